@@ -0,0 +1,284 @@
+"""
+Benchmark offline cho pipeline smart_ocr_rag (không gọi Google Vision / OpenAI)
+
+Chạy đúng các stage của production (build_scan_stages + run_stages: OCR parse, trích xuất
+nguyên liệu, phân tích sức khỏe, mapping vị trí) rồi dựng response, với client Vision / OpenAI
+giả lập có latency + jitter (fake_clients.py). Báo cáo theo từng kích thước nhãn:
+- p50 / p95 / p99 / mean từng stage (ms)
+- throughput (scan/giây) với --concurrency luồng song song
+- cấp phát bộ nhớ (tracemalloc, lượt chạy riêng để không làm sai thời gian) và peak RSS
+- số lần gọi API, token ước lượng, số chuỗi đã embed
+- số lệnh gọi đồng thời tối đa tới từng upstream và số lần phải chờ limiter (upstream.py)
+- với --fake-openai-server: gọi OpenAI thật qua SDK tới server giả lập (fake_openai_server.py),
+  thống kê retry / 429 / điều chỉnh concurrency của openai_scheduler
+- với --rtdb-latency: bật cache L2 trên Realtime Database giả lập (FakeRealtimeDb), đếm số
+  request đọc / ghi L2 mỗi scan (lượt sau của cùng nhãn dùng lại L2 dù L1 đã bị xóa)
+
+Ví dụ:
+    python bench_pipeline.py --sizes 50,200,600 --iterations 30
+    python bench_pipeline.py --vision-latency 0 --chat-latency 0 --embedding-latency 0   # chỉ đo CPU
+    python bench_pipeline.py --sizes 200 --iterations 64 --concurrency 16     # tải đồng thời / instance
+    python bench_pipeline.py --vision-json rec_vision.json --completions rec_completions.json
+    python bench_pipeline.py --sizes 200 --iterations 64 --concurrency 16 --fake-openai-server \
+        --openai-rpm 600 --openai-error-rate 0.05                              # 429 / backoff
+    python bench_pipeline.py --sizes 200 --iterations 20 --rtdb-latency 0.03         # có cache L2
+    python bench_pipeline.py --json current.json --baseline baseline.json --tolerance 0.25
+
+--vision-json: response ghi lại bằng vision.AnnotateImageResponse.to_json(response)
+--completions: {"extraction": ..., "health": ..., "verdicts": ..., "analysis": ...} nội dung JSON model đã trả về
+--analysis-mode fused: đo chế độ gộp 1 lệnh gọi (so sánh độ khớp 2 chế độ: compare_analysis_modes.py)
+Thoát với mã 1 nếu p95 của stage nào vượt baseline quá --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "functions"))
+
+# Không đụng tới Realtime Database thật (--rtdb-latency: L2 trên FakeRealtimeDb, phải bật trước khi
+# import main), ảnh giả lập không cần tiền xử lý
+_FAKE_RTDB = any(arg.startswith("--rtdb-latency") for arg in sys.argv)
+for _name in ("OCR_CACHE_L2", "EMBEDDING_CACHE_L2", "VERDICT_CACHE_L2"):
+    os.environ.setdefault(_name, "1" if _FAKE_RTDB else "0")
+os.environ.setdefault("PREPROCESS_ENABLED", "0")
+
+import numpy as np  # noqa: E402
+
+import main  # noqa: E402
+import cache  # noqa: E402
+from cache import clear_l1_caches  # noqa: E402
+from upstream import vision_limiter, chat_limiter, embedding_limiter  # noqa: E402
+from openai_scheduler import chat_scheduler, embedding_scheduler  # noqa: E402
+from fake_clients import Latency, FakeVisionClient, FakeOpenAIClient, FakeRealtimeDb  # noqa: E402
+from fake_openai_server import start_server, add_server_arguments  # noqa: E402
+from synthetic_labels import make_label, to_vision_response, load_vision_response  # noqa: E402
+
+HEALTH_PROFILE = {
+    "allergy": ["hải sản", "đậu phộng"],
+    "medical_history": ["tiểu đường", "cao huyết áp"],
+}
+UPSTREAM_LIMITERS = [vision_limiter, chat_limiter, embedding_limiter]
+SCHEDULERS = [chat_scheduler, embedding_scheduler]
+STAGES = ["ocr", "ocr_parse", "region", "fused", "ingredients", "health", "mappings", "assemble", "total"]
+
+
+def run_scan(image_content: bytes, threshold: float, analysis_mode: str = None) -> dict:
+    """1 lượt scan đầy đủ, trả về thời gian từng stage (ms)"""
+    started = time.perf_counter()
+    stages = main.build_scan_stages(image_content, HEALTH_PROFILE, threshold, analysis_mode=analysis_mode)
+    results, report = main.run_stages(stages)
+    assemble_started = time.perf_counter()
+    json.dumps(main.build_scan_response(results, report, HEALTH_PROFILE, threshold), ensure_ascii=False)
+    finished = time.perf_counter()
+
+    timings = {name: info["duration_ms"] for name, info in report.items()}
+    timings["assemble"] = (finished - assemble_started) * 1000
+    timings["total"] = (finished - started) * 1000
+    return timings
+
+
+def percentiles(values: list) -> dict:
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(float(p50), 2), "p95": round(float(p95), 2),
+            "p99": round(float(p99), 2), "mean": round(float(np.mean(values)), 2)}
+
+
+def bench_label(name: str, response, ingredients: list, args, recorded: dict) -> dict:
+    vision = FakeVisionClient(response, Latency(args.vision_latency, args.jitter, seed=1))
+    openai = FakeOpenAIClient(ingredients, Latency(args.chat_latency, args.jitter, seed=2),
+                              Latency(args.embedding_latency, args.jitter, seed=3), recorded=recorded)
+    main._vision_client = vision
+    main._openai_client = openai
+    rtdb = None
+    if args.rtdb_latency is not None:
+        rtdb = FakeRealtimeDb(Latency(args.rtdb_latency, args.jitter, seed=4))
+        cache.db = rtdb
+    server = None
+    if args.fake_openai_server:
+        server = start_server(ingredients, rpm=args.openai_rpm, error_rate=args.openai_error_rate,
+                              server_error_rate=args.openai_server_error_rate,
+                              latency=args.chat_latency, embedding_latency=args.embedding_latency,
+                              jitter=args.jitter, slow_rate=args.openai_slow_rate,
+                              slow_latency=args.openai_slow_latency, seed=2)
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        os.environ.setdefault("OPENAI_API_KEY", "bench")
+        main._openai_client = main._create_openai_client()
+
+    def image_for(i: int) -> bytes:
+        # Mỗi lượt 1 ảnh khác nhau -> cache OCR miss (trừ khi --warm)
+        return f"bench-{name}".encode() if args.warm else f"bench-{name}-{i}".encode()
+
+    def one(i: int) -> dict:
+        if not args.warm:
+            clear_l1_caches()
+        timings = run_scan(image_for(i), args.threshold, args.analysis_mode)
+        parse_started = time.perf_counter()
+        main.parse_vision_response(response)
+        timings["ocr_parse"] = (time.perf_counter() - parse_started) * 1000
+        return timings
+
+    for i in range(args.warmup):
+        one(-1 - i)
+
+    limiters_before = {limiter.name: limiter.get_stats() for limiter in UPSTREAM_LIMITERS}
+    schedulers_before = {scheduler.name: scheduler.get_stats() for scheduler in SCHEDULERS}
+    server_before = server.stats.snapshot() if server else {}
+    samples = []
+    wall_started = time.perf_counter()
+    if args.concurrency > 1:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            samples = list(pool.map(one, range(args.iterations)))
+    else:
+        samples = [one(i) for i in range(args.iterations)]
+    wall = time.perf_counter() - wall_started
+    calls = {**vision.stats.snapshot(), **openai.stats.snapshot(), **(rtdb.stats.snapshot() if rtdb else {})}
+    if server:
+        server_after = server.stats.snapshot()
+        calls.update({f"openai_{k}": v - server_before.get(k, 0) for k, v in server_after.items()})
+    upstream = {}
+    for limiter in UPSTREAM_LIMITERS:
+        before, after = limiters_before[limiter.name], limiter.get_stats()
+        upstream[limiter.name] = {"limit": after["limit"], "peak_in_flight": after["peak_in_flight"],
+                                  "waited": after["waited"] - before["waited"],
+                                  "wait_ms": round(after["wait_ms"] - before["wait_ms"], 1)}
+    scheduler_stats = {}
+    for scheduler in SCHEDULERS:
+        before, after = schedulers_before[scheduler.name], scheduler.get_stats()
+        scheduler_stats[scheduler.name] = {
+            **{k: after[k] - before[k] for k in ("retries", "rate_limited", "server_errors", "failures",
+                                                  "deadline_exceeded", "throttled")},
+            "limit": after["limit"],
+        }
+
+    if server:
+        server.shutdown()
+
+    # Lượt riêng để đo cấp phát (tracemalloc làm chậm đáng kể, không tính vào thời gian)
+    alloc_peak_kb = None
+    if args.alloc_iterations > 0 and not server:
+        saved = (vision.latency, openai.chat_latency, openai.embedding_latency)
+        vision.latency = openai.chat_latency = openai.embedding_latency = Latency(0)
+        tracemalloc.start()
+        for i in range(args.alloc_iterations):
+            clear_l1_caches()
+            tracemalloc.reset_peak()
+            run_scan(image_for(args.iterations + i), args.threshold, args.analysis_mode)
+        alloc_peak_kb = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+        tracemalloc.stop()
+        vision.latency, openai.chat_latency, openai.embedding_latency = saved
+
+    words = len(main.parse_vision_response(response))
+    return {
+        "ocr_words": words,
+        "ingredients": len(ingredients),
+        "iterations": args.iterations,
+        "stages": {stage: percentiles([s[stage] for s in samples if stage in s])
+                   for stage in STAGES if any(stage in s for s in samples)},
+        "throughput_per_sec": round(args.iterations / wall, 2),
+        "alloc_peak_kb": alloc_peak_kb,
+        # ru_maxrss: KB trên Linux, tăng dần theo thời gian sống của process
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "calls_per_scan": {k: round(v / (args.iterations + args.warmup), 1) for k, v in calls.items()},
+        "upstream": upstream,
+        "scheduler": scheduler_stats,
+    }
+
+
+def print_report(name: str, result: dict):
+    print(f"\n=== {name}: {result['ocr_words']} từ OCR, {result['ingredients']} nguyên liệu, "
+          f"{result['iterations']} lượt ===")
+    print(f"{'stage':<12}{'p50':>10}{'p95':>10}{'p99':>10}{'mean':>10}   (ms)")
+    for stage, p in result["stages"].items():
+        print(f"{stage:<12}{p['p50']:>10.1f}{p['p95']:>10.1f}{p['p99']:>10.1f}{p['mean']:>10.1f}")
+    print(f"throughput: {result['throughput_per_sec']} scan/s | peak RSS: {result['peak_rss_mb']} MB | "
+          f"alloc peak: {result['alloc_peak_kb']} KB")
+    print(f"calls/scan: {result['calls_per_scan']}")
+    print(f"upstream: {result['upstream']}")
+    print(f"scheduler: {result['scheduler']}")
+
+
+def compare_baseline(current: dict, baseline: dict, tolerance: float) -> list:
+    """Các stage có p95 vượt baseline * (1 + tolerance) (cộng 1ms để bỏ qua nhiễu ở stage rất nhanh)"""
+    regressions = []
+    for name, result in current["labels"].items():
+        base = baseline.get("labels", {}).get(name)
+        if not base:
+            continue
+        for stage, p in result["stages"].items():
+            base_p95 = base["stages"].get(stage, {}).get("p95")
+            if base_p95 is not None and p["p95"] > base_p95 * (1 + tolerance) + 1:
+                regressions.append(f"{name}/{stage}: p95 {p['p95']}ms > baseline {base_p95}ms")
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="50,200,600", help="Số từ của các nhãn giả lập")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--alloc-iterations", type=int, default=3)
+    parser.add_argument("--threshold", type=float, default=0.6)
+    parser.add_argument("--analysis-mode", choices=main.ANALYSIS_MODES, default=main.DEFAULT_ANALYSIS_MODE)
+    parser.add_argument("--warm", action="store_true", help="Giữ cache giữa các lượt (đo đường cache hit)")
+    parser.add_argument("--vision-latency", type=float, default=0.4, help="Giây / lệnh Vision")
+    parser.add_argument("--chat-latency", type=float, default=1.0, help="Giây / lệnh chat completion")
+    parser.add_argument("--embedding-latency", type=float, default=0.15, help="Giây / lệnh embeddings")
+    parser.add_argument("--jitter", type=float, default=0.25, help="Độ lệch chuẩn log-normal của latency")
+    parser.add_argument("--vision-json", nargs="*", default=[], help="Response Vision đã ghi lại")
+    parser.add_argument("--completions", help="Nội dung completion đã ghi lại (JSON)")
+    parser.add_argument("--fake-openai-server", action="store_true",
+                        help="Gọi OpenAI qua SDK tới server HTTP giả lập (bỏ qua đo cấp phát bộ nhớ)")
+    add_server_arguments(parser, prefix="openai-")
+    parser.add_argument("--rtdb-latency", type=float, default=None,
+                        help="Giây / request Realtime Database giả lập (bật cache L2)")
+    parser.add_argument("--json", help="Ghi kết quả ra file JSON")
+    parser.add_argument("--baseline", help="File JSON kết quả cũ để so sánh")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    recorded = {}
+    if args.completions:
+        with open(args.completions, encoding="utf-8") as f:
+            recorded = {k: v if isinstance(v, str) else json.dumps(v, ensure_ascii=False)
+                        for k, v in json.load(f).items()}
+    recorded_ingredients = json.loads(recorded["extraction"]).get("ingredients", []) if "extraction" in recorded else []
+
+    labels = []
+    for path in args.vision_json:
+        labels.append((os.path.basename(path), load_vision_response(path), recorded_ingredients))
+    if not args.vision_json:
+        for size in (int(s) for s in args.sizes.split(",") if s.strip()):
+            ingredients, paragraphs = make_label(size, seed=size)
+            labels.append((f"synthetic_{size}", to_vision_response(paragraphs, seed=size), ingredients))
+
+    output = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("json", "baseline")},
+        "labels": {},
+    }
+    for name, response, ingredients in labels:
+        result = bench_label(name, response, ingredients, args, recorded)
+        output["labels"][name] = result
+        print_report(name, result)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(output, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_baseline(output, json.load(f), args.tolerance)
+        if regressions:
+            print("\n❌ Regression:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("\n✅ Không có regression so với baseline")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,195 @@
+"""
+So sánh 2 chế độ phân tích của smart_ocr_rag trên cùng bộ nhãn:
+- separate: trích xuất nguyên liệu -> phân tích rủi ro (2 lệnh chat nối tiếp)
+- fused: 1 lệnh structured output (main.analyze_fused)
+
+Báo cáo theo từng nhãn và chế độ:
+- latency: tổng scan, thời điểm có nguyên liệu (event ingredients khi stream), p50 / p95 (ms)
+- số lệnh chat, token input / output (trace của từng scan)
+- độ khớp giữa 2 chế độ (từng lượt ghép cặp): Jaccard nguyên liệu và nguyên liệu bị cảnh báo
+  (đã chuẩn hóa), chênh lệch risk_score trung bình trên nguyên liệu cùng bị cảnh báo, tỉ lệ
+  cùng kết luận (có / không có cảnh báo risk_score >= 0.6)
+
+Mặc định dùng client OpenAI giả lập (fake_clients.py, chỉ kiểm tra đường code / latency giả lập);
+--live gọi OpenAI thật (cần OPENAI_API_KEY) để đo latency, token và độ khớp thực tế.
+Vision luôn dùng response đã ghi lại (--vision-json) hoặc nhãn giả lập.
+
+Ví dụ:
+    python compare_analysis_modes.py --sizes 50,200 --iterations 10
+    OPENAI_API_KEY=... python compare_analysis_modes.py --live --vision-json rec1.json rec2.json \\
+        --iterations 5 --json modes.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "functions"))
+
+# LOCAL_PARSER: nhãn giả lập đều tách được cục bộ, tắt để so sánh đúng phần trích xuất của model
+for _name in ("OCR_CACHE_L2", "EMBEDDING_CACHE_L2", "VERDICT_CACHE_L2", "PREPROCESS_ENABLED", "LOCAL_PARSER"):
+    os.environ.setdefault(_name, "0")
+
+import numpy as np  # noqa: E402
+
+import main  # noqa: E402
+import tracing  # noqa: E402
+from cache import clear_l1_caches  # noqa: E402
+from lexical_matcher import normalize  # noqa: E402
+from openai_scheduler import chat_scheduler  # noqa: E402
+from fake_clients import Latency, FakeVisionClient, FakeOpenAIClient  # noqa: E402
+from synthetic_labels import make_label, to_vision_response, load_vision_response  # noqa: E402
+
+HEALTH_PROFILE = {
+    "allergy": ["hải sản", "đậu phộng"],
+    "medical_history": ["tiểu đường", "cao huyết áp"],
+}
+# Ngưỡng "không an toàn" khi so kết luận của 2 chế độ
+UNSAFE_RISK = 0.6
+
+
+def run_scan(image_content: bytes, mode: str, threshold: float) -> dict:
+    """1 lượt scan, trả về thời gian, token và output cần để so khớp"""
+    marks = {}
+    started = time.perf_counter()
+
+    def on_stage_done(name, value, status):
+        marks[name] = (time.perf_counter() - started) * 1000
+
+    calls_before = chat_scheduler.get_stats()["calls"]
+    with tracing.trace_scope("compare_analysis_modes") as trace:
+        stages = main.build_scan_stages(image_content, HEALTH_PROFILE, threshold, analysis_mode=mode)
+        results, report = main.run_stages(stages, on_stage_done=on_stage_done)
+    total_ms = (time.perf_counter() - started) * 1000
+    counters = trace.to_dict()["counters"]
+    health = results.get("health") or {}
+    return {
+        "total_ms": total_ms,
+        "ingredients_ms": marks.get("ingredients"),
+        "chat_calls": chat_scheduler.get_stats()["calls"] - calls_before,
+        "input_tokens": counters.get("openai_input_tokens", 0),
+        "output_tokens": counters.get("openai_output_tokens", 0),
+        "degraded": [name for name, info in report.items() if info["status"] != "ok"],
+        "ingredients": results.get("ingredients") or [],
+        "warnings": health.get("warnings", []),
+    }
+
+
+def _jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def _warned(scan: dict) -> dict:
+    """nguyên liệu (chuẩn hóa) -> risk_score cao nhất"""
+    warned = {}
+    for warning in scan["warnings"]:
+        key = normalize(str(warning.get("ingredient", "")))
+        warned[key] = max(warned.get(key, 0.0), float(warning.get("risk_score", 0) or 0))
+    return warned
+
+
+def agreement(separate: dict, fused: dict) -> dict:
+    warned_a, warned_b = _warned(separate), _warned(fused)
+    common = warned_a.keys() & warned_b.keys()
+    unsafe_a = any(score >= UNSAFE_RISK for score in warned_a.values())
+    unsafe_b = any(score >= UNSAFE_RISK for score in warned_b.values())
+    return {
+        "ingredients_jaccard": _jaccard({normalize(i) for i in separate["ingredients"]},
+                                        {normalize(i) for i in fused["ingredients"]}),
+        "warnings_jaccard": _jaccard(set(warned_a), set(warned_b)),
+        "risk_score_mae": (float(np.mean([abs(warned_a[k] - warned_b[k]) for k in common]))
+                           if common else None),
+        "same_verdict": unsafe_a == unsafe_b,
+    }
+
+
+def summarize(scans: list) -> dict:
+    def pct(values):
+        values = [v for v in values if v is not None]
+        if not values:
+            return None
+        p50, p95 = np.percentile(values, [50, 95])
+        return {"p50": round(float(p50), 1), "p95": round(float(p95), 1)}
+
+    return {
+        "total_ms": pct([s["total_ms"] for s in scans]),
+        "ingredients_ms": pct([s["ingredients_ms"] for s in scans]),
+        "chat_calls": round(float(np.mean([s["chat_calls"] for s in scans])), 2),
+        "input_tokens": round(float(np.mean([s["input_tokens"] for s in scans])), 1),
+        "output_tokens": round(float(np.mean([s["output_tokens"] for s in scans])), 1),
+        "degraded_scans": sum(1 for s in scans if s["degraded"]),
+    }
+
+
+def compare_label(name: str, response, ingredients: list, args) -> dict:
+    main._vision_client = FakeVisionClient(response, Latency(0))
+    if not args.live:
+        main._openai_client = FakeOpenAIClient(ingredients, Latency(args.chat_latency, args.jitter, seed=2),
+                                               Latency(args.embedding_latency, args.jitter, seed=3))
+
+    scans = {mode: [] for mode in main.ANALYSIS_MODES}
+    for i in range(args.iterations):
+        # Xen kẽ 2 chế độ để latency của OpenAI dao động như nhau giữa 2 bên
+        for mode in main.ANALYSIS_MODES:
+            clear_l1_caches()
+            scans[mode].append(run_scan(f"compare-{name}-{i}".encode(), mode, args.threshold))
+
+    pairs = [agreement(a, b) for a, b in zip(scans["separate"], scans["fused"])]
+    mae = [p["risk_score_mae"] for p in pairs if p["risk_score_mae"] is not None]
+    return {
+        "modes": {mode: summarize(items) for mode, items in scans.items()},
+        "agreement": {
+            "ingredients_jaccard": round(float(np.mean([p["ingredients_jaccard"] for p in pairs])), 3),
+            "warnings_jaccard": round(float(np.mean([p["warnings_jaccard"] for p in pairs])), 3),
+            "risk_score_mae": round(float(np.mean(mae)), 3) if mae else None,
+            "same_verdict_rate": round(sum(p["same_verdict"] for p in pairs) / len(pairs), 3),
+        },
+    }
+
+
+def print_report(name: str, result: dict):
+    print(f"\n=== {name} ===")
+    print(f"{'mode':<10}{'total p50':>11}{'p95':>9}{'ingr. p50':>11}{'p95':>9}"
+          f"{'chat':>7}{'in tok':>9}{'out tok':>9}{'degraded':>10}")
+    for mode, s in result["modes"].items():
+        ingr = s["ingredients_ms"] or {"p50": 0, "p95": 0}
+        print(f"{mode:<10}{s['total_ms']['p50']:>11.0f}{s['total_ms']['p95']:>9.0f}"
+              f"{ingr['p50']:>11.0f}{ingr['p95']:>9.0f}{s['chat_calls']:>7}"
+              f"{s['input_tokens']:>9.0f}{s['output_tokens']:>9.0f}{s['degraded_scans']:>10}")
+    print(f"agreement: {result['agreement']}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="50,200", help="Số từ của các nhãn giả lập")
+    parser.add_argument("--vision-json", nargs="*", default=[], help="Response Vision đã ghi lại")
+    parser.add_argument("--iterations", type=int, default=5, help="Số lượt / chế độ / nhãn")
+    parser.add_argument("--threshold", type=float, default=0.6)
+    parser.add_argument("--live", action="store_true", help="Gọi OpenAI thật (OPENAI_API_KEY)")
+    parser.add_argument("--chat-latency", type=float, default=1.0, help="Giả lập: giây / lệnh chat")
+    parser.add_argument("--embedding-latency", type=float, default=0.15)
+    parser.add_argument("--jitter", type=float, default=0.25)
+    parser.add_argument("--json", help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    labels = [(os.path.basename(path), load_vision_response(path), []) for path in args.vision_json]
+    if not args.vision_json:
+        for size in (int(s) for s in args.sizes.split(",") if s.strip()):
+            ingredients, paragraphs = make_label(size, seed=size)
+            labels.append((f"synthetic_{size}", to_vision_response(paragraphs, seed=size), ingredients))
+
+    output = {"config": {k: v for k, v in vars(args).items() if k != "json"}, "labels": {}}
+    for name, response, ingredients in labels:
+        result = compare_label(name, response, ingredients, args)
+        output["labels"][name] = result
+        print_report(name, result)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(output, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
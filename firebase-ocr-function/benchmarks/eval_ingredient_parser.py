@@ -0,0 +1,128 @@
+"""
+Đánh giá bộ tách thành phần cục bộ (functions/ingredient_parser.py) trên bộ nhãn mẫu
+
+Mỗi nhãn trong fixtures/ingredient_lists.json được dựng thành response Vision (synthetic_labels.py)
+rồi chạy đúng đường code của pipeline: parse_vision_response -> detect_ingredient_region ->
+parse_ingredient_region. Nhãn có "expected": null là nhãn PHẢI gọi model (parser không được
+tự tin); các nhãn còn lại có danh sách nguyên liệu đúng.
+
+Báo cáo:
+- fast_path_rate: tỉ lệ nhãn đi đường cục bộ (không gọi model trích xuất)
+- exact_match_rate / precision / recall trên các nhãn đi đường cục bộ (so sau khi chuẩn hóa)
+- false_accepts: nhãn đi đường cục bộ nhưng sai (kể cả nhãn phải gọi model)
+- missed: nhãn tách được nhưng parser không đủ tự tin (chỉ tốn thêm 1 lệnh gọi model)
+- fallback_reasons: lý do phải gọi model
+
+Thoát với mã 1 nếu có false_accepts (dùng được như kiểm tra trước khi đổi quy tắc / ngưỡng).
+
+Ví dụ:
+    python eval_ingredient_parser.py
+    python eval_ingredient_parser.py --verbose --min-confidence 0.7 --json parser.json
+"""
+import os
+import sys
+import json
+import argparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "functions"))
+
+for _name in ("OCR_CACHE_L2", "EMBEDDING_CACHE_L2", "VERDICT_CACHE_L2", "PREPROCESS_ENABLED"):
+    os.environ.setdefault(_name, "0")
+
+import main  # noqa: E402
+import ingredient_parser  # noqa: E402
+from ingredient_region import detect_ingredient_region  # noqa: E402
+from lexical_matcher import normalize  # noqa: E402
+from synthetic_labels import tokenize, to_vision_response  # noqa: E402
+
+FIXTURES = os.path.join(HERE, "fixtures", "ingredient_lists.json")
+# Vision tách dấu câu thành từ riêng (trừ dấu thập phân)
+PUNCTUATION = ",.:;()[]%"
+
+
+def build_document(fixture: dict):
+    paragraphs = [[tokenize(line, PUNCTUATION) for line in lines] for lines in fixture["paragraphs"]]
+    return main.parse_vision_response(to_vision_response(paragraphs, paragraphs_per_block=1))
+
+
+def evaluate(fixture: dict) -> dict:
+    doc = build_document(fixture)
+    region = detect_ingredient_region(doc)
+    parsed = ingredient_parser.parse_ingredient_region(doc, region.mask)
+    expected = fixture["expected"]
+    result = {
+        "name": fixture["name"],
+        "accepted": parsed.confident,
+        "confidence": parsed.confidence,
+        "issues": parsed.issues,
+        "region": region.reason,
+        "ingredients": parsed.ingredients,
+        "expected": expected,
+    }
+    if parsed.confident:
+        got = [normalize(i) for i in parsed.ingredients]
+        want = [normalize(i) for i in expected] if expected is not None else []
+        common = len(set(got) & set(want))
+        result["exact"] = got == want
+        result["precision"] = common / len(got) if got else 0.0
+        result["recall"] = common / len(want) if want else 0.0
+    return result
+
+
+def summarize(results: list) -> dict:
+    accepted = [r for r in results if r["accepted"]]
+    reasons = {}
+    for r in results:
+        if not r["accepted"]:
+            reason = r["issues"][0] if r["issues"] else "low_confidence"
+            reasons[reason] = reasons.get(reason, 0) + 1
+
+    def mean(key):
+        return round(sum(r[key] for r in accepted) / len(accepted), 3) if accepted else None
+
+    return {
+        "fixtures": len(results),
+        "fast_path_rate": round(len(accepted) / len(results), 3) if results else 0,
+        "exact_match_rate": mean("exact"),
+        "precision": mean("precision"),
+        "recall": mean("recall"),
+        "false_accepts": [r["name"] for r in accepted if not r["exact"]],
+        "missed": [r["name"] for r in results if not r["accepted"] and r["expected"] is not None],
+        "fallback_reasons": reasons,
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixtures", default=FIXTURES)
+    parser.add_argument("--min-confidence", type=float, help="Ghi đè LOCAL_PARSER_MIN_CONFIDENCE")
+    parser.add_argument("--verbose", action="store_true", help="In kết quả từng nhãn")
+    parser.add_argument("--json", help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    if args.min_confidence is not None:
+        ingredient_parser.LOCAL_PARSER_MIN_CONFIDENCE = args.min_confidence
+    with open(args.fixtures, encoding="utf-8") as f:
+        fixtures = json.load(f)
+
+    results = [evaluate(fixture) for fixture in fixtures]
+    summary = summarize(results)
+
+    for r in results:
+        status = ("OK " if r["exact"] else "SAI") if r["accepted"] else "LLM"
+        print(f"{status} {r['name']:<30} conf={r['confidence']:.2f} region={r['region']:<14} "
+              f"issues={','.join(r['issues']) or '-'}")
+        if args.verbose or (r["accepted"] and not r["exact"]):
+            print(f"      got:      {r['ingredients']}")
+            print(f"      expected: {r['expected']}")
+    print(f"\n{json.dumps(summary, ensure_ascii=False)}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "results": results}, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if summary["false_accepts"] else 0)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,251 @@
+"""
+Client Vision / OpenAI giả lập cho benchmark (không gọi mạng)
+
+- Latency cấu hình được: base_sec * exp(N(0, jitter)) (phân phối log-normal, có đuôi dài
+  giống latency mạng thật)
+- Trả về response đã ghi lại (nếu có) hoặc response tổng hợp từ nhãn giả lập
+- Đếm số lần gọi, số token (ước lượng ~4 ký tự / token) và số chuỗi đã embed
+"""
+import json
+import math
+import time
+import random
+import zlib
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+
+
+class Latency:
+    """Sinh độ trễ log-normal, thread-safe"""
+
+    def __init__(self, base_sec: float, jitter: float = 0.0, seed: int = 0):
+        self.base_sec = base_sec
+        self.jitter = jitter
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sleep(self):
+        if self.base_sec <= 0:
+            return
+        with self._lock:
+            factor = math.exp(self._rng.gauss(0, self.jitter)) if self.jitter > 0 else 1.0
+        time.sleep(self.base_sec * factor)
+
+
+class CallStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, **fields):
+        with self._lock:
+            for field, n in fields.items():
+                self.counts[field] = self.counts.get(field, 0) + n
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.counts)
+
+
+class FakeVisionClient:
+    """Thay cho vision.ImageAnnotatorClient: trả về response đã ghi lại sau latency giả lập"""
+
+    def __init__(self, response, latency: Latency):
+        self.response = response
+        self.latency = latency
+        self.stats = CallStats()
+
+    def document_text_detection(self, image=None, **kwargs):
+        self.latency.sleep()
+        self.stats.add(vision_calls=1, vision_images=1)
+        return self.response
+
+    def batch_annotate_images(self, requests=None, **kwargs):
+        self.latency.sleep()
+        self.stats.add(vision_calls=1, vision_images=len(requests))
+        return SimpleNamespace(responses=[self.response for _ in requests])
+
+
+class FakeRealtimeDb:
+    """
+    Thay cho firebase_admin.db (chỉ reference().get / set / update / delete), lưu trong bộ nhớ
+    Mỗi lệnh get / set / update / delete là 1 request (latency giả lập), đếm số lượt đọc / ghi / byte ghi
+    """
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.stats = CallStats()
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def reference(self, path: str):
+        return _FakeReference(self, path.strip("/"))
+
+
+class _FakeReference:
+    def __init__(self, db: FakeRealtimeDb, path: str):
+        self._db = db
+        self._path = path
+
+    def get(self):
+        self._db.latency.sleep()
+        self._db.stats.add(rtdb_reads=1)
+        with self._db._lock:
+            return self._db._data.get(self._path)
+
+    def set(self, value):
+        self._db.latency.sleep()
+        self._db.stats.add(rtdb_writes=1, rtdb_write_bytes=len(json.dumps(value)))
+        with self._db._lock:
+            self._db._data[self._path] = value
+
+    def delete(self):
+        self._db.latency.sleep()
+        self._db.stats.add(rtdb_writes=1)
+        with self._db._lock:
+            self._db._data.pop(self._path, None)
+
+    def update(self, values: dict):
+        # Chỉ hỗ trợ update 1 cấp dưới path (đủ cho cache L2)
+        self._db.latency.sleep()
+        self._db.stats.add(rtdb_writes=1, rtdb_write_bytes=len(json.dumps(values)))
+        with self._db._lock:
+            for key, value in values.items():
+                self._db._data[f"{self._path}/{key}"] = value
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class _FakeCompletions:
+    def __init__(self, parent: "FakeOpenAIClient"):
+        self._parent = parent
+
+    def create(self, model: str, messages: list, stream: bool = False, **kwargs):
+        parent = self._parent
+        prompt = messages[-1]["content"]
+        content = parent.respond(prompt, kwargs.get("response_format"))
+        parent.chat_latency.sleep()
+        usage = SimpleNamespace(
+            prompt_tokens=_estimate_tokens(prompt),
+            completion_tokens=_estimate_tokens(content),
+            total_tokens=_estimate_tokens(prompt) + _estimate_tokens(content),
+        )
+        parent.stats.add(chat_calls=1, prompt_tokens=usage.prompt_tokens,
+                         completion_tokens=usage.completion_tokens)
+        if stream:
+            chunks = [
+                SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content[i:i + 16]))])
+                for i in range(0, len(content), 16)
+            ]
+            if (kwargs.get("stream_options") or {}).get("include_usage"):
+                chunks.append(SimpleNamespace(choices=[], usage=usage))
+            return iter(chunks)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=usage,
+        )
+
+
+class _FakeEmbeddings:
+    def __init__(self, parent: "FakeOpenAIClient"):
+        self._parent = parent
+
+    def create(self, model: str, input: list, **kwargs):
+        parent = self._parent
+        parent.embedding_latency.sleep()
+        parent.stats.add(embedding_calls=1, embedded_strings=len(input))
+        return SimpleNamespace(
+            data=[SimpleNamespace(embedding=parent.vector(text)) for text in input],
+            usage=SimpleNamespace(prompt_tokens=sum(_estimate_tokens(t) for t in input)),
+        )
+
+
+class FakeOpenAIClient:
+    """
+    Thay cho openai.OpenAI: chat.completions.create + embeddings.create
+    Args:
+        ingredients: Nguyên liệu trả về cho prompt trích xuất (nhãn giả lập)
+        recorded: (optional) dict {"extraction" | "health" | "verdicts" | "analysis": nội dung JSON đã ghi lại}
+        dim: Số chiều vector embedding
+    """
+
+    def __init__(self, ingredients: list, chat_latency: Latency, embedding_latency: Latency,
+                 recorded: dict = None, dim: int = 1536):
+        self.ingredients = ingredients
+        self.recorded = recorded or {}
+        self.dim = dim
+        self.chat_latency = chat_latency
+        self.embedding_latency = embedding_latency
+        self.stats = CallStats()
+        self.chat = SimpleNamespace(completions=_FakeCompletions(self))
+        self.embeddings = _FakeEmbeddings(self)
+
+    def vector(self, text: str) -> list:
+        # Vector ổn định theo text (cùng text -> cùng vector)
+        rng = np.random.default_rng(zlib.crc32(text.encode("utf-8")))
+        return rng.standard_normal(self.dim, dtype=np.float32)
+
+    def respond(self, prompt: str, response_format: dict = None) -> str:
+        if (response_format or {}).get("type") == "json_schema":
+            # Chế độ gộp (main.analyze_fused): nguyên liệu + phân tích rủi ro
+            kind = "analysis"
+        elif '"verdicts"' in prompt:
+            kind = "verdicts"
+        elif '"warnings"' in prompt:
+            kind = "health"
+        else:
+            kind = "extraction"
+        if kind in self.recorded:
+            return self.recorded[kind]
+        return json.dumps(getattr(self, f"_synthetic_{kind}")(prompt), ensure_ascii=False)
+
+    def _synthetic_extraction(self, prompt: str) -> dict:
+        return {"ingredients": list(self.ingredients)}
+
+    def _synthetic_analysis(self, prompt: str) -> dict:
+        return {**self._synthetic_extraction(prompt), **self._synthetic_health(prompt)}
+
+    def _risky(self) -> list:
+        # Khoảng 1/4 nguyên liệu có rủi ro
+        return self.ingredients[::4]
+
+    def _synthetic_health(self, prompt: str) -> dict:
+        risky = self._risky()
+        return {
+            "warnings": [_verdict(name) for name in risky],
+            "safe_ingredients": [name for name in self.ingredients if name not in risky],
+            "overall_recommendation": "CẦN HẠN CHẾ: dữ liệu giả lập cho benchmark.",
+        }
+
+    def _synthetic_verdicts(self, prompt: str) -> dict:
+        # Prompt verdict liệt kê "- <nguyên liệu>: [Dị ứng] x; [Bệnh lý] y"; mọi cặp đều có
+        # verdict, nguyên liệu rủi ro chỉ có rủi ro với tình trạng đầu tiên
+        verdicts = []
+        risky = set(self._risky())
+        for line in prompt.splitlines():
+            if not line.startswith("- ") or ": [" not in line:
+                continue
+            name, conditions = line[2:].split(": [", 1)
+            for i, item in enumerate(f"[{conditions}".split("; ")):
+                condition = item.split("]", 1)[1].strip()
+                if name in risky and i == 0:
+                    verdicts.append({**_verdict(name), "condition": condition})
+                else:
+                    verdicts.append({"ingredient": name, "condition": condition, "risk_score": 0})
+        return {"verdicts": verdicts}
+
+
+def _verdict(name: str) -> dict:
+    return {
+        "ingredient": name,
+        "risk_score": 0.65,
+        "warning_type": "medical_condition",
+        "summary": f"{name} ảnh hưởng tới tình trạng sức khỏe (giả lập)",
+        "scientific_explanation": "Nội dung giả lập cho benchmark. " * 8,
+        "potential_effects": ["Tác động 1", "Tác động 2"],
+        "recommendation": "Hạn chế sử dụng",
+    }
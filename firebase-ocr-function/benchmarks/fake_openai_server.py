@@ -0,0 +1,228 @@
+"""
+Server HTTP giả lập OpenAI API (chat completions + embeddings) để thử openai_scheduler
+
+Trả về nội dung tổng hợp như FakeOpenAIClient (fake_clients.py), kèm header rate limit
+giống OpenAI; có thể cấu hình để trả 429 / 5xx / response chậm:
+- --rpm: giới hạn request / phút (token bucket), vượt -> 429 + retry-after
+- --error-rate / --server-error-rate: tỉ lệ 429 / 500 ngẫu nhiên
+- --latency, --embedding-latency, --jitter, --slow-rate, --slow-latency: độ trễ (log-normal) và response chậm bất thường
+
+Chạy riêng:
+    python fake_openai_server.py --port 8089 --rpm 120 --error-rate 0.1
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=fake ...
+Hoặc để bench_pipeline.py tự khởi động: --fake-openai-server (xem --help)
+GET /stats: số request đã nhận / 429 / 500.
+"""
+import json
+import time
+import base64
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from fake_clients import Latency, CallStats, FakeOpenAIClient, _estimate_tokens
+
+
+class RateLimiter:
+    """Token bucket theo phút, trả về (được phép?, còn lại, giây tới khi có thêm 1 lượt)"""
+
+    def __init__(self, rpm: int):
+        self.rpm = rpm
+        self.tokens = float(rpm)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> tuple[bool, int, float]:
+        if self.rpm <= 0:
+            return True, 1_000_000, 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rpm, self.tokens + (now - self.updated) * self.rpm / 60)
+            self.updated = now
+            refill = 60 / self.rpm
+            if self.tokens < 1:
+                return False, 0, (1 - self.tokens) * refill
+            self.tokens -= 1
+            return True, int(self.tokens), refill
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, ingredients: list, rpm: int = 0, error_rate: float = 0.0,
+                 server_error_rate: float = 0.0, latency: float = 0.0, embedding_latency: float = None,
+                 jitter: float = 0.0, slow_rate: float = 0.0, slow_latency: float = 0.0, seed: int = 0):
+        super().__init__(address, _Handler)
+        self.content = FakeOpenAIClient(ingredients, Latency(0), Latency(0))
+        self.limiter = RateLimiter(rpm)
+        self.error_rate = error_rate
+        self.server_error_rate = server_error_rate
+        self.latency = Latency(latency, jitter, seed=seed)
+        self.embedding_latency = Latency(latency if embedding_latency is None else embedding_latency,
+                                         jitter, seed=seed + 1)
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.stats = CallStats()
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+
+    def roll(self) -> float:
+        with self._rng_lock:
+            return self._rng.random()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FakeOpenAIServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            return self._json(200, self.server.stats.snapshot())
+        self._json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        server = self.server
+        server.stats.add(requests=1)
+
+        allowed, remaining, reset = server.limiter.take()
+        rate_headers = {
+            "x-ratelimit-limit-requests": str(server.limiter.rpm or 1_000_000),
+            "x-ratelimit-remaining-requests": str(remaining),
+            "x-ratelimit-reset-requests": f"{reset:.3f}s",
+        }
+        if not allowed or server.roll() < server.error_rate:
+            server.stats.add(rate_limited=1)
+            return self._json(429, {"error": {"message": "Rate limit reached (fake)", "type": "requests",
+                                              "code": "rate_limit_exceeded"}},
+                              {**rate_headers, "retry-after": f"{max(reset, 0.05):.3f}"})
+        if server.roll() < server.server_error_rate:
+            server.stats.add(server_errors=1)
+            return self._json(500, {"error": {"message": "Internal error (fake)", "type": "server_error"}})
+
+        (server.embedding_latency if self.path.endswith("/embeddings") else server.latency).sleep()
+        if server.slow_rate and server.roll() < server.slow_rate:
+            server.stats.add(slow=1)
+            time.sleep(server.slow_latency)
+
+        if self.path.endswith("/chat/completions"):
+            return self._chat(body, rate_headers)
+        if self.path.endswith("/embeddings"):
+            return self._embeddings(body, rate_headers)
+        self._json(404, {"error": {"message": f"unknown path {self.path}"}})
+
+    def _chat(self, body: dict, headers: dict):
+        prompt = body["messages"][-1]["content"]
+        content = self.server.content.respond(prompt, body.get("response_format"))
+        usage = {"prompt_tokens": _estimate_tokens(prompt), "completion_tokens": _estimate_tokens(content)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        self.server.stats.add(chat=1)
+        base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": body.get("model", "fake")}
+
+        if not body.get("stream"):
+            return self._json(200, {
+                **base, "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            }, headers)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        chunks = [
+            {**base, "object": "chat.completion.chunk",
+             "choices": [{"index": 0, "delta": {"content": content[i:i + 16]}, "finish_reason": None}]}
+            for i in range(0, len(content), 16)
+        ]
+        if (body.get("stream_options") or {}).get("include_usage"):
+            chunks.append({**base, "object": "chat.completion.chunk", "choices": [], "usage": usage})
+        for chunk in chunks:
+            self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _embeddings(self, body: dict, headers: dict):
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        as_base64 = body.get("encoding_format") == "base64"
+        data = []
+        for i, text in enumerate(texts):
+            vector = np.asarray(self.server.content.vector(text), dtype=np.float32)
+            embedding = base64.b64encode(vector.tobytes()).decode() if as_base64 else vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(_estimate_tokens(t) for t in texts)
+        self.server.stats.add(embeddings=1, embedded_strings=len(texts))
+        self._json(200, {"object": "list", "data": data, "model": body.get("model", "fake"),
+                         "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}, headers)
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _json(self, status: int, payload: dict, headers: dict = None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_server(ingredients: list, host: str = "127.0.0.1", port: int = 0, **options) -> FakeOpenAIServer:
+    """Chạy server trong thread nền (port 0 = cổng ngẫu nhiên), trả về server (xem .base_url)"""
+    server = FakeOpenAIServer((host, port), ingredients, **options)
+    threading.Thread(target=server.serve_forever, daemon=True, name="fake-openai").start()
+    return server
+
+
+def add_server_arguments(parser: argparse.ArgumentParser, prefix: str = ""):
+    parser.add_argument(f"--{prefix}rpm", type=int, default=0, help="Request / phút (0 = không giới hạn)")
+    parser.add_argument(f"--{prefix}error-rate", type=float, default=0.0, help="Tỉ lệ 429 ngẫu nhiên")
+    parser.add_argument(f"--{prefix}server-error-rate", type=float, default=0.0, help="Tỉ lệ 500 ngẫu nhiên")
+    parser.add_argument(f"--{prefix}slow-rate", type=float, default=0.0, help="Tỉ lệ response chậm bất thường")
+    parser.add_argument(f"--{prefix}slow-latency", type=float, default=5.0, help="Giây thêm cho response chậm")
+
+
+def main_cli():
+    from synthetic_labels import make_label
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=1.0, help="Giây / lệnh chat completion")
+    parser.add_argument("--embedding-latency", type=float, default=0.15, help="Giây / lệnh embeddings")
+    parser.add_argument("--jitter", type=float, default=0.25)
+    parser.add_argument("--label-size", type=int, default=200, help="Nhãn giả lập dùng để sinh nguyên liệu")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    ingredients, _ = make_label(args.label_size, seed=args.label_size)
+    server = FakeOpenAIServer((args.host, args.port), ingredients, rpm=args.rpm, error_rate=args.error_rate,
+                              server_error_rate=args.server_error_rate, latency=args.latency,
+                              embedding_latency=args.embedding_latency, jitter=args.jitter,
+                              slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+    print(f"Fake OpenAI server: {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n{server.stats.snapshot()}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,142 @@
+"""
+Sinh nhãn thành phần giả lập dưới dạng response Google Vision thật (AnnotateImageResponse)
+
+Dùng cho bench_pipeline.py khi không có response đã ghi lại. Response được dựng bằng
+chính kiểu proto của google-cloud-vision, nên parse_vision_response chạy đúng đường code
+như production (symbols, detected_break, confidence, bounding box).
+
+Ghi lại response thật để benchmark:
+    json_text = vision.AnnotateImageResponse.to_json(response)
+rồi truyền file qua --vision-json.
+"""
+import random
+
+INGREDIENTS = [
+    "bột mì", "đường", "muối i-ốt", "dầu cọ", "sữa bột", "sữa bột gầy", "bơ", "trứng gà",
+    "tinh bột sắn", "tinh bột ngô", "đường glucose", "mạch nha", "tôm khô", "mực", "cá cơm",
+    "đậu nành", "đậu phộng", "mè rang", "hạt điều", "cacao", "socola", "vani tổng hợp",
+    "chất điều vị (621)", "chất tạo ngọt (955)", "chất bảo quản (211)", "chất nhũ hóa (322)",
+    "chất ổn định (1422)", "chất tạo xốp (500ii)", "màu thực phẩm (102)", "hương dâu tổng hợp",
+    "nước mắm", "tỏi", "hành tím", "ớt bột", "tiêu đen", "gừng", "lá dứa", "nước cốt dừa",
+    "sữa dừa", "bột trứng", "whey", "lactose", "gluten lúa mì", "men nở", "giấm", "mật ong",
+]
+
+FILLER = [
+    "hướng", "dẫn", "sử", "dụng", "bảo", "quản", "nơi", "khô", "ráo", "thoáng", "mát", "tránh",
+    "ánh", "nắng", "trực", "tiếp", "ngày", "sản", "xuất", "hạn", "xem", "trên", "bao", "bì",
+    "khối", "lượng", "tịnh", "năng", "lượng", "chất", "béo", "carbohydrate", "protein", "natri",
+    "giá", "trị", "dinh", "dưỡng", "trong", "100g", "sản", "phẩm", "công", "ty", "cổ", "phần",
+    "thực", "phẩm", "việt", "nam", "địa", "chỉ", "khu", "công", "nghiệp", "tỉnh", "bình", "dương",
+]
+
+WORDS_PER_LINE = 8
+LINES_PER_PARAGRAPH = 4
+PARAGRAPHS_PER_BLOCK = 2
+
+# BreakType
+_SPACE = 1
+_LINE_BREAK = 5
+
+
+def tokenize(text: str, punctuation: str = ",:;()") -> list:
+    """Tách như Vision: dấu câu đứng riêng thành 1 từ (trừ dấu thập phân: "1,9", "0.5")"""
+    tokens = []
+    for part in text.split():
+        word = ""
+        for i, ch in enumerate(part):
+            decimal = ch in ",." and 0 < i < len(part) - 1 and part[i - 1].isdigit() and part[i + 1].isdigit()
+            if ch in punctuation and not decimal:
+                if word:
+                    tokens.append(word)
+                    word = ""
+                tokens.append(ch)
+            else:
+                word += ch
+        if word:
+            tokens.append(word)
+    return tokens
+
+
+def make_label(word_count: int, seed: int = 0) -> tuple[list, list]:
+    """
+    Sinh nhãn ~word_count từ (kể cả dấu câu)
+    Returns:
+        (ingredients: nguyên liệu có trên nhãn, paragraphs: [[dòng = [token...]]])
+    """
+    rng = random.Random(seed)
+    n_ingredients = min(len(INGREDIENTS), max(5, word_count // 12))
+    ingredients = rng.sample(INGREDIENTS, n_ingredients)
+
+    tokens = tokenize("Thành phần: " + ", ".join(ingredients) + ".")
+    sections = [tokens]
+    remaining = max(0, word_count - len(tokens))
+    while remaining > 0:
+        size = min(remaining, rng.randint(20, 60))
+        sections.append([rng.choice(FILLER) for _ in range(size)])
+        remaining -= size
+
+    paragraphs = []
+    for section in sections:
+        lines = [section[i:i + WORDS_PER_LINE] for i in range(0, len(section), WORDS_PER_LINE)]
+        for i in range(0, len(lines), LINES_PER_PARAGRAPH):
+            paragraphs.append(lines[i:i + LINES_PER_PARAGRAPH])
+    return ingredients, paragraphs
+
+
+def to_vision_response(paragraphs: list, seed: int = 0, paragraphs_per_block: int = PARAGRAPHS_PER_BLOCK):
+    """Dựng vision.AnnotateImageResponse từ các paragraph (list dòng, mỗi dòng list token)"""
+    from google.cloud import vision
+
+    rng = random.Random(seed)
+    char_w, line_h = 14, 24
+    blocks = []
+    y = 20
+    for start in range(0, len(paragraphs), paragraphs_per_block):
+        block_paragraphs = []
+        for lines in paragraphs[start:start + paragraphs_per_block]:
+            words = []
+            for line in lines:
+                x = 20
+                for position, token in enumerate(line):
+                    last_in_line = position == len(line) - 1
+                    symbols = [
+                        {
+                            "text": ch,
+                            "confidence": round(rng.uniform(0.85, 1.0), 3),
+                            "property": {"detected_break": {
+                                "type_": (_LINE_BREAK if last_in_line else _SPACE) if i == len(token) - 1 else 0
+                            }},
+                        }
+                        for i, ch in enumerate(token)
+                    ]
+                    width = char_w * len(token)
+                    words.append({
+                        "symbols": symbols,
+                        "confidence": round(rng.uniform(0.9, 1.0), 3),
+                        "bounding_box": {"vertices": [
+                            {"x": x, "y": y}, {"x": x + width, "y": y},
+                            {"x": x + width, "y": y + line_h}, {"x": x, "y": y + line_h},
+                        ]},
+                    })
+                    x += width + char_w
+                y += line_h + 6
+            block_paragraphs.append({"words": words})
+            y += line_h
+        blocks.append({"paragraphs": block_paragraphs})
+
+    full_text = "\n".join(" ".join(line) for lines in paragraphs for line in lines)
+    return vision.AnnotateImageResponse({
+        "text_annotations": [{"description": full_text}],
+        "full_text_annotation": {
+            "text": full_text,
+            "pages": [{"width": 1200, "height": y + 20, "blocks": blocks}],
+        },
+    })
+
+
+def load_vision_response(path: str):
+    """Đọc response đã ghi lại bằng vision.AnnotateImageResponse.to_json"""
+    from google.cloud import vision
+
+    with open(path, encoding="utf-8") as f:
+        return vision.AnnotateImageResponse.from_json(f.read(), ignore_unknown_fields=True)
@@ -0,0 +1,402 @@
+"""
+Biên dịch hồ sơ sức khỏe thành tập từ khóa kích hoạt để so khớp dị ứng cục bộ
+
+Thay vì để model suy luận mỗi lần rằng "hải sản" bao gồm tôm, cua, mực... hay
+"gluten" bao gồm bột mì, lúa mạch..., mỗi hồ sơ được biên dịch 1 lần thành:
+- trigger trực tiếp (allergy / medical_condition)
+- trigger phản ứng chéo (cross_reactivity)
+và cache theo hash của hồ sơ đã chuẩn hóa. Việc so khớp với danh sách nguyên liệu dùng
+index theo token đầu tiên của trigger, kết quả cố định và lặp lại được.
+"""
+import re
+import hashlib
+from collections import defaultdict
+
+from cache import TieredCache, env_int
+from lexical_matcher import normalize
+
+# Đổi khi TAXONOMY thay đổi để bỏ các hồ sơ đã biên dịch cũ
+TAXONOMY_VERSION = 2
+
+# Nhóm -> (từ khóa trực tiếp, từ khóa phản ứng chéo, từ khóa loại trừ)
+# Từ khóa so khớp theo nguyên token (giữ dấu tiếng Việt để tránh "cá" khớp "cà")
+# Mã phụ gia viết dạng "e<mã>": chỉ khớp "E220", "INS 220" hoặc mã trong ngoặc "(220)", không khớp
+# số đứng trần (khối lượng, hàm lượng...). "bơ" trần là quả bơ (latex), bơ sữa phải ghi rõ.
+TAXONOMY = {
+    "hải sản": (
+        ["hải sản", "tôm", "tép", "cua", "ghẹ", "mực", "bạch tuộc", "sò", "ốc", "hến", "nghêu",
+         "ngao", "hàu", "cá", "nước mắm", "mắm", "seafood", "shrimp", "prawn", "crab", "squid",
+         "oyster", "clam", "mussel", "fish", "shellfish"],
+        [],
+        []
+    ),
+    "giáp xác": (
+        ["tôm", "tép", "cua", "ghẹ", "tôm hùm", "shrimp", "prawn", "crab", "lobster", "crustacean"],
+        ["mực", "sò", "ốc", "hến", "nghêu", "hàu"],
+        []
+    ),
+    "tôm": (["tôm", "tép", "shrimp", "prawn"], ["cua", "ghẹ", "tôm hùm", "lobster", "crab"], []),
+    "cua": (["cua", "ghẹ", "crab"], ["tôm", "tép", "shrimp", "prawn"], []),
+    "cá": (["cá", "nước mắm", "dầu cá", "fish", "anchovy"], [], []),
+    "gluten": (
+        ["gluten", "bột mì", "lúa mì", "lúa mạch", "yến mạch", "mạch nha", "bột mì đa dụng",
+         "wheat", "barley", "oat", "oats", "rye", "malt", "semolina"],
+        [],
+        []
+    ),
+    "lúa mì": (["lúa mì", "bột mì", "wheat", "semolina"], ["lúa mạch", "barley", "rye"], []),
+    "đậu phộng": (
+        ["đậu phộng", "lạc", "bơ đậu phộng", "peanut", "peanuts", "groundnut"],
+        ["đậu nành", "đậu tương", "đậu xanh", "đậu hà lan", "lupin", "soy", "soybean"],
+        []
+    ),
+    "các loại đậu": (
+        ["đậu", "đậu phộng", "lạc", "đậu nành", "đậu tương", "đậu xanh", "đậu đỏ", "đậu đen",
+         "đậu hà lan", "peanut", "soy", "soya", "soybean", "bean", "beans", "pea", "lentil"],
+        [],
+        []
+    ),
+    "đậu nành": (
+        ["đậu nành", "đậu tương", "lecithin đậu nành", "nước tương", "xì dầu", "đậu hũ", "đậu phụ",
+         "soy", "soya", "soybean", "tofu"],
+        ["đậu phộng", "lạc", "peanut"],
+        []
+    ),
+    "sữa": (
+        ["sữa", "sữa bò", "sữa bột", "sữa tươi", "sữa đặc", "bột sữa", "whey", "casein", "caseinate",
+         "lactose", "bơ sữa", "bơ động vật", "bơ lạt", "kem sữa", "phô mai", "milk", "butter", "cream",
+         "cheese", "dairy"],
+        ["sữa dê", "sữa cừu", "goat milk"],
+        ["sữa dừa", "sữa đậu nành", "sữa hạt", "coconut milk"]
+    ),
+    "sữa bò": (
+        ["sữa", "sữa bò", "sữa bột", "sữa tươi", "sữa đặc", "bột sữa", "whey", "casein",
+         "lactose", "bơ sữa", "bơ động vật", "bơ lạt", "kem sữa", "phô mai", "milk", "butter", "cream",
+         "cheese"],
+        ["sữa dê", "sữa cừu", "goat milk"],
+        ["sữa dừa", "sữa đậu nành", "sữa hạt", "coconut milk"]
+    ),
+    "lactose": (["lactose", "sữa", "sữa bột", "whey", "milk"], [], ["sữa dừa", "sữa đậu nành", "sữa hạt"]),
+    "trứng": (
+        ["trứng", "lòng đỏ trứng", "lòng trắng trứng", "bột trứng", "albumin", "egg", "eggs", "egg yolk"],
+        [],
+        []
+    ),
+    "các loại hạt": (
+        ["hạnh nhân", "óc chó", "hạt điều", "hạt dẻ", "hạt phỉ", "hạt macca", "hạt dẻ cười",
+         "almond", "cashew", "walnut", "hazelnut", "pecan", "pistachio", "macadamia"],
+        [],
+        []
+    ),
+    "mè": (["mè", "vừng", "dầu mè", "sesame"], [], []),
+    "vừng": (["mè", "vừng", "dầu mè", "sesame"], [], []),
+    "latex": (
+        [],
+        ["chuối", "bơ", "kiwi", "hạt dẻ", "banana", "avocado", "chestnut"],
+        ["bơ sữa", "bơ động vật", "bơ lạt", "bơ thực vật", "bơ đậu phộng", "bơ ca cao"]
+    ),
+    "sulfite": (["sulfite", "sulphite", "natri metabisulfit", "e220", "e221", "e223", "e224"], [], []),
+    "bột ngọt": (["bột ngọt", "mì chính", "msg", "mononatri glutamat", "e621"], [], []),
+    # --- Bệnh lý ---
+    "tiểu đường": (
+        ["đường", "đường kính", "đường cát", "đường mía", "glucose", "fructose", "sucrose", "siro",
+         "syrup", "mạch nha", "maltodextrin", "mật ong", "sugar", "tinh bột"],
+        [],
+        []
+    ),
+    "cao huyết áp": (
+        ["muối", "muối i ốt", "natri", "sodium", "salt", "bột ngọt", "mì chính", "msg", "e621",
+         "nước mắm", "nước tương", "hạt nêm", "bột canh"],
+        [],
+        []
+    ),
+    "gan nhiễm mỡ": (
+        ["đường", "fructose", "siro", "syrup", "dầu cọ", "shortening", "chất béo bão hòa", "rượu",
+         "mỡ", "bơ sữa", "bơ động vật", "butter", "sugar", "palm oil"],
+        [],
+        []
+    ),
+    "gout": (
+        ["thịt bò", "nội tạng", "gan", "tôm", "cua", "cá cơm", "hải sản", "nấm men", "chiết xuất nấm men",
+         "bia", "yeast extract"],
+        [],
+        []
+    ),
+    "bệnh thận": (
+        ["muối", "natri", "kali", "phốt phát", "phosphat", "phosphate", "e451", "e452", "e339", "e340",
+         "protein", "đạm", "sodium", "potassium"],
+        [],
+        []
+    ),
+    "viêm họng": (
+        ["ớt", "hạt tiêu", "tiêu đen", "tiêu trắng", "tiêu xay", "bột tiêu", "cay", "chili", "pepper",
+         "acid citric", "axit citric", "e330"],
+        [],
+        []
+    ),
+}
+
+# Tên gọi khác -> tên nhóm trong TAXONOMY
+ALIASES = {
+    "hai san": "hải sản", "seafood": "hải sản", "shellfish": "giáp xác", "động vật có vỏ": "giáp xác",
+    "lạc": "đậu phộng", "peanut": "đậu phộng", "đậu": "các loại đậu", "họ đậu": "các loại đậu",
+    "đậu tương": "đậu nành", "soy": "đậu nành", "milk": "sữa", "sữa và các sản phẩm từ sữa": "sữa",
+    "egg": "trứng", "hạt cây": "các loại hạt", "tree nuts": "các loại hạt", "nuts": "các loại hạt",
+    "sesame": "mè", "wheat": "lúa mì", "bột mì": "lúa mì", "msg": "bột ngọt", "mì chính": "bột ngọt",
+    "đái tháo đường": "tiểu đường", "diabetes": "tiểu đường", "tăng huyết áp": "cao huyết áp",
+    "huyết áp cao": "cao huyết áp", "hypertension": "cao huyết áp", "fatty liver": "gan nhiễm mỡ",
+    "gút": "gout", "suy thận": "bệnh thận", "thận": "bệnh thận", "cao su": "latex",
+}
+
+# (kind, warning_type) -> risk_score mặc định cho kết quả so khớp cục bộ
+LOCAL_RISK_SCORES = {
+    ("allergy", "allergy"): 0.9,
+    ("allergy", "cross_reactivity"): 0.6,
+    ("medical", "medical_condition"): 0.5,
+}
+
+
+# Mã phụ gia: "E220" / "E 220" / "INS 220" và các mã trong ngoặc "(220)", "(220, 223)"
+# (hậu tố phân loại như "451i" / "451(i)" được bỏ: trigger chỉ dùng mã gốc)
+_CODE_SUFFIX = r'(?:[a-f]|[iv]{1,3})?'
+_ADDITIVE_PREFIX = re.compile(rf'\b(?:e|ins)\s*(\d{{3,4}}){_CODE_SUFFIX}\b')
+_PAREN_CODES = re.compile(rf'\(\s*(\d{{3,4}}{_CODE_SUFFIX}(?:\s*[,;/]\s*\d{{3,4}}{_CODE_SUFFIX})*)\s*\)')
+
+
+def _additive_codes(text: str) -> str:
+    """Viết mã phụ gia về dạng "e<mã>" (số đứng trần giữ nguyên, không khớp trigger phụ gia)"""
+    text = _PAREN_CODES.sub(lambda m: " ".join(f"e{code}" for code in re.findall(r'\d{3,4}', m.group(1))), text)
+    return _ADDITIVE_PREFIX.sub(r'e\1', text)
+
+
+def _tokens(text: str) -> list:
+    """Tách token chữ/số sau khi chuẩn hóa (bỏ dấu câu, ngoặc, %; mã phụ gia -> "e<mã>")"""
+    return re.findall(r'\w+', _additive_codes(normalize(text)))
+
+
+class CompiledProfile:
+    """
+    Hồ sơ sức khỏe đã biên dịch
+    Attributes:
+        triggers: {term chuẩn hóa: [(tên tình trạng, kind, warning_type)]}
+        exclusions: {tên tình trạng: [cụm loại trừ (tuple token)]} - chỉ áp dụng cho trigger của
+            chính tình trạng đó (VD: "sữa đậu nành" không phải sữa bò, nhưng vẫn là đậu nành)
+        index: {token đầu: [term (dạng tuple token), ...]} dài trước ngắn sau
+    """
+
+    def __init__(self, triggers: dict, exclusions: dict):
+        self.triggers = triggers
+        self.exclusions = exclusions
+        self.index = defaultdict(list)
+        for term in sorted(triggers, key=lambda t: -len(t.split())):
+            tokens = tuple(term.split())
+            self.index[tokens[0]].append(tokens)
+
+    @staticmethod
+    def _excluded_spans(tokens: list, phrases: list) -> list:
+        """Các khoảng [start, stop) token khớp một cụm loại trừ"""
+        return [(i, i + len(phrase)) for phrase in phrases for i in range(len(tokens) - len(phrase) + 1)
+                if tuple(tokens[i:i + len(phrase)]) == phrase]
+
+    def match(self, ingredient: str) -> list:
+        """
+        Tìm các trigger xuất hiện (nguyên token) trong một nguyên liệu
+        Returns:
+            [(term, tên tình trạng, kind, warning_type)]
+        """
+        tokens = _tokens(ingredient)
+        spans = {}  # tình trạng -> khoảng loại trừ (tính khi cần)
+
+        hits = []
+        seen = set()
+        for i, token in enumerate(tokens):
+            for term_tokens in self.index.get(token, ()):
+                if tuple(tokens[i:i + len(term_tokens)]) != term_tokens:
+                    continue
+                term = " ".join(term_tokens)
+                stop = i + len(term_tokens)
+                for condition, kind, warning_type in self.triggers[term]:
+                    if (condition, warning_type) in seen:
+                        continue
+                    if condition not in spans:
+                        spans[condition] = self._excluded_spans(tokens, self.exclusions.get(condition, ()))
+                    # Trigger nằm trọn trong cụm loại trừ của chính tình trạng này -> bỏ qua
+                    if any(a <= i and stop <= b for a, b in spans[condition]):
+                        continue
+                    seen.add((condition, warning_type))
+                    hits.append((term, condition, kind, warning_type))
+        return hits
+
+
+def profile_hash(health_profile: dict) -> str:
+    """Key của hồ sơ sức khỏe đã chuẩn hóa (không phân biệt hoa/thường, dấu cách, thứ tự, trùng lặp)"""
+    allergies = sorted({normalize(a) for a in health_profile.get("allergy", []) or [] if isinstance(a, str)})
+    medical = sorted({normalize(m) for m in health_profile.get("medical_history", []) or [] if isinstance(m, str)})
+    raw = f"v{TAXONOMY_VERSION}|a:{'|'.join(allergies)}|m:{'|'.join(medical)}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def compile_profile(health_profile: dict) -> CompiledProfile:
+    """Biên dịch hồ sơ sức khỏe thành tập trigger (không cache)"""
+    taxonomy = {normalize(name): entry for name, entry in TAXONOMY.items()}
+    aliases = {normalize(alias): normalize(target) for alias, target in ALIASES.items()}
+
+    triggers = defaultdict(list)
+    exclusions = defaultdict(list)
+
+    def add(term: str, condition: str, kind: str, warning_type: str):
+        term = " ".join(_tokens(term))
+        if not term:
+            return
+        entry = (condition, kind, warning_type)
+        if entry not in triggers[term]:
+            triggers[term].append(entry)
+
+    for kind, field in (("allergy", "allergy"), ("medical", "medical_history")):
+        for condition in health_profile.get(field, []) or []:
+            if not isinstance(condition, str) or not normalize(condition):
+                continue
+            condition = condition.strip()
+            key = normalize(condition)
+            key = aliases.get(key, key)
+            direct_type = "allergy" if kind == "allergy" else "medical_condition"
+
+            if key not in taxonomy:
+                # Không có trong taxonomy: chính tên tình trạng là trigger
+                add(key, condition, kind, direct_type)
+                continue
+
+            direct, cross, excluded = taxonomy[key]
+            add(key, condition, kind, direct_type)
+            for term in direct:
+                add(term, condition, kind, direct_type)
+            if kind == "allergy":
+                for term in cross:
+                    add(term, condition, kind, "cross_reactivity")
+            for term in excluded:
+                phrase = tuple(_tokens(term))
+                if phrase and phrase not in exclusions[condition]:
+                    exclusions[condition].append(phrase)
+
+    return CompiledProfile(dict(triggers), dict(exclusions))
+
+
+_TAXONOMY_KEYS = {normalize(name) for name in TAXONOMY}
+_ALIAS_KEYS = {normalize(alias): normalize(target) for alias, target in ALIASES.items()}
+
+
+def is_known_condition(condition: str) -> bool:
+    """Tình trạng có trong TAXONOMY (trực tiếp hoặc qua ALIASES)"""
+    key = normalize(condition)
+    return _ALIAS_KEYS.get(key, key) in _TAXONOMY_KEYS
+
+
+_compiled_profiles = TieredCache(
+    "compiled_profiles",
+    None,
+    None,
+    maxsize=env_int("PROFILE_CACHE_MAXSIZE", 512),
+    ttl_sec=env_int("PROFILE_CACHE_TTL_SEC", 24 * 3600),
+    use_l2=False
+)
+
+
+def get_compiled_profile(health_profile: dict) -> CompiledProfile:
+    """Lấy hồ sơ đã biên dịch từ cache (key = hash hồ sơ chuẩn hóa), biên dịch nếu chưa có"""
+    key = profile_hash(health_profile)
+    compiled = _compiled_profiles.get(key)
+    if compiled is None:
+        compiled = compile_profile(health_profile)
+        _compiled_profiles.set(key, compiled)
+    return compiled
+
+
+def find_local_warnings(ingredients: list, health_profile: dict) -> list:
+    """
+    So khớp cục bộ nguyên liệu với hồ sơ đã biên dịch
+    Returns:
+        Danh sách cảnh báo (cùng format với analyze_health_risks, thêm "source": "local")
+    """
+    compiled = get_compiled_profile(health_profile)
+    if not compiled.triggers:
+        return []
+
+    warnings = []
+    seen = set()
+    for ingredient in ingredients:
+        ingredient_norm = normalize(ingredient)
+        if ingredient_norm in seen:
+            continue
+        seen.add(ingredient_norm)
+
+        hits = compiled.match(ingredient)
+        if not hits:
+            continue
+
+        scored = sorted(
+            ((LOCAL_RISK_SCORES[(kind, warning_type)], term, condition, warning_type)
+             for term, condition, kind, warning_type in hits),
+            key=lambda item: -item[0]
+        )
+        risk_score, term, condition, warning_type = scored[0]
+        conditions = list(dict.fromkeys(item[2] for item in scored))
+
+        if warning_type == "allergy":
+            summary = f"Chứa \"{term}\" thuộc nhóm dị ứng \"{condition}\" của bạn."
+            recommendation = "Không nên sử dụng sản phẩm này."
+        elif warning_type == "cross_reactivity":
+            summary = f"\"{term}\" có thể gây phản ứng chéo với dị ứng \"{condition}\" của bạn."
+            recommendation = "Thận trọng, theo dõi phản ứng của cơ thể hoặc tránh sử dụng."
+        else:
+            summary = f"\"{term}\" không tốt cho tình trạng \"{condition}\" của bạn."
+            recommendation = "Hạn chế sử dụng."
+
+        warnings.append({
+            "ingredient": ingredient,
+            "risk_score": risk_score,
+            "warning_type": warning_type,
+            "summary": summary,
+            "scientific_explanation": "",
+            "potential_effects": [],
+            "recommendation": recommendation,
+            "conditions": conditions,
+            "source": "local"
+        })
+    return warnings
+
+
+def merge_warnings(local_warnings: list, llm_warnings: list) -> list:
+    """
+    Gộp cảnh báo cục bộ với cảnh báo từ model
+    - Cảnh báo cục bộ đứng trước (đúng thứ tự đã stream cho client)
+    - Nếu model cũng cảnh báo cùng nguyên liệu: dùng nội dung của model, risk_score lấy max
+    - Các cảnh báo còn lại của model giữ nguyên thứ tự
+    """
+    llm_by_ingredient = {}
+    for warning in llm_warnings:
+        llm_by_ingredient.setdefault(normalize(str(warning.get("ingredient", ""))), warning)
+
+    merged = []
+    used = set()
+    for local in local_warnings:
+        key = normalize(local["ingredient"])
+        llm = llm_by_ingredient.get(key)
+        if llm is None:
+            merged.append(local)
+            continue
+        used.add(key)
+        conditions = list(dict.fromkeys(local.get("conditions", []) + llm.get("conditions", [])))
+        merged.append({
+            **llm,
+            "ingredient": local["ingredient"],
+            "risk_score": max(llm.get("risk_score", 0), local["risk_score"]),
+            "conditions": conditions,
+            "source": "local+llm"
+        })
+
+    for warning in llm_warnings:
+        key = normalize(str(warning.get("ingredient", "")))
+        if key not in used:
+            used.add(key)
+            merged.append(warning)
+    return merged
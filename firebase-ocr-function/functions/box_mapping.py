@@ -0,0 +1,97 @@
+"""
+Tính toán bounding box vector hóa (NumPy) cho bước mapping vị trí nguyên liệu
+
+- Box của các từ OCR là 1 mảng int32 liên tục (N, 4): x0, y0, x1, y1 (OcrDocument.rects())
+- Cửa sổ n-gram (list chỉ số từ) -> ma trận (M, W) đệm -1, hợp box bằng min/max vector hóa
+- Chọn top-k ứng viên mỗi phrase bằng argpartition thay vì sort toàn bộ
+- Non-max suppression để giữ mọi lần xuất hiện khác nhau của cùng 1 nguyên liệu
+  (VD: danh sách thành phần tiếng Việt và tiếng Anh trên cùng bao bì)
+"""
+import numpy as np
+
+# Sentinel cho ô đệm khi lấy min/max theo cửa sổ
+_INT_MAX = np.iinfo(np.int32).max
+_INT_MIN = np.iinfo(np.int32).min
+
+
+def window_matrix(windows: list) -> np.ndarray:
+    """Danh sách cửa sổ (list chỉ số từ, độ dài khác nhau) -> ma trận int32 (M, W) đệm -1"""
+    width = max((len(w) for w in windows), default=0)
+    matrix = np.full((len(windows), width), -1, dtype=np.int32)
+    for row, indices in enumerate(windows):
+        matrix[row, :len(indices)] = indices
+    return matrix
+
+
+def union_rects(rects: np.ndarray, windows: list) -> np.ndarray:
+    """
+    Hợp box của các từ trong mỗi cửa sổ
+    Args:
+        rects: (N, 4) từ OcrDocument.rects()
+        windows: M cửa sổ, mỗi cửa sổ là list chỉ số từ
+    Returns:
+        np.ndarray int32 (M, 4)
+    """
+    if not windows:
+        return np.zeros((0, 4), dtype=np.int32)
+    matrix = window_matrix(windows)
+    valid = (matrix >= 0)[..., None]
+    gathered = rects[np.clip(matrix, 0, None)]  # (M, W, 4)
+    mins = np.where(valid, gathered[..., :2], _INT_MAX).min(axis=1)
+    maxs = np.where(valid, gathered[..., 2:], _INT_MIN).max(axis=1)
+    return np.concatenate([mins, maxs], axis=1).astype(np.int32)
+
+
+def top_k(scores: np.ndarray, k: int, threshold: float = None) -> np.ndarray:
+    """
+    Chỉ số k điểm cao nhất (giảm dần), chỉ giữ các điểm >= threshold
+    argpartition O(n) thay vì argsort O(n log n) trên toàn bộ corpus
+    """
+    if scores.size == 0:
+        return np.zeros(0, dtype=np.intp)
+    if k < scores.size:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(scores.size)
+    if threshold is not None:
+        candidates = candidates[scores[candidates] >= threshold]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def non_max_suppression(rects: np.ndarray, scores: np.ndarray, overlap_threshold: float = 0.5,
+                        groups: np.ndarray = None) -> list:
+    """
+    Greedy NMS: giữ box điểm cao nhất, loại các box chồng lấn với nó
+    Độ chồng lấn = diện tích giao / diện tích box nhỏ hơn, để cửa sổ con nằm trong
+    cửa sổ lớn hơn (VD: "đường" trong "đường kính") cũng bị loại
+    Args:
+        groups: (optional) nhóm của từng box (VD: image_index); chỉ loại box cùng nhóm
+    Returns:
+        Chỉ số các box được giữ, theo điểm giảm dần
+    """
+    if len(rects) == 0:
+        return []
+    rects = rects.astype(np.float64)
+    areas = np.maximum(rects[:, 2] - rects[:, 0], 1) * np.maximum(rects[:, 3] - rects[:, 1], 1)
+    order = np.argsort(-scores, kind="stable")
+
+    keep = []
+    while order.size:
+        best = order[0]
+        keep.append(int(best))
+        rest = order[1:]
+        inter_w = np.minimum(rects[best, 2], rects[rest, 2]) - np.maximum(rects[best, 0], rects[rest, 0])
+        inter_h = np.minimum(rects[best, 3], rects[rest, 3]) - np.maximum(rects[best, 1], rects[rest, 1])
+        inter = np.clip(inter_w, 0, None) * np.clip(inter_h, 0, None)
+        overlap = inter / np.minimum(areas[best], areas[rest])
+        suppressed = overlap > overlap_threshold
+        if groups is not None:
+            suppressed &= groups[rest] == groups[best]
+        order = rest[~suppressed]
+    return keep
+
+
+def rect_to_polygon(rect) -> list:
+    """(x0, y0, x1, y1) -> 4 đỉnh theo format bounding_box của response"""
+    x0, y0, x1, y1 = (int(v) for v in rect)
+    return [[x0, y0], [x1, y0], [x1, y1], [x0, y1]]
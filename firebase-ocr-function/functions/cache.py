@@ -0,0 +1,328 @@
+"""
+Cache dùng chung cho pipeline Smart OCR RAG
+
+- Tầng 1 (L1): LRU + TTL trong bộ nhớ process (mất khi instance bị thu hồi)
+- Tầng 2 (L2): Realtime Database (bền vững, dùng chung giữa các instance)
+
+Mỗi cache đăng ký vào registry để endpoint health_check có thể báo cáo hit/miss.
+"""
+import os
+import time
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from firebase_admin import db
+
+# Registry toàn cục: name -> cache (để expose thống kê)
+_registry = {}
+_registry_lock = threading.Lock()
+
+# Pool cho các lượt đọc L2 theo lô (get_many) và ghi L2 chạy nền (set / set_many)
+_l2_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="cache-l2")
+# Lệnh ghi L2 chạy nền của request hiện tại (xem l2_write_scope)
+_pending_writes = contextvars.ContextVar("cache_l2_pending_writes", default=None)
+
+
+def env_int(name: str, default: int) -> int:
+    """Đọc biến môi trường kiểu int, fallback về default nếu không hợp lệ"""
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def env_flag(name: str, default: bool = False) -> bool:
+    """Đọc biến môi trường kiểu bool ("1", "true", "yes" => True)"""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# Số key tối đa trong 1 multi-path update (giữ mỗi lệnh ghi nhỏ, VD embedding ~8KB / vector)
+L2_WRITE_BATCH = max(1, env_int("CACHE_L2_WRITE_BATCH", 100))
+# Thời gian tối đa chờ các lệnh ghi L2 còn dở khi request kết thúc
+L2_FLUSH_TIMEOUT_SEC = env_int("CACHE_L2_FLUSH_TIMEOUT_MS", 2000) / 1000
+
+
+def _submit_write(fn, *args):
+    """Ghi L2 chạy nền; gắn vào l2_write_scope của request hiện tại (nếu có) để được chờ khi kết thúc"""
+    future = _l2_pool.submit(fn, *args)
+    pending = _pending_writes.get()
+    if pending is not None:
+        pending.append(future)
+
+
+@contextmanager
+def l2_write_scope(timeout_sec: float = None):
+    """
+    Gom các lệnh ghi L2 chạy nền trong scope (kể cả từ các thread stage chạy trong copy của context)
+    và chờ chúng xong khi thoát scope, tối đa timeout_sec (mặc định L2_FLUSH_TIMEOUT_SEC).
+    Cloud Functions gen2 bóp CPU ngoài thời gian xử lý request: lệnh ghi còn dở sau khi đã trả
+    response có thể bị treo / mất, khiến cache L2 ngừng được lấp đầy mà không báo lỗi.
+    Dùng được làm decorator cho endpoint: @l2_write_scope()
+    """
+    pending = []
+    token = _pending_writes.set(pending)
+    try:
+        yield
+    finally:
+        _pending_writes.reset(token)
+        if pending:
+            _, not_done = wait(pending, timeout=L2_FLUSH_TIMEOUT_SEC if timeout_sec is None else timeout_sec)
+            if not_done:
+                logging.warning(f"⚠️ Cache L2: {len(not_done)}/{len(pending)} lệnh ghi chưa xong khi kết thúc request")
+
+
+class LRUCache:
+    """
+    LRU cache có TTL, thread-safe
+    Args:
+        maxsize: Số entry tối đa trước khi evict entry ít dùng nhất
+        ttl_sec: Thời gian sống của entry (<= 0 = không hết hạn)
+    """
+
+    def __init__(self, maxsize: int = 256, ttl_sec: int = 3600):
+        self.maxsize = maxsize
+        self.ttl_sec = ttl_sec
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl_sec if self.ttl_sec > 0 else 0
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RealtimeDbTier:
+    """
+    Tầng cache bền vững trên Realtime Database
+    Lưu tại: cache/{namespace}/{key} = {"v": payload (str), "exp": epoch_ms}
+    Mọi lỗi I/O đều được log và coi như cache miss, không làm hỏng request.
+    """
+
+    def __init__(self, namespace: str, ttl_sec: int = 7 * 24 * 3600):
+        self.namespace = namespace
+        self.ttl_sec = ttl_sec
+
+    def _ref(self, key: str):
+        return db.reference(f'cache/{self.namespace}/{key}')
+
+    def get(self, key: str):
+        try:
+            node = self._ref(key).get()
+        except Exception as e:
+            logging.warning(f"⚠️ Cache L2 ({self.namespace}) read error: {e}")
+            return None
+        if not node or 'v' not in node:
+            return None
+        if self.ttl_sec > 0 and node.get('exp', 0) < time.time() * 1000:
+            # RTDB không tự xóa theo exp: xóa khi đọc thấy để cache không tăng mãi
+            # (nếu instance khác vừa ghi lại node này thì chỉ mất 1 lượt hit)
+            self.delete(key)
+            return None
+        return node['v']
+
+    def get_many(self, keys: list) -> dict:
+        """
+        Đọc nhiều key trong 1 lượt: Admin SDK không có multi-path read nên các GET được gửi
+        song song trên _l2_pool (thời gian ~ 1 round trip thay vì len(keys) round trip)
+        Returns:
+            Dict key -> payload cho các key có trong L2
+        """
+        return {key: payload for key, payload in zip(keys, _l2_pool.map(self.get, keys))
+                if payload is not None}
+
+    def _expires_at(self) -> int:
+        return int((time.time() + self.ttl_sec) * 1000) if self.ttl_sec > 0 else 0
+
+    def set(self, key: str, payload: str):
+        try:
+            self._ref(key).set({"v": payload, "exp": self._expires_at()})
+        except Exception as e:
+            logging.warning(f"⚠️ Cache L2 ({self.namespace}) write error: {e}")
+
+    def delete(self, key: str):
+        try:
+            self._ref(key).delete()
+        except Exception as e:
+            logging.warning(f"⚠️ Cache L2 ({self.namespace}) delete error: {e}")
+
+    def set_many(self, payloads: dict):
+        """Ghi nhiều key bằng multi-path update trên cache/{namespace}, tối đa L2_WRITE_BATCH key / request"""
+        expires_at = self._expires_at()
+        items = list(payloads.items())
+        for start in range(0, len(items), L2_WRITE_BATCH):
+            try:
+                db.reference(f'cache/{self.namespace}').update(
+                    {key: {"v": payload, "exp": expires_at} for key, payload in items[start:start + L2_WRITE_BATCH]}
+                )
+            except Exception as e:
+                logging.warning(f"⚠️ Cache L2 ({self.namespace}) write error: {e}")
+
+
+class TieredCache:
+    """
+    Cache 2 tầng: L1 (LRUCache, lưu object đã parse) + L2 (RealtimeDbTier, lưu payload đã serialize)
+
+    Args:
+        name: Tên cache (dùng làm namespace L2 và key thống kê)
+        serialize / deserialize: Chuyển object <-> str cho L2
+        maxsize, ttl_sec: Cấu hình L1
+        l2_ttl_sec: TTL của L2
+        use_l2: Bật/tắt tầng Realtime Database
+    """
+
+    def __init__(self, name: str, serialize, deserialize,
+                 maxsize: int = 256, ttl_sec: int = 3600,
+                 l2_ttl_sec: int = 7 * 24 * 3600, use_l2: bool = True):
+        self.name = name
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self.l1 = LRUCache(maxsize=maxsize, ttl_sec=ttl_sec)
+        self.l2 = RealtimeDbTier(name, ttl_sec=l2_ttl_sec) if use_l2 else None
+        self._stats_lock = threading.Lock()
+        self.stats = {"l1_hits": 0, "l2_hits": 0, "misses": 0, "sets": 0}
+        register_cache(self)
+
+    def _count(self, field: str, n: int = 1):
+        with self._stats_lock:
+            self.stats[field] += n
+
+    def _decode(self, key: str, payload):
+        """Payload L2 -> object, None nếu không có / hỏng"""
+        if payload is None:
+            return None
+        try:
+            return self.deserialize(payload)
+        except Exception as e:
+            logging.warning(f"⚠️ Cache {self.name}: payload hỏng cho key {key}: {e}")
+            return None
+
+    def get(self, key: str):
+        value = self.l1.get(key)
+        if value is not None:
+            self._count("l1_hits")
+            return value
+
+        if self.l2 is not None:
+            value = self._decode(key, self.l2.get(key))
+            if value is not None:
+                self.l1.set(key, value)
+                self._count("l2_hits")
+                return value
+
+        self._count("misses")
+        return None
+
+    def set(self, key: str, value):
+        """
+        Lưu 1 entry; serialize + ghi L2 chạy nền (best-effort) để không cộng thêm độ trễ vào stage,
+        được chờ khi request kết thúc (l2_write_scope)
+        """
+        self.l1.set(key, value)
+        if self.l2 is not None:
+            _submit_write(self._write, key, value)
+        self._count("sets")
+
+    def _write(self, key: str, value):
+        self.l2.set(key, self.serialize(value))
+
+    def get_many(self, keys: list) -> dict:
+        """
+        Tra cứu nhiều key cùng lúc: L1, rồi 1 lượt đọc L2 (RealtimeDbTier.get_many) cho các key còn thiếu
+        Returns:
+            Dict key -> value cho các key có trong cache
+        """
+        found = {}
+        l1_missing = []
+        for key in keys:
+            value = self.l1.get(key)
+            if value is not None:
+                found[key] = value
+            else:
+                l1_missing.append(key)
+
+        l2_hits = 0
+        if l1_missing and self.l2 is not None:
+            for key, payload in self.l2.get_many(l1_missing).items():
+                value = self._decode(key, payload)
+                if value is not None:
+                    self.l1.set(key, value)
+                    found[key] = value
+                    l2_hits += 1
+
+        self._count("l1_hits", len(keys) - len(l1_missing))
+        self._count("l2_hits", l2_hits)
+        self._count("misses", len(l1_missing) - l2_hits)
+        return found
+
+    def set_many(self, items: dict):
+        """Lưu nhiều entry; ghi L2 chạy nền (best-effort) bằng multi-path update"""
+        for key, value in items.items():
+            self.l1.set(key, value)
+        if self.l2 is not None and items:
+            _submit_write(self._write_many, dict(items))
+        self._count("sets", len(items))
+
+    def _write_many(self, items: dict):
+        self.l2.set_many({key: self.serialize(value) for key, value in items.items()})
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        lookups = stats["l1_hits"] + stats["l2_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["l1_hits"] + stats["l2_hits"]) / lookups, 3) if lookups else 0
+        stats["l1_size"] = len(self.l1)
+        stats["l1_evictions"] = self.l1.evictions
+        return stats
+
+
+def register_cache(cache):
+    """Đăng ký cache (hoặc bất kỳ object nào có get_stats()) vào registry"""
+    with _registry_lock:
+        _registry[cache.name] = cache
+
+
+def get_cache_stats() -> dict:
+    """Thống kê hit/miss của tất cả cache đã đăng ký"""
+    with _registry_lock:
+        caches = list(_registry.values())
+    return {cache.name: cache.get_stats() for cache in caches}
+
+
+def clear_l1_caches():
+    """Xóa tầng L1 của mọi cache đã đăng ký (VD: benchmark đo đường đi cache miss)"""
+    with _registry_lock:
+        caches = list(_registry.values())
+    for cache in caches:
+        if hasattr(cache, "l1"):
+            cache.l1.clear()
@@ -0,0 +1,80 @@
+"""
+Kho embedding bền vững cho find_coordinates_semantic
+
+Key: (model, text đã chuẩn hóa) -> vector float32
+- L1: LRU trong process (instance warm giữ lại các n-gram phổ biến: "đường", "muối", "bột mì"...)
+- L2: Realtime Database tại cache/embeddings/{model}/{sha1(text)} (n-gram chung được dùng lại giữa
+  các nhãn và các instance); cả lô text của 1 lần tra cứu được đọc trong 1 lượt (song song) và
+  ghi bằng multi-path update (chạy nền, chia nhỏ theo CACHE_L2_WRITE_BATCH)
+
+Chỉ những text chưa có trong cache mới được gửi lên client.embeddings.create.
+"""
+import base64
+import hashlib
+import unicodedata
+
+import numpy as np
+
+from cache import TieredCache, env_int, env_flag
+
+
+def normalize_text(text: str) -> str:
+    """Chuẩn hóa text trước khi embed: NFC, gộp khoảng trắng, chữ thường"""
+    return " ".join(unicodedata.normalize('NFC', text).split()).casefold()
+
+
+def encode_vector(vector: np.ndarray) -> str:
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode('ascii')
+
+
+def decode_vector(payload: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(payload), dtype=np.float32)
+
+
+class EmbeddingStore:
+    """
+    Cache embedding 2 tầng, tra cứu theo lô theo (model, text)
+    Args:
+        name: Tên cache (namespace L2 và key thống kê)
+        maxsize: Số vector tối đa trong L1 (~6KB/vector với text-embedding-3-small)
+        ttl_sec: TTL của L1 (<= 0 = không hết hạn)
+        use_l2: Bật/tắt tầng Realtime Database
+    """
+
+    def __init__(self, name: str = "embeddings", maxsize: int = 10000,
+                 ttl_sec: int = 0, use_l2: bool = True):
+        self.cache = TieredCache(
+            name,
+            encode_vector,
+            decode_vector,
+            maxsize=maxsize,
+            ttl_sec=ttl_sec,
+            l2_ttl_sec=env_int("EMBEDDING_CACHE_L2_TTL_SEC", 90 * 24 * 3600),
+            use_l2=use_l2
+        )
+
+    @staticmethod
+    def _key(model: str, text: str) -> str:
+        # {model}/{sha1}: node con theo model trên L2 (tên model hợp lệ làm key RTDB)
+        return f"{model}/{hashlib.sha1(text.encode('utf-8')).hexdigest()}"
+
+    def get_many(self, model: str, texts: list[str]) -> dict:
+        """
+        Tra cứu nhiều text (đã chuẩn hóa) cùng lúc: L1, rồi 1 lượt đọc L2 cho các text còn thiếu
+        Returns:
+            Dict text -> vector float32 cho các text có trong cache
+        """
+        keys = {self._key(model, text): text for text in texts}
+        return {keys[key]: vector for key, vector in self.cache.get_many(list(keys)).items()}
+
+    def set_many(self, model: str, vectors: dict):
+        """Lưu nhiều vector; ghi L2 chạy nền (best-effort) bằng multi-path update"""
+        self.cache.set_many({self._key(model, text): vector for text, vector in vectors.items()})
+
+
+embedding_store = EmbeddingStore(
+    "embeddings",
+    maxsize=env_int("EMBEDDING_CACHE_MAXSIZE", 10000),
+    ttl_sec=env_int("EMBEDDING_CACHE_TTL_SEC", 0),
+    use_l2=env_flag("EMBEDDING_CACHE_L2", True)
+)
@@ -0,0 +1,138 @@
+"""
+Bảng ghi nhớ (memo) kết luận sức khỏe theo cặp (nguyên liệu, tình trạng)
+
+Kết luận như ("bột mì", dị ứng "gluten") hay ("muối", bệnh "cao huyết áp") giống nhau
+với mọi người dùng, nên được cache theo:
+    key = (phiên bản prompt, model, loại tình trạng, tình trạng chuẩn hóa, nguyên liệu chuẩn hóa)
+Chỉ những cặp chưa biết mới được gửi cho model; response (warnings / safe_ingredients)
+được lắp ráp lại từ verdict trong cache + verdict mới.
+"""
+import json
+import hashlib
+
+from cache import TieredCache, env_int, env_flag
+from lexical_matcher import normalize
+
+# Đổi khi prompt verdict thay đổi để không dùng lại kết luận cũ
+VERDICT_VERSION = 2
+
+# Loại tình trạng -> nhãn hiển thị trong prompt
+CONDITION_KINDS = {
+    "allergy": "Dị ứng",
+    "medical": "Bệnh lý",
+}
+
+SAFE_VERDICT = {"risk_score": 0}
+
+
+verdict_cache = TieredCache(
+    "health_verdicts",
+    lambda verdict: json.dumps(verdict, ensure_ascii=False, separators=(',', ':')),
+    json.loads,
+    maxsize=env_int("VERDICT_CACHE_MAXSIZE", 20000),
+    ttl_sec=env_int("VERDICT_CACHE_TTL_SEC", 7 * 24 * 3600),
+    l2_ttl_sec=env_int("VERDICT_CACHE_L2_TTL_SEC", 90 * 24 * 3600),
+    use_l2=env_flag("VERDICT_CACHE_L2", True)
+)
+
+
+def profile_conditions(health_profile: dict) -> list:
+    """
+    Danh sách tình trạng (kind, tên gốc, tên chuẩn hóa) từ hồ sơ sức khỏe, bỏ trùng
+    """
+    conditions = []
+    seen = set()
+    for kind, field in (("allergy", "allergy"), ("medical", "medical_history")):
+        for name in health_profile.get(field, []) or []:
+            if not isinstance(name, str) or not name.strip():
+                continue
+            key = (kind, normalize(name))
+            if key in seen:
+                continue
+            seen.add(key)
+            conditions.append((kind, name.strip(), key[1]))
+    return conditions
+
+
+def verdict_key(model: str, kind: str, condition: str, ingredient: str) -> str:
+    """Key Realtime Database (sha1) cho một cặp đã chuẩn hóa"""
+    raw = f"v{VERDICT_VERSION}|{model}|{kind}:{condition}|{ingredient}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def compact_verdict(item: dict) -> dict | None:
+    """
+    Chỉ giữ các field cần cache từ một verdict của model
+    Returns:
+        None nếu verdict không có risk_score hợp lệ (không được coi là "an toàn")
+    """
+    risk_score = item.get("risk_score")
+    if isinstance(risk_score, bool) or not isinstance(risk_score, (int, float)):
+        return None
+    if risk_score <= 0:
+        return dict(SAFE_VERDICT)
+    return {
+        "risk_score": round(min(risk_score, 1.0), 2),
+        "warning_type": item.get("warning_type", "medical_condition"),
+        "summary": item.get("summary", ""),
+        "scientific_explanation": item.get("scientific_explanation", ""),
+        "potential_effects": item.get("potential_effects", []) or [],
+        "recommendation": item.get("recommendation", ""),
+    }
+
+
+def assemble_warning(ingredient: str, verdicts: list) -> dict | None:
+    """
+    Gộp các verdict có rủi ro của một nguyên liệu thành 1 cảnh báo
+    Args:
+        ingredient: Tên nguyên liệu gốc (giữ nguyên chính tả)
+        verdicts: [(tên tình trạng, verdict dict)]
+    Returns:
+        Cảnh báo theo format của analyze_health_risks, hoặc None nếu an toàn
+    """
+    risky = [(name, v) for name, v in verdicts if v.get("risk_score", 0) > 0]
+    if not risky:
+        return None
+    risky.sort(key=lambda item: -item[1]["risk_score"])
+    top = risky[0][1]
+
+    potential_effects = []
+    for _, verdict in risky:
+        for effect in verdict.get("potential_effects", []):
+            if effect not in potential_effects:
+                potential_effects.append(effect)
+
+    def join(field: str, separator: str) -> str:
+        parts = [v.get(field, "") for _, v in risky]
+        return separator.join(dict.fromkeys(p for p in parts if p))
+
+    return {
+        "ingredient": ingredient,
+        "risk_score": top["risk_score"],
+        "warning_type": top.get("warning_type", "medical_condition"),
+        "summary": join("summary", "; "),
+        "scientific_explanation": join("scientific_explanation", "\n\n"),
+        "potential_effects": potential_effects,
+        "recommendation": top.get("recommendation", ""),
+        "conditions": [name for name, _ in risky],
+    }
+
+
+def local_overall_recommendation(warnings: list, ingredient_count: int) -> str:
+    """Đánh giá tổng thể tạo cục bộ từ các cảnh báo (không cần gọi model)"""
+    if not warnings:
+        return (f"AN TOÀN: Không phát hiện thành phần nào trong {ingredient_count} thành phần "
+                f"gây hại cho hồ sơ sức khỏe của bạn. Vẫn nên sử dụng ở mức độ hợp lý.")
+
+    ordered = sorted(warnings, key=lambda w: -w.get("risk_score", 0))
+    max_risk = ordered[0].get("risk_score", 0)
+    names = ", ".join(w["ingredient"] for w in ordered[:5])
+
+    if max_risk >= 0.6:
+        return (f"KHÔNG AN TOÀN: Sản phẩm chứa thành phần có nguy cơ cao với hồ sơ sức khỏe của bạn "
+                f"({names}). Khuyến nghị không sử dụng sản phẩm này.")
+    if max_risk >= 0.4:
+        return (f"CẦN HẠN CHẾ: Sản phẩm chứa thành phần ảnh hưởng đến tình trạng sức khỏe của bạn "
+                f"({names}). Chỉ nên dùng với lượng nhỏ và không thường xuyên.")
+    return (f"TƯƠNG ĐỐI AN TOÀN: Một số thành phần cần lưu ý ({names}) nhưng mức độ rủi ro thấp. "
+            f"Theo dõi phản ứng của cơ thể khi sử dụng.")
@@ -0,0 +1,135 @@
+"""
+Lưu trữ lịch sử scan trên Realtime Database: tách node tóm tắt và node chi tiết
+
+    scan_history/{device_id}/{history_id}          -> tóm tắt (danh sách lịch sử)
+    scan_history_details/{device_id}/{history_id}  -> chi tiết (health_warnings, mappings, user_profile...)
+    scan_history_versions/{device_id}              -> history_id của lần ghi gần nhất (ETag của get_history)
+
+Query danh sách chỉ đọc các node tóm tắt nhỏ nên chi phí tỉ lệ với số bản ghi chứ không
+phải kích thước payload; màn hình chi tiết tải node chi tiết khi cần. Hai node được ghi bằng
+1 lệnh update nhiều path (atomic), cùng node phiên bản của thiết bị: get_history đọc node
+này (vài byte) để trả 304 mà không phải đọc danh sách. Bản ghi cũ (toàn bộ dữ liệu trong
+scan_history) vẫn đọc được.
+"""
+import time
+import random
+import threading
+
+SUMMARY_ROOT = "scan_history"
+DETAIL_ROOT = "scan_history_details"
+VERSION_ROOT = "scan_history_versions"
+
+# Các trường nằm trong node tóm tắt; còn lại thuộc node chi tiết
+SUMMARY_FIELDS = ("created_at", "image_url", "thumbnail_url", "ingredients_count",
+                  "risk_summary", "total_ocr_words", "matched_count")
+
+# -----------------------------------------------------
+# Push ID (cùng thuật toán với Firebase SDK, sinh tại chỗ không cần round-trip)
+# -----------------------------------------------------
+_PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+_push_lock = threading.Lock()
+_last_push_ms = 0
+_last_random = [0] * 12
+
+
+def generate_push_id(timestamp_ms: int = None) -> str:
+    """ID 20 ký tự, sắp xếp theo thời gian tạo (8 ký tự timestamp + 12 ký tự ngẫu nhiên)"""
+    global _last_push_ms
+    now = int(time.time() * 1000) if timestamp_ms is None else timestamp_ms
+    with _push_lock:
+        if now == _last_push_ms:
+            # Cùng millisecond: tăng phần ngẫu nhiên để giữ thứ tự
+            for i in range(11, -1, -1):
+                if _last_random[i] < 63:
+                    _last_random[i] += 1
+                    break
+                _last_random[i] = 0
+        else:
+            _last_push_ms = now
+            for i in range(12):
+                _last_random[i] = random.randrange(64)
+        random_part = "".join(_PUSH_CHARS[n] for n in _last_random)
+
+    time_part = []
+    for _ in range(8):
+        time_part.append(_PUSH_CHARS[now % 64])
+        now //= 64
+    return "".join(reversed(time_part)) + random_part
+
+
+# -----------------------------------------------------
+# Ghi
+# -----------------------------------------------------
+def history_record(scan_result: dict, created_at: int, image_url: str | None,
+                   thumbnail_url: str | None = None) -> dict:
+    """Bản ghi lịch sử đầy đủ từ kết quả scan (cùng các trường như trước khi tách node)"""
+    ingredients = scan_result.get("ingredients", [])
+    return {
+        "created_at": created_at,
+        "image_url": image_url,
+        "thumbnail_url": thumbnail_url,
+
+        # Ingredients data
+        "ingredients": ingredients,
+        "ingredients_count": len(ingredients),
+        "safe_ingredients": scan_result.get("safe_ingredients", []),
+
+        # Health warnings (full object)
+        "health_warnings": scan_result.get("health_warnings", []),
+
+        # Risk summary (full object)
+        "risk_summary": scan_result.get("risk_summary", {}),
+
+        # Mappings (bounding boxes)
+        "mappings": scan_result.get("mappings", []),
+
+        # OCR metadata
+        "total_ocr_words": scan_result.get("total_ocr_words", 0),
+        "matched_count": scan_result.get("matched_count", 0),
+        "threshold_used": scan_result.get("threshold_used", 0.6),
+
+        # User profile
+        "user_profile": scan_result.get("user_profile", {})
+    }
+
+
+def split_updates(device_id: str, history_id: str, record: dict) -> dict:
+    """Payload cho db.reference().update(): {path tóm tắt: ..., path chi tiết: ..., path phiên bản: ...}"""
+    summary = {field: record[field] for field in SUMMARY_FIELDS if field in record}
+    detail = {field: value for field, value in record.items() if field not in SUMMARY_FIELDS}
+    return {
+        f"{SUMMARY_ROOT}/{device_id}/{history_id}": summary,
+        f"{DETAIL_ROOT}/{device_id}/{history_id}": detail,
+        f"{VERSION_ROOT}/{device_id}": history_id,
+    }
+
+
+# -----------------------------------------------------
+# Đọc
+# -----------------------------------------------------
+def summary_of(history_id: str, history_data: dict) -> dict:
+    """Bản tóm tắt cho danh sách (bản ghi mới hoặc bản ghi cũ chưa tách node)"""
+    summary = {"id": history_id}
+    for field in SUMMARY_FIELDS:
+        summary[field] = history_data.get(field)
+    if summary["ingredients_count"] is None:
+        summary["ingredients_count"] = len(history_data.get("ingredients") or [])
+    return summary
+
+
+def merge_detail(history_id: str, history_data: dict, detail: dict | None) -> dict:
+    """Bản ghi đầy đủ = tóm tắt + chi tiết (bản ghi cũ: detail None, dữ liệu đã đầy đủ)"""
+    return {"id": history_id, **history_data, **(detail or {})}
+
+
+def encode_cursor(created_at: int, history_id: str) -> str:
+    """Cursor của trang tiếp theo: '<created_at>_<history_id>' của bản ghi cũ nhất đã trả về"""
+    return f"{created_at}_{history_id}"
+
+
+def decode_cursor(cursor: str) -> tuple[int, str]:
+    """Raises ValueError nếu cursor không hợp lệ"""
+    created_at, sep, history_id = cursor.partition("_")
+    if not sep or not history_id:
+        raise ValueError("Invalid cursor")
+    return int(created_at), history_id
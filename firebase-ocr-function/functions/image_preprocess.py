@@ -0,0 +1,204 @@
+"""
+Tiền xử lý ảnh (Pillow) trước khi gửi Google Vision OCR
+
+Ảnh chụp từ điện thoại thường 3000-4000px, vài MB, trong khi OCR nhãn thành phần chỉ cần
+~2000px cạnh dài. Các bước:
+1. Xoay theo EXIF orientation
+2. Thu nhỏ về cạnh dài tối đa (PREPROCESS_MAX_EDGE)
+3. (tùy chọn) Cắt về vùng có chữ (PREPROCESS_AUTOCROP=1)
+4. Chuyển ảnh xám + nén lại JPEG/WebP với chất lượng cấu hình được
+
+Tọa độ bounding box do Vision trả về (theo ảnh đã xử lý) được quy đổi lại về
+hệ tọa độ ảnh gốc (đã xoay đúng chiều) bằng restore_boxes().
+"""
+import os
+import time
+import random
+import logging
+import threading
+from io import BytesIO
+
+from cache import register_cache, env_int, env_flag
+
+
+class PreprocessStats:
+    """Thống kê tích lũy: số byte tiết kiệm, thời gian xử lý, ảnh hưởng tới số từ OCR"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self.stats = {
+            "images": 0, "skipped": 0, "bytes_in": 0, "bytes_out": 0, "total_ms": 0.0,
+            "compared": 0, "words_original": 0, "words_processed": 0
+        }
+        register_cache(self)
+
+    def record(self, **fields):
+        with self._lock:
+            for field, value in fields.items():
+                self.stats[field] += value
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+        stats["bytes_saved"] = stats["bytes_in"] - stats["bytes_out"]
+        stats["avg_ms"] = round(stats["total_ms"] / stats["images"], 1) if stats["images"] else 0
+        stats["total_ms"] = round(stats["total_ms"], 1)
+        if stats["words_original"]:
+            stats["word_ratio"] = round(stats["words_processed"] / stats["words_original"], 3)
+        return stats
+
+
+preprocess_stats = PreprocessStats("image_preprocess")
+
+
+def _text_bbox(gray, padding_ratio: float = 0.03):
+    """
+    Ước lượng vùng chứa chữ: lọc cạnh -> ngưỡng -> bbox của các pixel cạnh
+    Returns:
+        (left, top, right, bottom) hoặc None nếu không tìm được vùng hợp lý
+    """
+    from PIL import ImageFilter
+
+    small = gray.copy()
+    small.thumbnail((512, 512))
+    edges = small.filter(ImageFilter.FIND_EDGES).point(lambda p: 255 if p > 60 else 0)
+    # Bộ lọc cạnh luôn sinh viền giả ở mép ảnh -> bỏ 2px mép
+    border = 2
+    inner = edges.crop((border, border, edges.width - border, edges.height - border)).getbbox()
+    if inner is None:
+        return None
+    bbox = (inner[0] + border, inner[1] + border, inner[2] + border, inner[3] + border)
+
+    scale_x = gray.width / small.width
+    scale_y = gray.height / small.height
+    pad_x = int(gray.width * padding_ratio)
+    pad_y = int(gray.height * padding_ratio)
+    left = max(int(bbox[0] * scale_x) - pad_x, 0)
+    top = max(int(bbox[1] * scale_y) - pad_y, 0)
+    right = min(int(bbox[2] * scale_x) + pad_x, gray.width)
+    bottom = min(int(bbox[3] * scale_y) + pad_y, gray.height)
+
+    # Vùng quá nhỏ thường là nhiễu -> không cắt
+    if (right - left) * (bottom - top) < 0.05 * gray.width * gray.height:
+        return None
+    return left, top, right, bottom
+
+
+def preprocess_image(image_content: bytes, max_long_edge: int = None, image_format: str = None,
+                     quality: int = None, grayscale: bool = None, autocrop: bool = None) -> tuple[bytes, dict]:
+    """
+    Chuẩn hóa ảnh cho OCR
+    Args:
+        image_content: bytes ảnh gốc
+        max_long_edge / image_format / quality / grayscale / autocrop:
+            mặc định đọc từ PREPROCESS_MAX_EDGE (2000), PREPROCESS_FORMAT (JPEG),
+            PREPROCESS_QUALITY (85), PREPROCESS_GRAYSCALE (1), PREPROCESS_AUTOCROP (0)
+    Returns:
+        (bytes đã xử lý, transform) với transform = {
+            "scale": hệ số nhân tọa độ để quay về ảnh gốc,
+            "offset": (x, y) phần bị cắt,
+            "original_bytes", "processed_bytes", "original_size", "processed_size", "duration_ms"
+        }
+        Nếu không decode được / ảnh đã đủ nhỏ và nhẹ hơn: trả về ảnh gốc với scale = 1
+    """
+    from PIL import Image, ImageOps
+
+    max_long_edge = max_long_edge or env_int("PREPROCESS_MAX_EDGE", 2000)
+    image_format = (image_format or os.environ.get("PREPROCESS_FORMAT", "JPEG")).upper()
+    quality = quality or env_int("PREPROCESS_QUALITY", 85)
+    grayscale = env_flag("PREPROCESS_GRAYSCALE", True) if grayscale is None else grayscale
+    autocrop = env_flag("PREPROCESS_AUTOCROP", False) if autocrop is None else autocrop
+
+    started = time.perf_counter()
+    identity = {"scale": 1.0, "offset": (0, 0), "original_bytes": len(image_content),
+                "processed_bytes": len(image_content)}
+
+    try:
+        img = Image.open(BytesIO(image_content))
+        original_size = img.size
+        # JPEG: để libjpeg decode thẳng ở độ phân giải thấp hơn (nhanh + ít RAM)
+        img.draft('L' if grayscale else 'RGB', (max_long_edge, max_long_edge))
+        draft_scale = original_size[0] / img.size[0]
+        img = ImageOps.exif_transpose(img)
+    except Exception as e:
+        logging.warning(f"⚠️ Không decode được ảnh, bỏ qua tiền xử lý: {e}")
+        preprocess_stats.record(skipped=1)
+        return image_content, identity
+
+    img = img.convert('L' if grayscale else 'RGB')
+    # Kích thước ảnh gốc sau khi xoay theo EXIF
+    upright_size = (round(img.width * draft_scale), round(img.height * draft_scale))
+
+    offset = (0, 0)
+    region_width = upright_size[0]
+    if autocrop:
+        bbox = _text_bbox(img if grayscale else img.convert('L'))
+        if bbox is not None:
+            img = img.crop(bbox)
+            offset = (bbox[0] * draft_scale, bbox[1] * draft_scale)
+            region_width = (bbox[2] - bbox[0]) * draft_scale
+
+    if max(img.size) > max_long_edge:
+        ratio = max_long_edge / max(img.size)
+        img = img.resize((max(1, round(img.width * ratio)), max(1, round(img.height * ratio))),
+                         Image.Resampling.LANCZOS)
+
+    # Hệ số nhân tọa độ: ảnh đã xử lý -> ảnh gốc
+    scale = region_width / img.width
+
+    output = BytesIO()
+    save_kwargs = {"quality": quality}
+    if image_format == "JPEG":
+        save_kwargs["optimize"] = True
+    img.save(output, format=image_format, **save_kwargs)
+    processed = output.getvalue()
+
+    duration_ms = (time.perf_counter() - started) * 1000
+    unchanged_geometry = scale == 1.0 and offset == (0, 0) and upright_size == original_size
+    if len(processed) >= len(image_content) and unchanged_geometry:
+        # Không giảm được dung lượng và không cần xoay/thu nhỏ -> giữ ảnh gốc
+        preprocess_stats.record(images=1, skipped=1, bytes_in=len(image_content),
+                                bytes_out=len(image_content), total_ms=duration_ms)
+        return image_content, {**identity, "duration_ms": round(duration_ms, 1)}
+
+    transform = {
+        "scale": scale,
+        "offset": offset,
+        "original_bytes": len(image_content),
+        "processed_bytes": len(processed),
+        "original_size": upright_size,
+        "processed_size": img.size,
+        "duration_ms": round(duration_ms, 1)
+    }
+    preprocess_stats.record(images=1, bytes_in=len(image_content), bytes_out=len(processed),
+                            total_ms=duration_ms)
+    logging.info(f"🖼️ Preprocess: {len(image_content) // 1024}KB -> {len(processed) // 1024}KB, "
+                 f"{upright_size} -> {img.size} ({duration_ms:.0f}ms)")
+    return processed, transform
+
+
+def restore_boxes(boxes, transform: dict):
+    """
+    Quy đổi bounding box từ ảnh đã xử lý về hệ tọa độ ảnh gốc (đã xoay đúng chiều)
+    Args:
+        boxes: np.ndarray (N, 4, 2)
+    Returns:
+        Mảng mới (hoặc chính boxes nếu transform là identity)
+    """
+    import numpy as np
+
+    scale = transform.get("scale", 1.0)
+    offset_x, offset_y = transform.get("offset", (0, 0))
+    if scale == 1.0 and offset_x == 0 and offset_y == 0:
+        return boxes
+    return np.rint(boxes * scale + (offset_x, offset_y)).astype(np.int32)
+
+
+def should_compare() -> bool:
+    """Lấy mẫu request để OCR cả ảnh gốc và so sánh số từ (PREPROCESS_COMPARE_RATE, 0..1)"""
+    try:
+        rate = float(os.environ.get("PREPROCESS_COMPARE_RATE", 0))
+    except ValueError:
+        return False
+    return rate > 0 and random.random() < rate
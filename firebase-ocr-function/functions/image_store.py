@@ -0,0 +1,109 @@
+"""
+Lưu ảnh scan lên Firebase Storage theo nội dung (content-addressed)
+
+    scan_images/{device_id}/{sha256}.{ext}        ảnh gốc, content type thật (JPEG/PNG/WebP/HEIC...)
+    scan_images/{device_id}/{sha256}_thumb.jpg    thumbnail cho danh sách lịch sử
+
+Cùng 1 ảnh lưu 2 lần -> cùng path -> bỏ qua upload (chỉ 1 request kiểm tra tồn tại).
+Path không đổi theo nội dung nên blob được đánh dấu immutable cho CDN / cache của app.
+"""
+import logging
+from io import BytesIO
+
+from cache import env_int
+from ocr_cache import content_hash
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# (magic bytes, offset, content type, phần mở rộng)
+_SIGNATURES = [
+    (b"\xff\xd8\xff", 0, "image/jpeg", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", 0, "image/png", "png"),
+    (b"GIF87a", 0, "image/gif", "gif"),
+    (b"GIF89a", 0, "image/gif", "gif"),
+    (b"BM", 0, "image/bmp", "bmp"),
+    (b"II*\x00", 0, "image/tiff", "tiff"),
+    (b"MM\x00*", 0, "image/tiff", "tiff"),
+]
+_HEIF_BRANDS = {b"heic": ("image/heic", "heic"), b"heix": ("image/heic", "heic"),
+                b"mif1": ("image/heif", "heif"), b"msf1": ("image/heif", "heif"),
+                b"avif": ("image/avif", "avif")}
+
+
+def detect_content_type(image_content: bytes) -> tuple[str, str]:
+    """
+    Nhận diện định dạng ảnh từ magic bytes (không decode ảnh)
+    Returns:
+        (content type, phần mở rộng), mặc định ("application/octet-stream", "bin")
+    """
+    head = bytes(image_content[:16])
+    for magic, offset, content_type, ext in _SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            return content_type, ext
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp", "webp"
+    if head[4:8] == b"ftyp" and head[8:12] in _HEIF_BRANDS:
+        return _HEIF_BRANDS[head[8:12]]
+    return "application/octet-stream", "bin"
+
+
+def make_thumbnail(image_content: bytes, max_edge: int = None, quality: int = None) -> bytes | None:
+    """
+    Thumbnail JPEG (cạnh dài tối đa THUMBNAIL_MAX_EDGE, mặc định 320px), xoay theo EXIF
+    Returns:
+        bytes JPEG hoặc None nếu không decode được ảnh
+    """
+    from PIL import Image, ImageOps
+
+    max_edge = max_edge or env_int("THUMBNAIL_MAX_EDGE", 320)
+    quality = quality or env_int("THUMBNAIL_QUALITY", 70)
+    try:
+        img = Image.open(BytesIO(image_content))
+        # JPEG: decode thẳng ở độ phân giải thấp
+        img.draft('RGB', (max_edge, max_edge))
+        img = ImageOps.exif_transpose(img).convert('RGB')
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        output = BytesIO()
+        img.save(output, format="JPEG", quality=quality, optimize=True)
+        return output.getvalue()
+    except Exception as e:
+        logging.warning(f"⚠️ Không tạo được thumbnail: {e}")
+        return None
+
+
+def _upload(bucket, path: str, data: bytes, content_type: str):
+    blob = bucket.blob(path)
+    blob.cache_control = IMMUTABLE_CACHE_CONTROL
+    # publicRead ngay khi upload, không cần thêm request make_public
+    blob.upload_from_string(data, content_type=content_type, predefined_acl="publicRead")
+    return blob
+
+
+def store_scan_image(bucket, device_id: str, image_content: bytes) -> dict:
+    """
+    Upload ảnh gốc + thumbnail (bỏ qua nếu ảnh đã có)
+    Returns:
+        {"image_url", "thumbnail_url", "image_hash", "content_type", "deduplicated"}
+    """
+    digest = content_hash(image_content)
+    content_type, ext = detect_content_type(image_content)
+    original = bucket.blob(f"scan_images/{device_id}/{digest}.{ext}")
+    thumbnail = bucket.blob(f"scan_images/{device_id}/{digest}_thumb.jpg")
+    result = {"image_hash": digest, "content_type": content_type}
+
+    # Ảnh gốc được upload sau thumbnail -> ảnh gốc tồn tại nghĩa là thumbnail (nếu tạo được) cũng đã có
+    if original.exists():
+        logging.info(f"♻️ Image already stored: {original.name}")
+        return {**result, "image_url": original.public_url,
+                "thumbnail_url": thumbnail.public_url if thumbnail.exists() else None,
+                "deduplicated": True}
+
+    thumbnail_url = None
+    thumbnail_content = make_thumbnail(image_content)
+    if thumbnail_content is not None:
+        thumbnail_url = _upload(bucket, thumbnail.name, thumbnail_content, "image/jpeg").public_url
+
+    image_url = _upload(bucket, original.name, image_content, content_type).public_url
+    logging.info(f"✅ Uploaded image to: {image_url} ({content_type}, "
+                 f"{len(image_content)} bytes, thumbnail {len(thumbnail_content or b'')} bytes)")
+    return {**result, "image_url": image_url, "thumbnail_url": thumbnail_url, "deduplicated": False}
@@ -0,0 +1,289 @@
+"""
+Tách danh sách thành phần cục bộ (không gọi model) cho nhãn có dạng chuẩn
+"Thành phần: a, b (1,9%), c (621)."
+
+Theo đúng quy tắc của prompt trích xuất (analyze_with_openai_strict):
+1. Tách theo dấu phẩy / chấm phẩy ở cấp ngoài cùng (không tách bên trong ngoặc, "1,9")
+2. Bỏ phần trăm / định lượng ("Bơ (1,9%)" -> "Bơ")
+3. Bỏ mã phụ gia trong ngoặc ("chất điều vị (621)" -> "chất điều vị"), kể cả ngoặc lồng nhau
+4. Giữ nguyên chính tả; ngoặc chứa danh sách con ("sô cô la (đường, bơ ca cao)") được
+   trải thành các nguyên liệu riêng sau nguyên liệu cha
+
+Độ tin cậy giảm theo các dấu hiệu bất thường (ngoặc lệch, nguyên liệu quá dài = nghi OCR mất
+dấu phẩy, ký tự rác, danh sách tiếp tục sau dấu chấm, OCR kém...). Chỉ khi đủ tin cậy
+(>= LOCAL_PARSER_MIN_CONFIDENCE) mới bỏ qua lệnh gọi model; tỉ lệ scan đi đường cục bộ và
+lý do phải gọi model expose qua health_check. LOCAL_PARSER=0: tắt.
+Bộ nhãn mẫu + độ chính xác: benchmarks/eval_ingredient_parser.py
+"""
+import os
+import re
+import logging
+import threading
+
+import numpy as np
+
+import tracing
+from cache import register_cache, env_flag
+from lexical_matcher import fold, normalize
+from ingredient_region import ANCHORS
+
+LOCAL_PARSER = env_flag("LOCAL_PARSER", True)
+LOCAL_PARSER_MIN_CONFIDENCE = float(os.environ.get("LOCAL_PARSER_MIN_CONFIDENCE", 0.8))
+# Nguyên liệu dài hơn số từ này (ngoài ngoặc) -> nghi OCR mất dấu phẩy giữa 2 nguyên liệu
+MAX_ITEM_WORDS = 6
+# Độ tin cậy trung bình của Vision trên vùng thành phần dưới mức này -> text có thể sai
+MIN_OCR_CONFIDENCE = 0.8
+
+# Lý do -> mức trừ độ tin cậy (trừ mỗi lần gặp với các lý do theo từng nguyên liệu)
+PENALTIES = {
+    "unbalanced_parentheses": 0.5,
+    "too_few_items": 0.4,
+    "list_continues": 0.3,
+    "nested_header": 0.3,
+    "long_item": 0.25,
+    "garbled_item": 0.25,
+    "low_ocr_confidence": 0.2,
+    "missing_colon": 0.1,
+}
+
+# Câu cảnh báo dị ứng sau danh sách không phải nguyên liệu ("Sản phẩm có chứa: sữa, đậu nành")
+_ALLERGEN_STATEMENT = re.compile(r"^(san pham )?(co the )?(co )?chua\b|^(may )?contains?\b")
+_QUANTITY = re.compile(r"^\d+(?:[.,]\d+)?\s*(?:%|g|mg|kg|mcg|µg|ml|l|kcal)?$", re.IGNORECASE)
+# Mã phụ gia: 621, E621, INS 621, 500ii, 1422, 160a(ii)
+_ADDITIVE_CODE = re.compile(r"^(?:ins|e)?\s*\d{3,4}[a-f]?\s*(?:\(?(?:i{1,3}|iv|v)\)?)?$", re.IGNORECASE)
+_INLINE_QUANTITY = re.compile(r"\d+(?:[.,]\d+)?\s*%|\b\d+(?:[.,]\d+)?\s*(?:mg|mcg|kg|g|ml)\b", re.IGNORECASE)
+_OPEN, _CLOSE = "([", ")]"
+# Dấu câu dính vào từ trước / sau khi ghép lại từ OCR (Vision tách dấu câu thành từ riêng)
+_NO_SPACE_BEFORE = set(",.;:)]%")
+_NO_SPACE_AFTER = set("([")
+
+
+class ParsedList:
+    """
+    Attributes:
+        ingredients: list[str] nguyên liệu theo thứ tự trên nhãn
+        confidence: độ tin cậy [0, 1]
+        issues: list[str] lý do bị trừ độ tin cậy (khóa của PENALTIES), theo thứ tự gặp
+    """
+
+    def __init__(self, ingredients: list, confidence: float, issues: list):
+        self.ingredients = ingredients
+        self.confidence = confidence
+        self.issues = issues
+
+    @property
+    def confident(self) -> bool:
+        return self.confidence >= LOCAL_PARSER_MIN_CONFIDENCE
+
+
+def glue_words(words: list) -> str:
+    """Ghép các từ OCR thành text tự nhiên: "Bơ ( 1,9 % )" -> "Bơ (1,9%)" """
+    parts = []
+    for word in words:
+        if parts and word[:1] not in _NO_SPACE_BEFORE and parts[-1][-1:] not in _NO_SPACE_AFTER:
+            parts.append(" ")
+        parts.append(word)
+    return "".join(parts)
+
+
+def _is_decimal_mark(text: str, i: int) -> bool:
+    return 0 < i < len(text) - 1 and text[i - 1].isdigit() and text[i + 1].isdigit()
+
+
+def _split_top_level(text: str, separators: str) -> tuple[list, bool]:
+    """
+    Tách text theo separators ở ngoài mọi ngoặc
+    Returns:
+        (các phần, balanced: ngoặc đóng / mở khớp nhau)
+    """
+    parts, start, depth, balanced = [], 0, 0, True
+    for i, ch in enumerate(text):
+        if ch in _OPEN:
+            depth += 1
+        elif ch in _CLOSE:
+            if depth == 0:
+                balanced = False
+            depth = max(0, depth - 1)
+        elif ch in separators and depth == 0 and not _is_decimal_mark(text, i):
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts, balanced and depth == 0
+
+
+def _paren_groups(text: str) -> tuple[str, list]:
+    """(text ngoài ngoặc cấp 1, [nội dung từng ngoặc cấp 1]); ngoặc chưa đóng chạy đến hết text"""
+    outside, groups, depth, start = [], [], 0, 0
+    for i, ch in enumerate(text):
+        if ch in _OPEN:
+            if depth == 0:
+                start = i + 1
+            depth += 1
+        elif ch in _CLOSE and depth:
+            depth -= 1
+            if depth == 0:
+                groups.append(text[start:i])
+        elif depth == 0:
+            outside.append(ch)
+    if depth:
+        groups.append(text[start:])
+    return "".join(outside), groups
+
+
+def _is_quantity_or_code(content: str) -> bool:
+    parts = [p.strip() for p in re.split(r"[,;/]", content)]
+    parts = [p for p in parts if p]
+    return bool(parts) and all(_QUANTITY.match(p) or _ADDITIVE_CODE.match(p) for p in parts)
+
+
+def _clean_name(text: str) -> str:
+    text = _INLINE_QUANTITY.sub(" ", text)
+    words = text.split()
+    # Mã phụ gia đứng sau tên không có ngoặc: "chất điều vị 621"
+    while len(words) > 1 and _ADDITIVE_CODE.match(words[-1]):
+        words.pop()
+    return " ".join(words).strip(" -:.*")
+
+
+def _parse_item(item: str, issues: list) -> list:
+    """1 nguyên liệu cấp ngoài (có thể kèm ngoặc) -> [tên, nguyên liệu con...]"""
+    outside, groups = _paren_groups(item)
+    inline, subs = [], []
+    for content in groups:
+        content = content.strip()
+        if not content or _is_quantity_or_code(content):
+            continue
+        sub_items, _ = _split_top_level(content, ",;")
+        if len(sub_items) > 1:
+            for sub in sub_items:
+                subs.extend(_parse_item(sub, issues))
+        else:
+            # Mô tả ngắn giữ lại trong ngoặc: "chất nhũ hóa (lecithin đậu nành (322))"
+            described = _parse_item(content, issues)
+            if described:
+                inline.append(f"({described[0]})")
+
+    name = _clean_name(outside)
+    if name:
+        # Tiêu đề nhóm bên trong danh sách ("Vắt mì: bột mì, ...; Gói gia vị: ...")
+        if ":" in name:
+            issues.append("nested_header")
+        if len(name.split()) > MAX_ITEM_WORDS:
+            issues.append("long_item")
+        letters = sum(ch.isalpha() for ch in name)
+        if letters < 2 or letters < 0.5 * len(name.replace(" ", "")):
+            issues.append("garbled_item")
+        name = " ".join([name, *inline])
+    elif inline:
+        # Chỉ có ngoặc mô tả, không có tên -> coi mô tả là tên
+        name = inline[0][1:-1]
+    return ([name] if name else []) + subs
+
+
+def parse_ingredient_text(text: str, has_colon: bool = True) -> ParsedList:
+    """
+    Tách danh sách (text ngay sau tiêu đề "Thành phần:") thành nguyên liệu
+    has_colon: tiêu đề có dấu ":" (không có -> trừ độ tin cậy)
+    """
+    issues = [] if has_colon else ["missing_colon"]
+
+    # Danh sách kết thúc ở dấu chấm cấp ngoài cùng đầu tiên (không tính "1.5")
+    sentences, balanced = _split_top_level(text, ".")
+    if not balanced:
+        issues.append("unbalanced_parentheses")
+    body = sentences[0]
+    trailing = ".".join(sentences[1:]).strip()
+    if trailing and not _ALLERGEN_STATEMENT.match(fold(trailing)):
+        if len(_split_top_level(trailing, ",;")[0]) >= 3:
+            issues.append("list_continues")
+
+    ingredients = []
+    for item in _split_top_level(body, ",;")[0]:
+        ingredients.extend(_parse_item(item.strip(), issues))
+    unique = {}
+    for ingredient in ingredients:
+        unique.setdefault(normalize(ingredient), ingredient)
+    ingredients = list(unique.values())
+    if len(ingredients) < 2:
+        issues.append("too_few_items")
+
+    confidence = max(0.0, 1.0 - sum(PENALTIES[issue] for issue in issues))
+    return ParsedList(ingredients, round(confidence, 3), issues)
+
+
+def parse_ingredient_region(doc, region: np.ndarray) -> ParsedList:
+    """
+    Tách danh sách trong vùng thành phần của OcrDocument (ingredient_region.py)
+    Vùng không bắt đầu bằng đúng 1 tiêu đề (không có vùng, nhãn song ngữ) -> confidence 0
+    """
+    if region is None:
+        return ParsedList([], 0.0, ["no_region"])
+    indices = np.flatnonzero(region & ~doc.is_duplicate)
+    words = [doc.words[i] for i in indices]
+    folded = [fold(word) for word in words]
+
+    anchors = [i for i in range(len(folded))
+               if any(tuple(folded[i:i + len(a)]) == a for a in ANCHORS)]
+    if len(anchors) != 1 or anchors[0] != 0:
+        return ParsedList([], 0.0, ["multiple_lists" if len(anchors) > 1 else "no_anchor"])
+    anchor_len = next(len(a) for a in ANCHORS if tuple(folded[:len(a)]) == a)
+
+    # "Thành phần:" / "Thành phần chính:"
+    start, has_colon = anchor_len, False
+    for i in range(anchor_len, min(anchor_len + 3, len(words))):
+        if words[i] == ":":
+            start, has_colon = i + 1, True
+            break
+    parsed = parse_ingredient_text(glue_words(words[start:]), has_colon)
+    if len(indices) and float(doc.confidence[indices].mean()) < MIN_OCR_CONFIDENCE:
+        parsed.issues.append("low_ocr_confidence")
+        parsed.confidence = round(max(0.0, parsed.confidence - PENALTIES["low_ocr_confidence"]), 3)
+    return parsed
+
+
+class LocalParserStats:
+    """Tỉ lệ scan không cần model trích xuất + lý do phải gọi model (health_check)"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self.stats = {"attempts": 0, "local": 0, "fallback_reasons": {}}
+        register_cache(self)
+
+    def record(self, parsed: ParsedList):
+        with self._lock:
+            self.stats["attempts"] += 1
+            if parsed.confident:
+                self.stats["local"] += 1
+            else:
+                reason = parsed.issues[0] if parsed.issues else "low_confidence"
+                reasons = self.stats["fallback_reasons"]
+                reasons[reason] = reasons.get(reason, 0) + 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = {**self.stats, "fallback_reasons": dict(self.stats["fallback_reasons"])}
+        stats["enabled"] = LOCAL_PARSER
+        stats["local_rate"] = round(stats["local"] / stats["attempts"], 3) if stats["attempts"] else 0
+        return stats
+
+
+local_parser_stats = LocalParserStats("ingredient_parser")
+
+
+def extract_ingredients_local(doc, region: np.ndarray) -> list | None:
+    """
+    Nguyên liệu tách cục bộ nếu đủ tin cậy, None nếu phải gọi model
+    (trace: ingredients_local / ingredients_model)
+    """
+    if not LOCAL_PARSER:
+        return None
+    parsed = parse_ingredient_region(doc, region)
+    local_parser_stats.record(parsed)
+    if not parsed.confident:
+        tracing.count("ingredients_model")
+        return None
+    tracing.count("ingredients_local")
+    logging.info(f"🧩 Tách thành phần cục bộ: {len(parsed.ingredients)} nguyên liệu "
+                 f"(tin cậy {parsed.confidence:.2f}), bỏ qua model trích xuất")
+    return parsed.ingredients
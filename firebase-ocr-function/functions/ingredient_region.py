@@ -0,0 +1,161 @@
+"""
+Xác định vùng "Thành phần" trên bao bì từ bố cục OCR (block / paragraph / line của Vision)
+
+Text OCR của cả bao bì gồm bảng dinh dưỡng, địa chỉ, mã vạch, quảng cáo... nhưng bước
+trích xuất nguyên liệu chỉ cần danh sách thành phần. Vùng được xác định cục bộ:
+1. Neo: "Thành phần", "Nguyên liệu", "Ingredients" (bỏ dấu, không phân biệt hoa thường;
+   bỏ qua "thành phần dinh dưỡng" = bảng dinh dưỡng)
+2. Mở rộng từ neo theo thứ tự đọc đến khi gặp tiêu đề mục khác ("Bảo quản", "HSD",
+   "Giá trị dinh dưỡng"...) ở đầu dòng / sau dấu chấm, hoặc ranh giới bố cục sau khi
+   danh sách đã kết thúc (dấu chấm cuối đoạn, sang block mới không còn dạng danh sách)
+3. Độ tin cậy: neo có dấu ":" / đứng đầu dòng, mật độ dấu phân cách (",", ";") trong vùng
+
+Độ tin cậy thấp (< REGION_MIN_CONFIDENCE) hoặc không có neo -> dùng toàn bộ text như trước.
+Vùng chiếm gần hết ảnh (ảnh chụp riêng phần thành phần) vẫn được trả về: bộ tách cục bộ
+(ingredient_parser.py) cần biết danh sách bắt đầu từ tiêu đề. REGION_DETECTION=0: tắt.
+"""
+import os
+
+import numpy as np
+
+from cache import env_flag
+from lexical_matcher import fold
+
+REGION_DETECTION = env_flag("REGION_DETECTION", True)
+REGION_MIN_CONFIDENCE = float(os.environ.get("REGION_MIN_CONFIDENCE", 0.7))
+
+# Cụm từ đã bỏ dấu (tuple token)
+ANCHORS = [("thanh", "phan"), ("nguyen", "lieu"), ("ingredients",), ("ingredient",), ("thanhphan",)]
+# Neo theo sau bởi các từ này không phải danh sách nguyên liệu
+ANCHOR_EXCLUDES = {"dinh", "duong", "nutrition", "nutritional"}
+SECTION_HEADERS = [
+    ("bao", "quan"), ("huong", "dan"), ("cach", "dung"), ("gia", "tri", "dinh", "duong"),
+    ("thong", "tin", "dinh", "duong"), ("thanh", "phan", "dinh", "duong"), ("han", "su", "dung"),
+    ("ngay", "san", "xuat"), ("nsx",), ("hsd",), ("san", "xuat", "tai"), ("san", "xuat", "boi"),
+    ("nha", "san", "xuat"), ("khoi", "luong", "tinh"), ("the", "tich", "thuc"), ("cong", "ty"),
+    ("dia", "chi"), ("xuat", "xu"), ("nhap", "khau"), ("phan", "phoi"), ("chi", "tieu", "chat", "luong"),
+    ("nutrition",), ("storage",), ("directions",), ("best", "before"), ("net", "wt"),
+    ("net", "weight"), ("manufactured",), ("distributed",), ("exp",), ("mfg",),
+]
+_SEPARATORS = {",", ";"}
+# Mật độ dấu phân cách (trên số từ không phải dấu câu) của một danh sách nguyên liệu điển hình
+_LIST_DENSITY = 0.25
+
+
+class IngredientRegion:
+    """
+    Attributes:
+        mask: bool (N) các từ thuộc vùng thành phần, None = dùng toàn bộ text
+        confidence: độ tin cậy [0, 1] của vùng tốt nhất (0 nếu không có neo)
+        reason: "region" | "disabled" | "no_anchor" | "low_confidence"
+        coverage: tỉ lệ số từ của vùng trên cả nhãn
+    """
+
+    def __init__(self, mask: np.ndarray | None, confidence: float, reason: str, coverage: float = 1.0):
+        self.mask = mask
+        self.confidence = confidence
+        self.reason = reason
+        self.coverage = coverage
+
+    def to_dict(self) -> dict:
+        return {"reason": self.reason, "confidence": round(self.confidence, 3),
+                "coverage": round(self.coverage, 3)}
+
+
+def _match_at(folded: list, i: int, phrases: list) -> int:
+    """Số từ của cụm trong phrases khớp tại vị trí i (0 nếu không khớp)"""
+    for phrase in phrases:
+        if tuple(folded[i:i + len(phrase)]) == phrase:
+            return len(phrase)
+    return 0
+
+
+def _is_list_like(folded: list, start: int, stop: int) -> bool:
+    """Dòng / đoạn [start, stop) có dạng danh sách (có dấu phân cách)"""
+    return any(folded[i] in _SEPARATORS for i in range(start, stop))
+
+
+def _expand(doc, folded: list, anchor: int, anchor_len: int) -> tuple[int, int]:
+    """Vùng [anchor, stop) theo thứ tự đọc bắt đầu từ neo"""
+    n = len(folded)
+    i = anchor + anchor_len
+    sentence_ended = False  # Từ trước kết thúc bằng dấu chấm (Vision có thể tách "." hoặc không)
+    while i < n:
+        if doc.image_index is not None and doc.image_index[i] != doc.image_index[anchor]:
+            break
+        new_line = doc.line[i] != doc.line[i - 1]
+        # Neo khác ở đầu dòng (nhãn song ngữ, neo trước là câu quảng cáo): vùng riêng
+        if new_line and _match_at(folded, i, ANCHORS):
+            break
+        # "chất bảo quản" là nguyên liệu, không phải mục "Bảo quản"
+        if (new_line or sentence_ended) and folded[i - 1] != "chat" and _match_at(folded, i, SECTION_HEADERS):
+            break
+        if doc.paragraph[i] != doc.paragraph[i - 1] and sentence_ended:
+            break
+        if doc.block[i] != doc.block[i - 1]:
+            # Danh sách dài bị Vision tách sang block khác (cột / khung): chỉ đi tiếp khi
+            # danh sách chưa kết thúc và dòng đầu block mới vẫn có dấu phân cách
+            line_end = i
+            while line_end < n and doc.line[line_end] == doc.line[i]:
+                line_end += 1
+            if sentence_ended or not _is_list_like(folded, i, line_end):
+                break
+        sentence_ended = folded[i].endswith(".")
+        i += 1
+    return anchor, i
+
+
+def _confidence(doc, folded: list, anchor: int, anchor_len: int, stop: int) -> float:
+    after = anchor + anchor_len
+    content = [i for i in range(after, stop) if not doc.is_noise[i]]
+    if len(content) < 2:
+        return 0.0
+    score = 0.5
+    # "Thành phần:" / "Thành phần chính:"
+    if any(folded[i] == ":" for i in range(after, min(after + 3, stop))):
+        score += 0.2
+    if anchor == 0 or doc.line[anchor] != doc.line[anchor - 1]:
+        score += 0.1
+    separators = sum(1 for i in range(after, stop) if folded[i] in _SEPARATORS)
+    score += 0.2 * min(1.0, separators / len(content) / _LIST_DENSITY)
+    return score
+
+
+def detect_ingredient_region(doc) -> IngredientRegion:
+    """
+    Vùng thành phần của OcrDocument (hợp của mọi vùng đủ tin cậy: nhãn song ngữ, batch scan)
+    Returns:
+        IngredientRegion, mask None nếu phải dùng toàn bộ text
+    """
+    if not REGION_DETECTION:
+        return IngredientRegion(None, 0.0, "disabled")
+    n = len(doc)
+    if not n:
+        return IngredientRegion(None, 0.0, "no_anchor")
+
+    folded = [fold(word) for word in doc.words]
+    mask = np.zeros(n, dtype=bool)
+    best = 0.0
+    found_anchor = False
+    i = 0
+    while i < n:
+        anchor_len = _match_at(folded, i, ANCHORS)
+        if not anchor_len or (i + anchor_len < n and folded[i + anchor_len] in ANCHOR_EXCLUDES):
+            i += 1
+            continue
+        found_anchor = True
+        start, stop = _expand(doc, folded, i, anchor_len)
+        confidence = _confidence(doc, folded, i, anchor_len, stop)
+        best = max(best, confidence)
+        if confidence >= REGION_MIN_CONFIDENCE:
+            mask[start:stop] = True
+            i = stop
+        else:
+            # Neo yếu (VD: "100% nguyên liệu tự nhiên") có thể che neo thật ở phía sau
+            i += anchor_len
+
+    if not found_anchor:
+        return IngredientRegion(None, 0.0, "no_anchor")
+    if not mask.any():
+        return IngredientRegion(None, best, "low_confidence")
+    return IngredientRegion(mask, best, "region", float(mask.mean()))
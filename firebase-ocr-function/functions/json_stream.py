@@ -0,0 +1,93 @@
+"""
+Parser JSON tăng dần cho output stream của OpenAI
+
+Khi gpt-4o stream từng token của một JSON object lớn, IncrementalArrayParser
+trả về từng phần tử của mảng (VD: "warnings") ngay khi phần tử đó đóng ngoặc,
+không cần chờ toàn bộ response. Mảng chuỗi (VD: "ingredients") có sẵn qua .value
+ngay khi mảng đóng ngoặc (finished).
+"""
+import json
+import re
+
+
+class IncrementalArrayParser:
+    """
+    Args:
+        key: Tên mảng cần theo dõi trong object JSON gốc (VD: "warnings")
+
+    Dùng:
+        parser = IncrementalArrayParser("warnings")
+        for delta in stream:
+            for item in parser.feed(delta):
+                ...
+    """
+
+    def __init__(self, key: str):
+        self._key_pattern = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+        self._buffer = ""
+        self._pos = None  # Vị trí quét tiếp theo (sau dấu "[" của mảng)
+        self._array_start = None
+        self._item_start = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self.finished = False
+        self.value = None  # Toàn bộ mảng (list) sau khi finished
+
+    def feed(self, delta: str) -> list:
+        """Thêm đoạn text mới, trả về các phần tử vừa hoàn chỉnh"""
+        self._buffer += delta
+        if self.finished:
+            return []
+
+        if self._pos is None:
+            match = self._key_pattern.search(self._buffer)
+            if not match:
+                return []
+            self._pos = match.end()
+            self._array_start = match.end() - 1
+
+        items = []
+        buffer = self._buffer
+        i = self._pos
+        while i < len(buffer):
+            ch = buffer[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                if self._depth == 0:
+                    self._item_start = i
+                self._depth += 1
+            elif ch in '}]':
+                if self._depth == 0:
+                    # Dấu "]" đóng mảng
+                    self.finished = True
+                    try:
+                        self.value = json.loads(buffer[self._array_start:i + 1])
+                    except json.JSONDecodeError:
+                        pass
+                    i += 1
+                    break
+                self._depth -= 1
+                if self._depth == 0 and self._item_start is not None:
+                    try:
+                        items.append(json.loads(buffer[self._item_start:i + 1]))
+                    except json.JSONDecodeError:
+                        pass
+                    self._item_start = None
+            i += 1
+
+        self._pos = i
+        return items
+
+    @property
+    def text(self) -> str:
+        """Toàn bộ text đã nhận"""
+        return self._buffer
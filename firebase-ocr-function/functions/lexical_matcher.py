@@ -0,0 +1,181 @@
+"""
+Bộ so khớp cục bộ (lexical/fuzzy) để map nguyên liệu -> vị trí từ OCR
+
+Prompt trích xuất yêu cầu "GIỮ NGUYÊN chính tả", nên phần lớn nguyên liệu là bản sao
+nguyên văn của một cửa sổ từ OCR. Bộ so khớp này chạy trước đường embedding:
+1. Bỏ dấu tiếng Việt (đ -> d, ư -> u, ...) + chữ thường
+2. Index trigram ký tự trên các cửa sổ 1..N từ OCR để lọc ứng viên
+3. Chấm điểm ứng viên bằng khoảng cách chỉnh sửa (Levenshtein) chuẩn hóa
+
+Kết quả hoàn toàn xác định (deterministic), không cần mạng.
+"""
+import unicodedata
+from collections import defaultdict
+
+# Bỏ dấu làm mất thông tin ("đường" vs "dương"), nên khớp sau khi bỏ dấu bị trừ điểm nhẹ.
+# Chỉ áp dụng khi 1 bên không có dấu (OCR mất dấu, tên tiếng Anh)
+FOLD_PENALTY = 0.92
+# Cả 2 bên đều có dấu nhưng chỉ giống nhau sau khi bỏ dấu -> khác từ ("đường" vs "dương"):
+# điểm luôn dưới ngưỡng so khớp cục bộ (LEXICAL_MATCH_MIN_SCORE), để embedding quyết định
+FOLD_CONFLICT_PENALTY = 0.8
+# Số ứng viên (theo trigram) được chấm điểm Levenshtein cho mỗi phrase
+MAX_CANDIDATES = 12
+
+
+def normalize(text: str) -> str:
+    """NFC + chữ thường + gộp khoảng trắng"""
+    return " ".join(unicodedata.normalize('NFC', text).casefold().split())
+
+
+def fold(text: str) -> str:
+    """Bỏ dấu tiếng Việt: "Bột mì" -> "bot mi", "đường" -> "duong" """
+    decomposed = unicodedata.normalize('NFD', normalize(text).replace('đ', 'd'))
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def levenshtein(a: str, b: str) -> int:
+    """Khoảng cách chỉnh sửa (insert/delete/substitute), O(len(a) * len(b))"""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (ca != cb)
+            ))
+        previous = current
+    return previous[-1]
+
+
+def similarity(a: str, b: str) -> float:
+    """1 - levenshtein / độ dài lớn nhất, trong khoảng [0, 1]"""
+    if not a and not b:
+        return 1.0
+    return 1.0 - levenshtein(a, b) / max(len(a), len(b))
+
+
+class LexicalIndex:
+    """
+    Index trigram trên các cửa sổ từ OCR liên tiếp
+
+    Args:
+        texts: Text của các từ OCR
+        segments: Các đoạn chỉ số từ không phải noise (theo thứ tự đọc);
+            cửa sổ không vượt qua ranh giới đoạn (VD: giữa 2 ảnh khác nhau)
+        max_window_size: Số từ tối đa trong một cửa sổ
+    """
+
+    def __init__(self, texts: list, segments: list, max_window_size: int = 5):
+        self.windows = []  # (indices, raw_text, normalized, folded, có dấu)
+        self._gram_counts = []
+        self._postings = defaultdict(list)
+
+        for window in range(1, max_window_size + 1):
+            for clean_indices in segments:
+                for i in range(len(clean_indices) - window + 1):
+                    indices = clean_indices[i:i + window]
+                    raw_text = " ".join(texts[idx] for idx in indices)
+                    folded = fold(raw_text)
+                    window_id = len(self.windows)
+                    grams = trigrams(folded)
+                    normalized = normalize(raw_text)
+                    self.windows.append((indices, raw_text, normalized, folded, folded != normalized))
+                    self._gram_counts.append(len(grams))
+                    for gram in grams:
+                        self._postings[gram].append(window_id)
+
+    def _scored_candidates(self, phrase: str) -> list:
+        """
+        Chấm điểm các ứng viên (lọc theo trigram chung) cho phrase
+        Returns:
+            [(score, window)] sắp xếp theo điểm giảm dần; hòa điểm: ưu tiên cửa sổ
+            xuất hiện trước (thứ tự đọc), rồi cửa sổ ngắn hơn
+        """
+        phrase_norm = normalize(phrase)
+        phrase_folded = fold(phrase)
+        phrase_marked = phrase_folded != phrase_norm
+        phrase_grams = trigrams(phrase_folded)
+        if not phrase_folded:
+            return []
+
+        # Lọc ứng viên theo số trigram chung (Dice coefficient)
+        shared = defaultdict(int)
+        for gram in phrase_grams:
+            for window_id in self._postings.get(gram, ()):
+                shared[window_id] += 1
+        if not shared:
+            return []
+
+        def dice(window_id):
+            return 2.0 * shared[window_id] / (len(phrase_grams) + self._gram_counts[window_id])
+
+        candidates = sorted(shared, key=lambda w: (-dice(w), w))[:MAX_CANDIDATES]
+
+        scored = []
+        for window_id in candidates:
+            window = self.windows[window_id]
+            fold_penalty = FOLD_CONFLICT_PENALTY if phrase_marked and window[4] else FOLD_PENALTY
+            score = max(
+                similarity(phrase_norm, window[2]),
+                fold_penalty * similarity(phrase_folded, window[3])
+            )
+            scored.append((score, window))
+        scored.sort(key=lambda item: (-item[0], item[1][0][0], len(item[1][0])))
+        return scored
+
+    def match(self, phrase: str):
+        """
+        Tìm cửa sổ OCR giống phrase nhất
+        Returns:
+            (window, score) hoặc (None, 0.0)
+        """
+        scored = self._scored_candidates(phrase)
+        if not scored:
+            return None, 0.0
+        score, window = scored[0]
+        return window, score
+
+    def match_all(self, phrase: str, min_score: float) -> list:
+        """
+        Mọi cửa sổ ứng viên đạt min_score (VD: nguyên liệu in 2 lần trên bao bì)
+        Returns:
+            [(window, score)] theo điểm giảm dần; các cửa sổ có thể chồng lấn nhau
+        """
+        return [(window, score) for score, window in self._scored_candidates(phrase) if score >= min_score]
+
+
+def match_phrases(target_phrases: list, words: list, segments: list,
+                  min_score: float = 0.85) -> dict:
+    """
+    So khớp cục bộ toàn bộ phrase
+    Args:
+        words: Text của các từ OCR
+        segments: Các đoạn chỉ số từ không phải noise (xem LexicalIndex)
+    Returns:
+        Dict {vị trí phrase trong target_phrases: [(indices, matched_text, score)]}
+        chỉ gồm các phrase đạt min_score; mỗi phrase có thể có nhiều cửa sổ (điểm giảm dần)
+    """
+    if not target_phrases or not any(segments):
+        return {}
+
+    longest_phrase = max(len(p.split()) for p in target_phrases)
+    index = LexicalIndex(
+        words,
+        segments,
+        max_window_size=max(3, min(longest_phrase + 1, 8))
+    )
+
+    matches = {}
+    for i, phrase in enumerate(target_phrases):
+        found = index.match_all(phrase, min_score)
+        if found:
+            matches[i] = [(window[0], window[1], score) for window, score in found]
+    return matches
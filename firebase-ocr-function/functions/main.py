@@ -4,15 +4,48 @@ Sử dụng Google Vision OCR + OpenAI + Semantic Search để trích xuất th
 """
 import os
 import json
+import time
 import base64
+import hashlib
 import logging
-import uuid
+import queue
+import threading
+import contextvars
 from io import BytesIO
+from concurrent.futures import Future
 from datetime import datetime
 
 from firebase_functions import https_fn, options
 from firebase_admin import initialize_app, db, storage
 
+import ocr_cache
+from cache import get_cache_stats, l2_write_scope, env_int, env_flag
+from embedding_cache import embedding_store, normalize_text
+from lexical_matcher import match_phrases, normalize
+from ocr_document import OcrDocument, OcrDocumentBuilder
+from box_mapping import union_rects, top_k, non_max_suppression, rect_to_polygon
+from pipeline import Stage, run_stages
+from singleflight import SingleFlight, FlightTimeout
+from ingredient_region import detect_ingredient_region
+from ingredient_parser import extract_ingredients_local
+from model_router import (
+    model_router, FAST_MODEL, STRONG_MODEL, validate_extraction, validate_health, validate_verdicts, profile_complexity
+)
+import tracing
+from upstream import vision_limiter, chat_limiter, embedding_limiter
+from openai_scheduler import (
+    chat_scheduler, embedding_scheduler, request_scope, remaining_deadline, INTERACTIVE, BATCH
+)
+import history_store
+from image_store import store_scan_image
+from json_stream import IncrementalArrayParser
+from health_verdicts import (
+    verdict_cache, verdict_key, profile_conditions, compact_verdict,
+    assemble_warning, local_overall_recommendation, CONDITION_KINDS
+)
+from allergen_profile import find_local_warnings, merge_warnings, profile_hash
+from image_preprocess import preprocess_image, restore_boxes, should_compare, preprocess_stats
+
 # --- KHỞI TẠO FIREBASE ---
 # Cấu hình cho Realtime Database và Storage
 firebase_app = initialize_app(options={
@@ -22,73 +55,273 @@ firebase_app = initialize_app(options={
 
 # --- LAZY LOADING CHO CÁC THƯ VIỆN NẶNG ---
 # Sử dụng lazy loading để tối ưu cold start
+# Client được dùng chung giữa các request / thread của instance (giữ pool kết nối)
 _vision_client = None
 _openai_client = None
+_client_lock = threading.Lock()
+
+# Số request đồng thời / instance cho smart_ocr_rag (Cloud Functions gen2 concurrency).
+# Mỗi scan chủ yếu chờ Vision / OpenAI (CPU ~100-300ms), nên 1 instance 1GB / 1 vCPU phục vụ
+# được nhiều scan cùng lúc. Đo bằng benchmarks/bench_pipeline.py --sizes 200 --concurrency N
+# (latency giả lập mặc định: Vision 0.4s, chat 1s, embeddings 0.15s):
+#   N=1: 0.44 scan/s, p95 2.7s | N=8: 3.1 scan/s, p95 2.9s | N=16: 5.0 scan/s, p95 3.5s, RSS 150MB
+#   N=32: 7.6 scan/s nhưng p95 4.9s, phải xếp hàng ở upstream limiter (upstream.py)
+SCAN_CONCURRENCY = env_int("SCAN_CONCURRENCY", 16)
+BATCH_SCAN_CONCURRENCY = env_int("BATCH_SCAN_CONCURRENCY", 4)
+# Tổng thời gian tối đa cho các lệnh gọi OpenAI (kể cả retry) của 1 request, < timeout_sec (300)
+OPENAI_REQUEST_DEADLINE_SEC = env_int("OPENAI_REQUEST_DEADLINE_SEC", 240)
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_BATCH_SIZE = 1000  # OpenAI giới hạn 2048 input / request
 
-def get_openai_embeddings(texts: list[str]) -> list[list[float]]:
+def get_openai_embeddings(texts: list[str]):
     """
-    Get embeddings from OpenAI API instead of local model
+    Get embeddings from OpenAI API, backed by the (model, normalized text) embedding cache.
+    Only texts missing from the cache are sent to client.embeddings.create.
     Args:
         texts: List of text strings to embed
     Returns:
-        List of embedding vectors
+        float32 numpy array of shape (len(texts), dim)
     """
-    client = get_openai_client()
+    import numpy as np
     
-    try:
-        response = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=texts
-        )
-        return [item.embedding for item in response.data]
-    except Exception as e:
-        logging.error(f"Error getting OpenAI embeddings: {e}")
-        raise
+    normalized = [normalize_text(t) for t in texts]
+    unique_texts = list(dict.fromkeys(normalized))
+    
+    vectors = embedding_store.get_many(EMBEDDING_MODEL, unique_texts)
+    missing = [t for t in unique_texts if t not in vectors]
+    tracing.count("embedding_cache_hits", len(unique_texts) - len(missing))
+    tracing.count("embedding_cache_misses", len(missing))
+    
+    if missing:
+        client = get_openai_client()
+        fresh = {}
+        try:
+            for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+                batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+                with tracing.span("embedding"):
+                    response = embedding_scheduler.call(
+                        client.embeddings,
+                        model=EMBEDDING_MODEL,
+                        input=batch
+                    )
+                tracing.count("embedded_strings", len(batch))
+                tracing.record_usage(getattr(response, "usage", None), prefix="embedding")
+                for text, item in zip(batch, response.data):
+                    fresh[text] = np.asarray(item.embedding, dtype=np.float32)
+        except Exception as e:
+            logging.error(f"Error getting OpenAI embeddings: {e}")
+            raise
+        vectors.update(fresh)
+        embedding_store.set_many(EMBEDDING_MODEL, fresh)
+    
+    logging.info(f"📦 Embeddings: {len(texts)} text, {len(unique_texts)} unique, {len(missing)} gọi API")
+    
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.stack([vectors[t] for t in normalized])
 
 def get_vision_client():
-    """Lazy load Google Vision client"""
+    """Lazy load Google Vision client (thread-safe, 1 kênh gRPC dùng chung cho mọi request)"""
     global _vision_client
     if _vision_client is None:
-        from google.cloud import vision
-        _vision_client = vision.ImageAnnotatorClient()
+        with _client_lock:
+            if _vision_client is None:
+                from google.cloud import vision
+                _vision_client = vision.ImageAnnotatorClient()
     return _vision_client
 
 def get_openai_client():
-    """Lazy load OpenAI client"""
+    """Lazy load OpenAI client (thread-safe, pool HTTP keep-alive dùng chung)"""
     global _openai_client
     if _openai_client is None:
-        from openai import OpenAI
-        # Lấy API key từ environment variable
-        api_key = os.environ.get('OPENAI_API_KEY')
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY chưa được cấu hình!")
-        _openai_client = OpenAI(api_key=api_key)
+        with _client_lock:
+            if _openai_client is None:
+                _openai_client = _create_openai_client()
     return _openai_client
 
+def _create_openai_client():
+    import httpx
+    from openai import OpenAI
+    # Lấy API key từ environment variable
+    api_key = os.environ.get('OPENAI_API_KEY')
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY chưa được cấu hình!")
+    # Đủ kết nối cho số lệnh gọi đồng thời tối đa (upstream.py), tái sử dụng kết nối TLS
+    max_connections = chat_limiter.limit + embedding_limiter.limit
+    http_client = httpx.Client(
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        timeout=httpx.Timeout(120.0, connect=10.0)
+    )
+    # Retry / backoff do openai_scheduler đảm nhận (đọc header rate limit, theo deadline request)
+    return OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+
 
 # ---------------------------------------------------------
 # BƯỚC 1: GOOGLE VISION OCR (Lấy dữ liệu thô)
 # ---------------------------------------------------------
-def get_ocr_data(image_content: bytes) -> list:
+VISION_BATCH_LIMIT = 16  # Số ảnh tối đa / 1 request batch_annotate_images
+
+def get_ocr_data(image_content: bytes, use_cache: bool = True, preprocess: bool = None) -> OcrDocument:
     """
     Sử dụng Google Vision để OCR ảnh
+    Kết quả được cache theo hash nội dung ảnh gốc (xem ocr_cache.py), nên cache hit
+    không tốn cả bước tiền xử lý ảnh.
     Args:
         image_content: bytes của ảnh
+        use_cache: Tra cứu/lưu cache OCR
+        preprocess: Tiền xử lý ảnh trước khi OCR (xem image_preprocess.py),
+            mặc định theo PREPROCESS_ENABLED (bật)
     Returns:
-        List các từ với vị trí bounding box
+        OcrDocument (xem ocr_document.py), bounding box theo tọa độ ảnh gốc
     """
+    cache_keys = None
+    if use_cache:
+        cached, cache_keys = ocr_cache.lookup(image_content)
+        if cached is not None:
+            logging.info(f"⚡ OCR cache hit ({len(cached)} từ)")
+            tracing.count("ocr_cache_hits")
+            return cached
+        tracing.count("ocr_cache_misses")
+    
+    if preprocess is None:
+        preprocess = env_flag("PREPROCESS_ENABLED", True)
+    
+    if preprocess:
+        with tracing.span("preprocess"):
+            processed_content, transform = preprocess_image(image_content)
+        doc = _detect_document_text(processed_content)
+        doc = doc.with_boxes(restore_boxes(doc.boxes, transform))
+        
+        # Lấy mẫu: OCR cả ảnh gốc để đo ảnh hưởng của tiền xử lý lên số từ nhận diện được
+        if processed_content is not image_content and should_compare():
+            original_words = _detect_document_text(image_content)
+            preprocess_stats.record(compared=1, words_original=len(original_words),
+                                    words_processed=len(doc))
+            logging.info(f"🖼️ Preprocess compare: {len(original_words)} từ (gốc) vs {len(doc)} từ (đã xử lý)")
+    else:
+        doc = _detect_document_text(image_content)
+    
+    if cache_keys is not None:
+        ocr_cache.store(cache_keys, doc)
+    
+    return doc
+
+
+def _detect_document_text(image_content: bytes) -> OcrDocument:
+    """Gọi Vision document_text_detection và parse kết quả"""
     from google.cloud import vision
     
     client = get_vision_client()
     image = vision.Image(content=image_content)
     
-    response = client.document_text_detection(image=image)
+    with vision_limiter.slot(), tracing.span("vision"):
+        response = client.document_text_detection(image=image)
+    return parse_vision_response(response)
+
+
+def get_ocr_data_batch(images: list, use_cache: bool = True, preprocess: bool = None) -> OcrDocument:
+    """
+    OCR nhiều ảnh (VD: các mặt của cùng 1 bao bì) bằng 1 lệnh batch_annotate_images
+    Args:
+        images: Danh sách bytes ảnh
+    Returns:
+        OcrDocument gộp của tất cả ảnh, có thêm:
+        - image_index: ảnh chứa từng từ
+        - is_duplicate: đoạn text đã xuất hiện ở ảnh trước (vùng chồng lấn khi chụp vòng quanh bao bì)
+    """
+    from google.cloud import vision
+    
+    if preprocess is None:
+        preprocess = env_flag("PREPROCESS_ENABLED", True)
     
+    docs = [None] * len(images)
+    cache_keys = [None] * len(images)
+    if use_cache:
+        for i, image_content in enumerate(images):
+            docs[i], cache_keys[i] = ocr_cache.lookup(image_content)
+    
+    misses = [i for i in range(len(images)) if docs[i] is None]
+    if misses:
+        logging.info(f"🔍 Batch OCR: {len(images) - len(misses)} cache hit, {len(misses)} ảnh gửi Vision")
+        client = get_vision_client()
+        for start in range(0, len(misses), VISION_BATCH_LIMIT):
+            chunk = misses[start:start + VISION_BATCH_LIMIT]
+            with tracing.span("preprocess"):
+                prepared = {
+                    i: preprocess_image(images[i]) if preprocess else (images[i], {})
+                    for i in chunk
+                }
+            requests = [
+                vision.AnnotateImageRequest(
+                    image=vision.Image(content=prepared[i][0]),
+                    features=[vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)]
+                )
+                for i in chunk
+            ]
+            with vision_limiter.slot(), tracing.span("vision"):
+                responses = client.batch_annotate_images(requests=requests).responses
+            for i, response in zip(chunk, responses):
+                if response.error.message:
+                    logging.error(f"❌ Vision lỗi ở ảnh {i}: {response.error.message}")
+                    docs[i] = OcrDocument.empty()
+                    continue
+                doc = parse_vision_response(response)
+                docs[i] = doc.with_boxes(restore_boxes(doc.boxes, prepared[i][1]))
+                if cache_keys[i] is not None:
+                    ocr_cache.store(cache_keys[i], docs[i])
+    
+    # Gộp thành document mới (các document con có thể đang nằm trong cache)
+    merged = OcrDocument.concat(docs)
+    _mark_duplicate_words(merged)
+    return merged
+
+
+def _mark_duplicate_words(doc: OcrDocument, ngram: int = 4):
+    """
+    Đánh dấu is_duplicate cho các từ thuộc n-gram đã xuất hiện ở ảnh trước
+    (text chồng lấn khi chụp nhiều ảnh liền nhau của cùng 1 danh sách thành phần)
+    """
+    import numpy as np
+    
+    seen = set()
+    clean = np.flatnonzero(~doc.is_noise)
+    for image_index in np.unique(doc.image_index[clean]):
+        indices = clean[doc.image_index[clean] == image_index]
+        keys = [normalize(doc.words[i]) for i in indices]
+        grams = [tuple(keys[j:j + ngram]) for j in range(len(keys) - ngram + 1)]
+        for j, gram in enumerate(grams):
+            if gram in seen:
+                doc.is_duplicate[indices[j:j + ngram]] = True
+        seen.update(grams)
+
+
+# Vision TextAnnotation.DetectedBreak.BreakType kết thúc một dòng:
+# EOL_SURE_SPACE (3), HYPHEN (4), LINE_BREAK (5)
+_LINE_END_BREAKS = (3, 4, 5)
+
+
+def _ends_line(word) -> bool:
+    """Từ cuối dòng: ký tự cuối có detected_break là xuống dòng"""
+    if not word.symbols:
+        return False
+    last = word.symbols[-1]
+    return int(last.property.detected_break.type_) in _LINE_END_BREAKS
+
+
+def parse_vision_response(response) -> OcrDocument:
+    """
+    Chuyển response document_text_detection thành OcrDocument
+    Giữ lại bố cục block / paragraph / line (chỉ số tăng dần theo thứ tự đọc của Vision,
+    dùng để không ghép n-gram vượt qua ranh giới dòng / đoạn khi mapping) và
+    độ tin cậy của từng từ / ký tự
+    """
     if not response.text_annotations:
-        return []
+        return OcrDocument.empty()
 
-    word_list = []
+    builder = OcrDocumentBuilder()
     ignore_chars = [",", ".", ":", ";", "|", "(", ")", "[", "]", "{", "}", "-", "*", "%"]
+    block_id = paragraph_id = line_id = 0
     
     for page in response.full_text_annotation.pages:
         for block in page.blocks:
@@ -97,24 +330,34 @@ def get_ocr_data(image_content: bytes) -> list:
                     word_text = ''.join([symbol.text for symbol in word.symbols])
                     box = [(v.x, v.y) for v in word.bounding_box.vertices]
                     is_noise = word_text in ignore_chars
+                    symbol_confidences = [
+                        symbol.confidence for symbol in word.symbols for _ in symbol.text
+                    ]
                     
-                    word_list.append({
-                        "text": word_text, 
-                        "box": box,
-                        "is_noise": is_noise
-                    })
+                    builder.add(word_text, box, is_noise, word.confidence, symbol_confidences,
+                                block_id, paragraph_id, line_id)
+                    if _ends_line(word):
+                        line_id += 1
+                # Dòng luôn kết thúc ở cuối đoạn
+                if builder.last_line() == line_id:
+                    line_id += 1
+                paragraph_id += 1
+            block_id += 1
     
-    return word_list
+    return builder.build()
 
 
 # ---------------------------------------------------------
 # BƯỚC 2: OPENAI ANALYSIS (Strict Prompt)
 # ---------------------------------------------------------
-def analyze_with_openai_strict(ocr_word_list: list) -> list:
+def analyze_with_openai_strict(ocr_doc: OcrDocument, region=None) -> list:
     """
     Sử dụng OpenAI để phân tích và trích xuất nguyên liệu
+    Model nhanh trước, nâng lên gpt-4o nếu kết quả không có trong text OCR (model_router.py)
+    region: (optional) mask vùng thành phần (ingredient_region.py), None = toàn bộ text
     """
-    full_text = " ".join([w['text'] for w in ocr_word_list])
+    # Bỏ các từ trùng lặp giữa các ảnh (batch scan) để không gửi 2 lần cùng 1 đoạn text
+    full_text = ocr_doc.extraction_text(region)
     
     client = get_openai_client()
     
@@ -137,24 +380,104 @@ def analyze_with_openai_strict(ocr_word_list: list) -> list:
     '''
     """
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
+    def call(model: str) -> list:
+        # Lỗi (429 hết lượt retry, quá deadline...) được ném ra để stage dùng fallback và báo
+        # degraded_stages, thay vì giả làm "không tìm thấy nguyên liệu"
+        response = chat_scheduler.call(
+            client.chat.completions,
+            model=model,
             messages=[{"role": "user", "content": prompt}],
             response_format={"type": "json_object"},
             temperature=0
         )
-        data = json.loads(response.choices[0].message.content)
-        return data.get("ingredients", [])
-    except Exception as e:
-        logging.error(f"Lỗi OpenAI: {e}")
-        return []
+        tracing.record_usage(response.usage)
+        ingredients = json.loads(response.choices[0].message.content).get("ingredients", [])
+        if not isinstance(ingredients, list):
+            raise ValueError("'ingredients' không phải mảng")
+        return ingredients
+    
+    return model_router.run("extraction", call,
+                            validate=lambda ingredients: validate_extraction(ingredients, full_text))
 
 
 # ---------------------------------------------------------
 # BƯỚC 2.5: PHÂN TÍCH RỦI RO SỨC KHỎE (Health Risk Analysis)
 # ---------------------------------------------------------
-def analyze_health_risks(ingredients: list, health_profile: dict) -> dict:
+# Model của output stream thẳng cho client / chế độ gộp
+HEALTH_MODEL = STRONG_MODEL
+
+# Dùng chung cho prompt phân tích sức khỏe và prompt gộp (analyze_fused)
+HEALTH_ANALYSIS_GUIDE = """## YÊU CẦU PHÂN TÍCH (QUAN TRỌNG)
+
+1. **Nhận diện trực tiếp**: Thành phần CÓ TRONG danh sách dị ứng
+   - Ví dụ: "hải sản" bao gồm: tôm, cua, mực, sò, ốc, cá...
+   - Ví dụ: "các loại đậu" bao gồm: đậu phộng, đậu nành, đậu xanh, đậu đỏ...
+   - Ví dụ: "gluten" bao gồm: bột mì, lúa mạch, yến mạch...
+
+2. **Nhận diện gián tiếp (Cross-reactivity)**: Thành phần có thể GÂY PHẢN ỨNG CHÉO
+   - Ví dụ: Dị ứng latex → có thể phản ứng với chuối, bơ, kiwi
+   - Ví dụ: Dị ứng đậu phộng → có thể phản ứng với đậu tương, đậu xanh
+   - Ví dụ: Dị ứng sữa bò → có thể phản ứng với sữa dê, sữa cừu
+
+3. **Ảnh hưởng tiền sử bệnh**: Thành phần KHÔNG TỐT cho tình trạng bệnh lý
+   - Gan nhiễm mỡ → hạn chế đường, chất béo bão hòa, rượu, fructose
+   - Tiểu đường → hạn chế đường, tinh bột tinh chế, carbohydrate đơn giản
+   - Cao huyết áp → hạn chế muối (sodium), MSG, thực phẩm chế biến sẵn
+   - Viêm họng → hạn chế đồ cay, đồ lạnh, đồ chiên rán, thực phẩm có tính axit
+   - Gout → hạn chế purine (thịt đỏ, nội tạng, hải sản)
+   - Bệnh thận → hạn chế protein, potassium, phosphorus"""
+
+RISK_SCORE_SCALE = """- risk_score: Điểm số đánh giá mức độ nguy hiểm trong khoảng [0, 1], trong đó:
+  * 0.8 - 1.0 = Cực kỳ nguy hiểm (dị ứng trực tiếp, có thể gây sốc phản vệ)
+  * 0.6 - 0.79 = Nguy hiểm cao (phản ứng chéo mạnh, ảnh hưởng nghiêm trọng đến bệnh lý)
+  * 0.4 - 0.59 = Nguy hiểm trung bình (ảnh hưởng tiền sử bệnh, cần hạn chế)
+  * 0.2 - 0.39 = Nguy hiểm thấp (cần thận trọng, theo dõi)
+  * 0.0 - 0.19 = Rất thấp (ảnh hưởng nhẹ, có thể sử dụng với lượng nhỏ)"""
+
+def analyze_health_risks(ingredients: list, health_profile: dict,
+                         on_warning=None, on_delta=None) -> dict:
+    """
+    Phân tích rủi ro sức khỏe dựa trên ingredients và health profile
+    1. So khớp cục bộ với hồ sơ đã biên dịch (allergen_profile.py) -> cảnh báo trực tiếp tức thì
+       (LOCAL_ALLERGEN_ONLY=1: dừng ở đây, không gọi model)
+    2. Mặc định dùng bảng memo theo cặp (nguyên liệu, tình trạng) - xem analyze_health_risks_memo;
+       đặt HEALTH_VERDICT_MEMO=0 để quay về 1 prompt toàn bộ (analyze_health_risks_full).
+    Tham số và kết quả giống analyze_health_risks_full.
+    """
+    # So khớp cục bộ với hồ sơ đã biên dịch: cảnh báo trực tiếp có ngay, không cần chờ model
+    local_warnings = find_local_warnings(ingredients, health_profile)
+    local_keys = {normalize(w["ingredient"]) for w in local_warnings}
+    if local_warnings:
+        logging.info(f"🎯 Local allergen match: {len(local_warnings)} cảnh báo")
+    if on_warning is not None:
+        for warning in local_warnings:
+            on_warning(warning)
+    
+    if env_flag("LOCAL_ALLERGEN_ONLY", False):
+        return {
+            "warnings": local_warnings,
+            "safe_ingredients": [i for i in dict.fromkeys(ingredients) if normalize(i) not in local_keys],
+            "overall_recommendation": local_overall_recommendation(local_warnings, len(set(map(normalize, ingredients))))
+        }
+    
+    def forward_warning(warning: dict):
+        # Nguyên liệu đã cảnh báo cục bộ thì không stream lại
+        if normalize(str(warning.get("ingredient", ""))) not in local_keys:
+            on_warning(warning)
+    
+    forward = forward_warning if on_warning is not None else None
+    if env_flag("HEALTH_VERDICT_MEMO", True):
+        return analyze_health_risks_memo(ingredients, health_profile, forward, on_delta,
+                                         local_warnings=local_warnings)
+    
+    result = analyze_health_risks_full(ingredients, health_profile, forward, on_delta)
+    result["warnings"] = merge_warnings(local_warnings, result["warnings"])
+    result["safe_ingredients"] = [i for i in result["safe_ingredients"] if normalize(str(i)) not in local_keys]
+    return result
+
+
+def analyze_health_risks_full(ingredients: list, health_profile: dict,
+                              on_warning=None, on_delta=None) -> dict:
     """
     Sử dụng OpenAI để phân tích rủi ro sức khỏe dựa trên ingredients và health profile
     
@@ -165,6 +488,9 @@ def analyze_health_risks(ingredients: list, health_profile: dict) -> dict:
                 "medical_history": ["bệnh 1", "bệnh 2"],
                 "allergy": ["dị ứng 1", "dị ứng 2"]
             }
+        on_warning: (optional) callback(warning: dict), gọi ngay khi từng cảnh báo
+            được stream xong -> bật chế độ stream của OpenAI
+        on_delta: (optional) callback(text: str) nhận từng token thô của gpt-4o
     
     Returns:
         Dictionary chứa warnings, safe_ingredients, overall_recommendation
@@ -192,25 +518,7 @@ Phân tích danh sách THÀNH PHẦN thực phẩm và xác định thành phầ
 ## DANH SÁCH THÀNH PHẦN CẦN PHÂN TÍCH
 {ingredients_str}
 
-## YÊU CẦU PHÂN TÍCH (QUAN TRỌNG)
-
-1. **Nhận diện trực tiếp**: Thành phần CÓ TRONG danh sách dị ứng
-   - Ví dụ: "hải sản" bao gồm: tôm, cua, mực, sò, ốc, cá...
-   - Ví dụ: "các loại đậu" bao gồm: đậu phộng, đậu nành, đậu xanh, đậu đỏ...
-   - Ví dụ: "gluten" bao gồm: bột mì, lúa mạch, yến mạch...
-
-2. **Nhận diện gián tiếp (Cross-reactivity)**: Thành phần có thể GÂY PHẢN ỨNG CHÉO
-   - Ví dụ: Dị ứng latex → có thể phản ứng với chuối, bơ, kiwi
-   - Ví dụ: Dị ứng đậu phộng → có thể phản ứng với đậu tương, đậu xanh
-   - Ví dụ: Dị ứng sữa bò → có thể phản ứng với sữa dê, sữa cừu
-
-3. **Ảnh hưởng tiền sử bệnh**: Thành phần KHÔNG TỐT cho tình trạng bệnh lý
-   - Gan nhiễm mỡ → hạn chế đường, chất béo bão hòa, rượu, fructose
-   - Tiểu đường → hạn chế đường, tinh bột tinh chế, carbohydrate đơn giản
-   - Cao huyết áp → hạn chế muối (sodium), MSG, thực phẩm chế biến sẵn
-   - Viêm họng → hạn chế đồ cay, đồ lạnh, đồ chiên rán, thực phẩm có tính axit
-   - Gout → hạn chế purine (thịt đỏ, nội tạng, hải sản)
-   - Bệnh thận → hạn chế protein, potassium, phosphorus
+{HEALTH_ANALYSIS_GUIDE}
 
 ## OUTPUT FORMAT (JSON)
 {{
@@ -232,117 +540,1089 @@ Phân tích danh sách THÀNH PHẦN thực phẩm và xác định thành phầ
 ## QUY TẮC BẮT BUỘC
 - Chỉ trả về JSON thuần túy, không có text giải thích bên ngoài
 - TOÀN BỘ nội dung PHẢI viết bằng TIẾNG VIỆT CÓ DẤU đầy đủ
-- risk_score: Điểm số đánh giá mức độ nguy hiểm trong khoảng [0, 1], trong đó:
-  * 0.8 - 1.0 = Cực kỳ nguy hiểm (dị ứng trực tiếp, có thể gây sốc phản vệ)
-  * 0.6 - 0.79 = Nguy hiểm cao (phản ứng chéo mạnh, ảnh hưởng nghiêm trọng đến bệnh lý)
-  * 0.4 - 0.59 = Nguy hiểm trung bình (ảnh hưởng tiền sử bệnh, cần hạn chế)
-  * 0.2 - 0.39 = Nguy hiểm thấp (cần thận trọng, theo dõi)
-  * 0.0 - 0.19 = Rất thấp (ảnh hưởng nhẹ, có thể sử dụng với lượng nhỏ)
+{RISK_SCORE_SCALE}
 - Giải thích khoa học phải chuyên sâu nhưng vẫn dễ hiểu cho người không có chuyên môn y khoa
 - Nếu KHÔNG có thành phần nào có vấn đề, trả về warnings = [] và overall_recommendation tích cực
 - Chỉ cảnh báo những thành phần THỰC SỰ có trong danh sách, không tự thêm thành phần mới
 """
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            response_format={"type": "json_object"},
-            temperature=0
-        )
-        data = json.loads(response.choices[0].message.content)
+    def call(model: str) -> dict:
+        # Lỗi được ném ra cho stage "health" (fallback + degraded_stages)
+        if on_warning is None and on_delta is None:
+            response = chat_scheduler.call(
+                client.chat.completions,
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                response_format={"type": "json_object"},
+                temperature=0
+            )
+            tracing.record_usage(response.usage)
+            content = response.choices[0].message.content
+        else:
+            content = _stream_health_completion(client, prompt, "warnings", on_warning, on_delta, model=model)
+        data = json.loads(content)
         return {
             "warnings": data.get("warnings", []),
             "safe_ingredients": data.get("safe_ingredients", []),
             "overall_recommendation": data.get("overall_recommendation", "")
         }
-    except Exception as e:
-        logging.error(f"Lỗi phân tích health risks: {e}")
-        return {
-            "warnings": [],
-            "safe_ingredients": ingredients,
-            "overall_recommendation": f"Không thể phân tích rủi ro sức khỏe: {str(e)}"
+    
+    # Cảnh báo đã stream cho client thì không nâng tầng được -> dùng thẳng model mạnh
+    conditions = profile_conditions(health_profile)
+    force_strong = ("streamed" if on_warning is not None or on_delta is not None
+                    else profile_complexity(conditions, len(ingredients) * len(conditions)))
+    return model_router.run("health_full", call, force_strong=force_strong,
+                            validate=lambda result: validate_health(result, ingredients))
+
+
+def _stream_health_completion(client, prompt: str, array_key: str = "warnings",
+                              on_item=None, on_delta=None, model: str = HEALTH_MODEL) -> str:
+    """
+    Gọi gpt-4o ở chế độ stream, đẩy từng phần tử của mảng array_key ra ngay khi
+    object JSON của nó hoàn chỉnh
+    Returns:
+        Toàn bộ nội dung JSON đã nhận
+    """
+    parser = IncrementalArrayParser(array_key)
+    
+    def consume(stream):
+        for chunk in stream:
+            if not chunk.choices:
+                # Chunk cuối (include_usage) chỉ chứa usage
+                tracing.record_usage(getattr(chunk, "usage", None))
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            if on_delta is not None:
+                on_delta(delta)
+            for item in parser.feed(delta):
+                if on_item is not None:
+                    on_item(item)
+    
+    # consume chạy khi vẫn giữ slot (kết nối vẫn mở trong lúc nhận token);
+    # chỉ retry lệnh tạo stream, không retry khi đã đẩy token cho client
+    chat_scheduler.call(
+        client.chat.completions,
+        consume=consume,
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        response_format={"type": "json_object"},
+        temperature=0,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+    return parser.text
+
+
+def analyze_health_risks_memo(ingredients: list, health_profile: dict,
+                              on_warning=None, on_delta=None, local_warnings: list = None) -> dict:
+    """
+    Phân tích rủi ro theo từng cặp (nguyên liệu, tình trạng) với bảng memo (xem health_verdicts.py)
+    - Cặp đã biết lấy từ cache, chỉ cặp chưa biết mới gửi cho model
+    - warnings / safe_ingredients được lắp ráp từ verdict cũ + mới
+    - overall_recommendation tạo cục bộ từ các cảnh báo
+    Cảnh báo của nguyên liệu đã đủ verdict trong cache được gửi qua on_warning ngay lập tức.
+    local_warnings: cảnh báo từ so khớp cục bộ, được gộp vào kết quả (đứng trước)
+    """
+    conditions = profile_conditions(health_profile)
+    ingredient_items = []  # (tên gốc, tên chuẩn hóa), bỏ trùng
+    seen = set()
+    for ingredient in ingredients:
+        ingredient_norm = normalize(ingredient)
+        if ingredient_norm and ingredient_norm not in seen:
+            seen.add(ingredient_norm)
+            ingredient_items.append((ingredient, ingredient_norm))
+    
+    pairs = [
+        (ingredient_norm, kind, condition_norm)
+        for _, ingredient_norm in ingredient_items
+        for kind, _, condition_norm in conditions
+    ]
+    # Verdict được cache theo model đã trả lời (model_router); ưu tiên verdict của model mạnh
+    verdicts = {}
+    for model in dict.fromkeys((STRONG_MODEL, FAST_MODEL)):
+        pending = {pair: verdict_key(model, pair[1], pair[2], pair[0]) for pair in pairs if pair not in verdicts}
+        if not pending:
+            break
+        cached = verdict_cache.get_many(list(pending.values()))
+        verdicts.update({pair: cached[key] for pair, key in pending.items() if key in cached})
+    unknown = [pair for pair in pairs if pair not in verdicts]
+    tracing.count("verdict_cache_hits", len(verdicts))
+    tracing.count("verdict_cache_misses", len(unknown))
+    logging.info(f"🧠 Verdict memo: {len(verdicts)}/{len(pairs)} cặp có sẵn, {len(unknown)} cặp gửi model")
+    
+    warnings = []
+    resolved = set()
+    
+    def resolve_ready():
+        """Lắp cảnh báo cho các nguyên liệu đã có đủ verdict (theo thứ tự phát ra)"""
+        for ingredient, ingredient_norm in ingredient_items:
+            if ingredient_norm in resolved:
+                continue
+            pairs = [(ingredient_norm, kind, condition_norm) for kind, _, condition_norm in conditions]
+            if not all(pair in verdicts for pair in pairs):
+                continue
+            resolved.add(ingredient_norm)
+            warning = assemble_warning(ingredient, [
+                (name, verdicts[(ingredient_norm, kind, condition_norm)])
+                for kind, name, condition_norm in conditions
+            ])
+            if warning is not None:
+                warnings.append(warning)
+                if on_warning is not None:
+                    on_warning(warning)
+    
+    resolve_ready()
+    
+    error = None
+    if unknown:
+        try:
+            fresh, model = _request_health_verdicts(unknown, ingredient_items, conditions, on_delta)
+            verdicts.update(fresh)
+            verdict_cache.set_many({
+                verdict_key(model, kind, condition_norm, ingredient_norm): verdict
+                for (ingredient_norm, kind, condition_norm), verdict in fresh.items()
+            })
+        except Exception as e:
+            logging.error(f"Lỗi phân tích health risks: {e}")
+            error = e
+        resolve_ready()
+    
+    warnings = merge_warnings(local_warnings or [], warnings)
+    warned = {normalize(w["ingredient"]) for w in warnings}
+    safe_ingredients = [
+        ingredient for ingredient, ingredient_norm in ingredient_items
+        if ingredient_norm in resolved and ingredient_norm not in warned
+    ]
+    
+    if error is not None:
+        overall_recommendation = f"Không thể phân tích rủi ro sức khỏe: {str(error)}"
+    else:
+        overall_recommendation = local_overall_recommendation(warnings, len(resolved))
+    
+    result = {
+        "warnings": warnings,
+        "safe_ingredients": safe_ingredients,
+        "overall_recommendation": overall_recommendation
+    }
+    if error is not None or len(resolved) < len(ingredient_items):
+        # Giữ cảnh báo đã có (cache / cục bộ) nhưng báo cho client biết kết quả chưa đầy đủ
+        # (lỗi gọi model, hoặc model bỏ sót cặp: nguyên liệu đó không được coi là an toàn)
+        result["degraded"] = True
+    return result
+
+
+def _request_health_verdicts(unknown_pairs: list, ingredient_items: list, conditions: list,
+                             on_delta=None) -> dict:
+    """
+    Hỏi model kết luận cho các cặp (nguyên liệu, tình trạng) chưa có trong memo
+    Model phải trả verdict tường minh cho MỌI cặp (cặp an toàn: risk_score = 0); cặp bị bỏ sót
+    không được coi là an toàn và không được cache.
+    Returns:
+        (dict (ingredient_norm, kind, condition_norm) -> verdict cho các cặp model đã trả lời,
+         model đã trả lời)
+    """
+    ingredient_names = {norm: name for name, norm in ingredient_items}
+    condition_names = {(kind, norm): name for kind, name, norm in conditions}
+    
+    # Nhóm theo nguyên liệu: "- bột mì: [Dị ứng] gluten; [Bệnh lý] tiểu đường"
+    grouped = {}
+    for ingredient_norm, kind, condition_norm in unknown_pairs:
+        grouped.setdefault(ingredient_norm, []).append(
+            f"[{CONDITION_KINDS[kind]}] {condition_names[(kind, condition_norm)]}"
+        )
+    pairs_str = "\n".join(
+        f"- {ingredient_names[ingredient_norm]}: {'; '.join(items)}"
+        for ingredient_norm, items in grouped.items()
+    )
+    
+    prompt = f"""
+Bạn là một BÁC SĨ DINH DƯỠNG và CHUYÊN GIA DỊ ỨNG THỰC PHẨM với kiến thức y khoa sâu rộng.
+
+## NHIỆM VỤ
+Với MỖI cặp (thành phần, tình trạng sức khỏe) dưới đây, đánh giá thành phần đó có GÂY HẠI cho người có tình trạng đó hay không.
+Mỗi dòng là một thành phần, theo sau là các tình trạng cần kiểm tra ([Dị ứng] hoặc [Bệnh lý]).
+
+## CÁC CẶP CẦN ĐÁNH GIÁ
+{pairs_str}
+
+{HEALTH_ANALYSIS_GUIDE}
+
+## OUTPUT FORMAT (JSON)
+{{
+  "verdicts": [
+    {{
+      "ingredient": "Tên thành phần y hệt như trong danh sách",
+      "condition": "Tên tình trạng y hệt như trong danh sách (không kèm [Dị ứng]/[Bệnh lý])",
+      "risk_score": 0.95,
+      "warning_type": "allergy/cross_reactivity/medical_condition",
+      "summary": "Tóm tắt ngắn gọn lý do cảnh báo",
+      "scientific_explanation": "Giải thích CHI TIẾT về mặt y khoa/sinh học",
+      "potential_effects": ["Tác động 1", "Tác động 2"],
+      "recommendation": "Lời khuyên cụ thể và thực tế"
+    }},
+    {{
+      "ingredient": "Thành phần an toàn với tình trạng này",
+      "condition": "Tên tình trạng",
+      "risk_score": 0
+    }}
+  ]
+}}
+
+## QUY TẮC BẮT BUỘC
+- Trả về verdict cho MỌI cặp trong danh sách, mỗi cặp đúng 1 phần tử, không bỏ sót cặp nào
+- Cặp AN TOÀN: risk_score = 0, chỉ cần "ingredient", "condition", "risk_score"
+- Giữ thứ tự các thành phần như trong danh sách
+- TOÀN BỘ nội dung PHẢI viết bằng TIẾNG VIỆT CÓ DẤU đầy đủ
+{RISK_SCORE_SCALE}
+- Kết luận phải đúng cho MỌI người có tình trạng đó (không phụ thuộc các tình trạng khác)
+- Chỉ trả về JSON thuần túy
+"""
+    
+    client = get_openai_client()
+    
+    def call(model: str) -> dict:
+        if on_delta is None:
+            response = chat_scheduler.call(
+                client.chat.completions,
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                response_format={"type": "json_object"},
+                temperature=0
+            )
+            tracing.record_usage(response.usage)
+            content = response.choices[0].message.content
+        else:
+            content = _stream_health_completion(client, prompt, "verdicts", None, on_delta, model=model)
+        return json.loads(content)
+    
+    # Tầng nhanh phải trả verdict cho đủ mọi cặp, đúng tên đã hỏi
+    force_strong = ("streamed" if on_delta is not None
+                    else profile_complexity(conditions, len(unknown_pairs)))
+    data, model = model_router.run(
+        "health_verdicts", call, force_strong=force_strong, with_model=True,
+        validate=lambda result: validate_verdicts(
+            result, {(ingredient_norm, condition_norm) for ingredient_norm, _, condition_norm in unknown_pairs})
+    )
+    
+    # Chỉ nhận cặp được trả lời tường minh (tầng mạnh / stream không qua validate)
+    fresh = {}
+    unknown_set = set(unknown_pairs)
+    for item in data.get("verdicts", []):
+        if not isinstance(item, dict) or (verdict := compact_verdict(item)) is None:
+            continue
+        ingredient_norm = normalize(str(item.get("ingredient", "")))
+        condition_norm = normalize(str(item.get("condition", "")))
+        for kind in CONDITION_KINDS:
+            pair = (ingredient_norm, kind, condition_norm)
+            if pair in unknown_set:
+                fresh[pair] = dict(verdict)
+    
+    missing = len(unknown_pairs) - len(fresh)
+    if missing:
+        logging.warning(f"⚠️ Health verdicts: {model} bỏ sót {missing}/{len(unknown_pairs)} cặp")
+        tracing.count("verdict_missing_pairs", missing)
+    return fresh, model
+
+
+# ---------------------------------------------------------
+# BƯỚC 2.6: CHẾ ĐỘ GỘP - TRÍCH XUẤT + PHÂN TÍCH RỦI RO TRONG 1 LỆNH GỌI
+# ---------------------------------------------------------
+# "separate": 2 lệnh gọi nối tiếp (analyze_with_openai_strict -> analyze_health_risks)
+# "fused": 1 lệnh structured output (analyze_fused), nguyên liệu có ngay khi mảng
+#          "ingredients" stream xong -> mapping chạy song song với phần phân tích rủi ro
+# Chọn theo request ("analysis_mode"), mặc định ANALYSIS_MODE.
+# So sánh latency / token / độ khớp: benchmarks/compare_analysis_modes.py
+ANALYSIS_MODES = ("separate", "fused")
+DEFAULT_ANALYSIS_MODE = os.environ.get("ANALYSIS_MODE", "separate")
+
+# "ingredients" đứng đầu schema: model sinh theo thứ tự thuộc tính nên nguyên liệu stream xong trước
+SCAN_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "ingredients": {"type": "array", "items": {"type": "string"}},
+        "warnings": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "ingredient": {"type": "string"},
+                    "risk_score": {"type": "number"},
+                    "warning_type": {"type": "string",
+                                     "enum": ["allergy", "cross_reactivity", "medical_condition"]},
+                    "summary": {"type": "string"},
+                    "scientific_explanation": {"type": "string"},
+                    "potential_effects": {"type": "array", "items": {"type": "string"}},
+                    "recommendation": {"type": "string"}
+                },
+                "required": ["ingredient", "risk_score", "warning_type", "summary",
+                             "scientific_explanation", "potential_effects", "recommendation"],
+                "additionalProperties": False
+            }
+        },
+        "safe_ingredients": {"type": "array", "items": {"type": "string"}},
+        "overall_recommendation": {"type": "string"}
+    },
+    "required": ["ingredients", "warnings", "safe_ingredients", "overall_recommendation"],
+    "additionalProperties": False
+}
+
+
+def analyze_fused(ocr_doc: OcrDocument, health_profile: dict,
+                  on_ingredients=None, on_warning=None, on_delta=None, region=None) -> dict:
+    """
+    Trích xuất nguyên liệu + phân tích rủi ro sức khỏe trong 1 lệnh gpt-4o (json_schema strict)
+    Luôn stream để có nguyên liệu sớm; cảnh báo cục bộ (allergen_profile.py) được gộp như
+    analyze_health_risks.
+    Args:
+        on_ingredients: (optional) callback(ingredients: list) ngay khi mảng "ingredients" hoàn chỉnh
+        on_warning / on_delta: như analyze_health_risks_full
+        region: như analyze_with_openai_strict
+    Returns:
+        {"ingredients": [...], "health": {"warnings", "safe_ingredients", "overall_recommendation"}}
+    """
+    full_text = ocr_doc.extraction_text(region)
+    client = get_openai_client()
+    
+    medical_history = health_profile.get('medical_history', [])
+    allergies = health_profile.get('allergy', [])
+    medical_history_str = ", ".join(medical_history) if medical_history else "Không có"
+    allergies_str = ", ".join(allergies) if allergies else "Không có"
+    
+    prompt = f"""
+Bạn là hệ thống trích xuất dữ liệu OCR chính xác, đồng thời là BÁC SĨ DINH DƯỠNG và CHUYÊN GIA DỊ ỨNG THỰC PHẨM.
+
+## NHIỆM VỤ
+1. Trích xuất danh sách "Thành phần nguyên liệu" (ingredients) từ văn bản thô của bao bì sản phẩm.
+2. Xác định thành phần nào có thể GÂY HẠI cho người dùng dựa trên HỒ SƠ SỨC KHỎE của họ.
+
+## QUY TẮC TRÍCH XUẤT (ingredients)
+1. Tách riêng từng nguyên liệu. Dấu phẩy (,) là dấu hiệu ngắt quan trọng nhất.
+2. LOẠI BỎ hoàn toàn các con số phần trăm và định lượng (Ví dụ: "Bơ (1,9%)" -> Chỉ lấy "Bơ").
+3. LOẠI BỎ các mã phụ gia trong ngoặc nếu có thể tách rời.
+4. GIỮ NGUYÊN chính tả của văn bản gốc (kể cả lỗi sai).
+
+## HỒ SƠ SỨC KHỎE
+- Tiền sử bệnh lý: {medical_history_str}
+- Dị ứng đã biết: {allergies_str}
+
+{HEALTH_ANALYSIS_GUIDE}
+
+## QUY TẮC BẮT BUỘC
+- warnings[].ingredient, safe_ingredients: đúng tên như trong ingredients đã trích xuất
+- TOÀN BỘ nội dung PHẢI viết bằng TIẾNG VIỆT CÓ DẤU đầy đủ
+{RISK_SCORE_SCALE}
+- scientific_explanation: giải thích CHI TIẾT cơ chế sinh học, chuyên sâu nhưng dễ hiểu
+- Nếu KHÔNG có thành phần nào có vấn đề, trả về warnings = [] và overall_recommendation tích cực
+
+## VĂN BẢN INPUT
+'''
+{full_text}
+'''
+"""
+    
+    ingredients_parser = IncrementalArrayParser("ingredients")
+    warnings_parser = IncrementalArrayParser("warnings")
+    state = {"ingredients": None, "local_warnings": [], "local_keys": set()}
+    
+    def publish_ingredients(ingredients: list):
+        # Cảnh báo cục bộ có ngay khi biết nguyên liệu, trước phần phân tích của model
+        state["ingredients"] = ingredients
+        state["local_warnings"] = find_local_warnings(ingredients, health_profile)
+        state["local_keys"] = {normalize(w["ingredient"]) for w in state["local_warnings"]}
+        if on_ingredients is not None:
+            on_ingredients(ingredients)
+        if on_warning is not None:
+            for warning in state["local_warnings"]:
+                on_warning(warning)
+    
+    def consume(stream):
+        for chunk in stream:
+            if not chunk.choices:
+                tracing.record_usage(getattr(chunk, "usage", None))
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            if on_delta is not None:
+                on_delta(delta)
+            if state["ingredients"] is None:
+                ingredients_parser.feed(delta)
+                if ingredients_parser.finished and ingredients_parser.value is not None:
+                    publish_ingredients([str(i) for i in ingredients_parser.value])
+            for warning in warnings_parser.feed(delta):
+                if on_warning is not None and normalize(str(warning.get("ingredient", ""))) not in state["local_keys"]:
+                    on_warning(warning)
+    
+    # Lỗi được ném ra cho stage "fused" (các stage phụ thuộc dùng fallback + degraded_stages).
+    # Nguyên liệu / cảnh báo đã stream ra ngoài thì không nâng tầng được -> luôn dùng model mạnh
+    model_router.run("fused", lambda model: chat_scheduler.call(
+        client.chat.completions,
+        consume=consume,
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        response_format={
+            "type": "json_schema",
+            "json_schema": {"name": "scan_analysis", "strict": True, "schema": SCAN_ANALYSIS_SCHEMA}
+        },
+        temperature=0,
+        stream=True,
+        stream_options={"include_usage": True}
+    ), force_strong="streamed")
+    data = json.loads(warnings_parser.text)
+    if state["ingredients"] is None:
+        publish_ingredients([str(i) for i in data.get("ingredients", [])])
+    
+    local_keys = state["local_keys"]
+    return {
+        "ingredients": state["ingredients"],
+        "health": {
+            "warnings": merge_warnings(state["local_warnings"], data.get("warnings", [])),
+            "safe_ingredients": [i for i in data.get("safe_ingredients", []) if normalize(str(i)) not in local_keys],
+            "overall_recommendation": data.get("overall_recommendation", "")
         }
+    }
 
 
 # ---------------------------------------------------------
 # BƯỚC 3: SEMANTIC MAPPING RAG (Core Logic)
 # ---------------------------------------------------------
-def find_coordinates_semantic(target_phrases: list, ocr_word_list: list, threshold: float = 0.55) -> list:
+def _build_semantic_corpus(words: list, segments: list, max_window_size: int = 3) -> tuple[list, list]:
+    """
+    Tạo corpus n-gram (1..max_window_size từ) trong từng đoạn, bỏ trùng theo text
+    Returns:
+        (texts: các chuỗi không trùng, locations: locations[k] = mọi list chỉ số từ có text texts[k])
     """
-    Sử dụng OpenAI Embeddings API để tìm vị trí của từng nguyên liệu trong ảnh
+    positions = {}  # text chuẩn hóa -> vị trí trong texts
+    texts = []
+    locations = []
+    for window in range(1, max_window_size + 1):
+        for clean_indices in segments:
+            for i in range(len(clean_indices) - window + 1):
+                current_indices = clean_indices[i : i + window]
+                text_segment = " ".join([words[idx] for idx in current_indices])
+                key = normalize_text(text_segment)
+                pos = positions.get(key)
+                if pos is None:
+                    positions[key] = len(texts)
+                    texts.append(text_segment)
+                    locations.append([current_indices])
+                else:
+                    locations[pos].append(current_indices)
+    return texts, locations
+
+
+def find_coordinates_semantic(target_phrases: list, ocr_doc: OcrDocument, threshold: float = 0.55,
+                              use_lexical: bool = True, region=None) -> list:
+    """
+    Tìm vị trí của từng nguyên liệu trong ảnh
+    1. So khớp cục bộ (trigram + edit distance, xem lexical_matcher.py) cho các phrase chép nguyên văn
+    2. Chỉ những phrase chưa khớp đủ tin cậy mới dùng OpenAI Embeddings API
+    Mỗi phrase lấy top-k ứng viên rồi non-max suppression (box_mapping.py), nên nguyên liệu
+    xuất hiện nhiều lần trên bao bì có đủ các vị trí (bounding_box + other_occurrences)
+    region: (optional) mask vùng thành phần; corpus embedding chỉ lấy trong vùng (nguyên liệu được
+    trích xuất từ text của vùng), so khớp cục bộ vẫn chạy trên cả nhãn
     """
     import numpy as np
     from numpy.linalg import norm
     
+    # Cửa sổ n-gram chỉ ghép bên trong 1 paragraph (hoặc 1 dòng: MAPPING_WINDOW_SCOPE=line)
+    window_scope = os.environ.get("MAPPING_WINDOW_SCOPE", "paragraph")
+    segments = ocr_doc.segments(window_scope)
+    if not segments:
+        return []
+    
+    top_k_per_phrase = env_int("MAPPING_TOP_K", 8)
+    nms_overlap = float(os.environ.get("MAPPING_NMS_OVERLAP", 0.5))
+    rects = ocr_doc.rects()
+    
+    # vị trí phrase -> [(indices, matched_text, score)] (có thể chồng lấn, chưa NMS)
+    candidates = {}
+    
+    # 1. Lexical first-pass
+    if use_lexical:
+        min_score = float(os.environ.get('LEXICAL_MATCH_MIN_SCORE', 0.85))
+        for pos, found in match_phrases(target_phrases, ocr_doc.words, segments, min_score).items():
+            candidates[pos] = found[:top_k_per_phrase]
+        logging.info(f"🔤 Lexical match: {len(candidates)}/{len(target_phrases)} nguyên liệu")
+    
+    unresolved = [i for i in range(len(target_phrases)) if i not in candidates]
+    
+    # 2. Semantic fallback cho các phrase còn lại
+    if unresolved:
+        # Tạo Corpus từ OCR data (mỗi text chỉ embed 1 lần)
+        corpus_segments = (ocr_doc.segments(window_scope, region) if region is not None else None) or segments
+        corpus_texts, corpus_locations = _build_semantic_corpus(ocr_doc.words, corpus_segments)
+        
+        # Batch encode corpus và queries với OpenAI
+        all_texts = corpus_texts + [target_phrases[i] for i in unresolved]
+        all_embeddings = get_openai_embeddings(all_texts)
+        
+        corpus_embeddings = all_embeddings[:len(corpus_texts)]
+        query_embeddings = all_embeddings[len(corpus_texts):]
+        
+        # Batch cosine similarity calculation
+        normalized_corpus = corpus_embeddings / (norm(corpus_embeddings, axis=1, keepdims=True) + 1e-8)
+        normalized_queries = query_embeddings / (norm(query_embeddings, axis=1, keepdims=True) + 1e-8)
+        all_similarities = normalized_queries @ normalized_corpus.T
+        
+        for row, phrase_pos in enumerate(unresolved):
+            similarities = all_similarities[row]
+            found = [
+                (indices, corpus_texts[k], float(similarities[k]))
+                for k in top_k(similarities, top_k_per_phrase, threshold)
+                for indices in corpus_locations[k]
+            ]
+            if found:
+                candidates[phrase_pos] = found
+    
+    # Giữ thứ tự nguyên liệu ban đầu
     results = []
+    for i, phrase in enumerate(target_phrases):
+        if i not in candidates:
+            continue
+        found = candidates[i]
+        windows = [indices for indices, _, _ in found]
+        scores = np.array([score for _, _, score in found], dtype=np.float32)
+        window_rects = union_rects(rects, windows)
+        # Batch scan: box trên các ảnh khác nhau không loại trừ nhau
+        groups = None if ocr_doc.image_index is None else ocr_doc.image_index[[w[0] for w in windows]]
+        keep = non_max_suppression(window_rects, scores, nms_overlap, groups)
+        
+        occurrences = []
+        for k in keep:
+            indices, matched_text, score = found[k]
+            occurrence = {
+                "matched_text": matched_text,
+                "confidence": round(score, 3),
+                "bounding_box": rect_to_polygon(window_rects[k])
+            }
+            # Batch scan: cho client biết box nằm trên ảnh nào
+            if ocr_doc.image_index is not None:
+                occurrence["image_index"] = ocr_doc.image_of(indices[0])
+            occurrences.append(occurrence)
+        
+        mapping = {"label": phrase, **occurrences[0]}
+        if len(occurrences) > 1:
+            mapping["other_occurrences"] = occurrences[1:]
+        results.append(mapping)
+    
+    return results
+
+
+# ---------------------------------------------------------
+# BƯỚC 4: PIPELINE (Stage DAG) + RISK SUMMARY
+# ---------------------------------------------------------
+def build_scan_stages(image_content: bytes, health_profile: dict, threshold: float,
+                      on_warning=None, on_delta=None, ocr_func=None, analysis_mode: str = None) -> list:
+    """
+    Khai báo pipeline scan dưới dạng DAG:
+        ocr -> region -> ingredients -> health
+                                     -> mappings
+    region: vùng thành phần trên nhãn (cục bộ, ingredient_region.py), chỉ text trong vùng được
+    gửi cho OpenAI; không xác định được vùng -> toàn bộ text. Danh sách trong vùng tách được
+    cục bộ với độ tin cậy cao (ingredient_parser.py) -> bỏ qua model trích xuất.
+    health và mappings chỉ phụ thuộc ingredients + ocr nên chạy song song.
+    analysis_mode="fused": stage "fused" (analyze_fused) chạy sau ocr; ingredients xong ngay
+    khi mảng nguyên liệu stream xong, health lấy phần phân tích rủi ro khi fused xong.
+    Timeout từng stage cấu hình qua STAGE_TIMEOUT_<NAME> (giây).
+    on_warning / on_delta: callback streaming, chuyển tiếp cho analyze_health_risks / analyze_fused
+    ocr_func: (optional) thay thế bước OCR mặc định (VD: batch nhiều ảnh)
+    """
+    def timeout(name: str, default: int) -> int:
+        return env_int(f"STAGE_TIMEOUT_{name.upper()}", default)
+
+    def run_ocr(r):
+        logging.info("🔍 Bắt đầu OCR...")
+        if ocr_func is not None:
+            return ocr_func()
+        return get_ocr_data(image_content)
+
+    def run_region(r):
+        if not r["ocr"]:
+            return None
+        region = detect_ingredient_region(r["ocr"])
+        tracing.count(f"region_{region.reason}")
+        if region.mask is not None:
+            logging.info(f"📐 Vùng thành phần: {region.coverage:.0%} số từ (tin cậy {region.confidence:.2f})")
+        return region.mask
+
+    def run_extraction(r):
+        if not r["ocr"]:
+            return []
+        local = extract_ingredients_local(r["ocr"], r["region"])
+        if local is not None:
+            return local
+        logging.info("🤖 Đang phân tích với AI...")
+        # Retry OpenAI không vượt quá timeout của stage (kết quả sau đó bị bỏ qua)
+        with request_scope(deadline_sec=timeout("ingredients", 90)):
+            return analyze_with_openai_strict(r["ocr"], r["region"])
+
+    def run_health(r):
+        if not r["ingredients"]:
+            return {"warnings": [], "safe_ingredients": [], "overall_recommendation": ""}
+        logging.info("🏥 Đang phân tích rủi ro sức khỏe...")
+        with request_scope(deadline_sec=timeout("health", 120)):
+            return analyze_health_risks(r["ingredients"], health_profile,
+                                        on_warning=on_warning, on_delta=on_delta)
+
+    def run_mapping(r):
+        if not r["ingredients"]:
+            return []
+        logging.info("🔗 Đang mapping vị trí...")
+        with request_scope(deadline_sec=timeout("mappings", 45)):
+            return find_coordinates_semantic(r["ingredients"], r["ocr"], threshold, region=r["region"])
+
+    def health_fallback(r, error):
+        return {
+            "warnings": [],
+            "safe_ingredients": r.get("ingredients", []),
+            "overall_recommendation": f"Không thể phân tích rủi ro sức khỏe: {str(error)}"
+        }
+
+    if (analysis_mode or DEFAULT_ANALYSIS_MODE) == "fused":
+        ingredients_ready = Future()
+
+        def publish(ingredients: list):
+            if not ingredients_ready.done():
+                ingredients_ready.set_result(ingredients)
+
+        def run_fused(r):
+            if not r["ocr"]:
+                publish([])
+                return None
+            local = extract_ingredients_local(r["ocr"], r["region"])
+            if local is not None:
+                # Nguyên liệu đã có -> chỉ còn phần phân tích rủi ro (như chế độ separate)
+                publish(local)
+                with request_scope(deadline_sec=timeout("health", 120)):
+                    return {"ingredients": local,
+                            "health": analyze_health_risks(local, health_profile,
+                                                           on_warning=on_warning, on_delta=on_delta)}
+            logging.info("🤖 Đang phân tích (trích xuất + rủi ro sức khỏe, 1 lệnh gọi)...")
+            try:
+                with request_scope(deadline_sec=timeout("fused", 150)):
+                    return analyze_fused(r["ocr"], health_profile, on_ingredients=publish,
+                                         on_warning=on_warning, on_delta=on_delta, region=r["region"])
+            except Exception as e:
+                if not ingredients_ready.done():
+                    ingredients_ready.set_exception(e)
+                raise
+
+        def run_fused_ingredients(r):
+            return ingredients_ready.result(timeout=timeout("ingredients", 90))
+
+        def run_fused_health(r):
+            if not r["ingredients"]:
+                return {"warnings": [], "safe_ingredients": [], "overall_recommendation": ""}
+            if r["fused"] is None:
+                raise RuntimeError("Phân tích gộp không thành công")
+            return r["fused"]["health"]
+
+        return [
+            Stage("ocr", run_ocr, timeout_sec=timeout("ocr", 60)),
+            Stage("region", run_region, deps=["ocr"],
+                  timeout_sec=timeout("region", 5), fallback=lambda r, e: None),
+            Stage("fused", run_fused, deps=["ocr", "region"],
+                  timeout_sec=timeout("fused", 150), fallback=lambda r, e: None),
+            Stage("ingredients", run_fused_ingredients, deps=["ocr"],
+                  timeout_sec=timeout("ingredients", 90), fallback=lambda r, e: []),
+            Stage("health", run_fused_health, deps=["fused", "ingredients"],
+                  timeout_sec=timeout("health", 120), fallback=health_fallback),
+            Stage("mappings", run_mapping, deps=["ingredients", "ocr", "region"],
+                  timeout_sec=timeout("mappings", 45), fallback=lambda r, e: []),
+        ]
+
+    return [
+        Stage("ocr", run_ocr, timeout_sec=timeout("ocr", 60)),
+        Stage("region", run_region, deps=["ocr"],
+              timeout_sec=timeout("region", 5), fallback=lambda r, e: None),
+        Stage("ingredients", run_extraction, deps=["ocr", "region"],
+              timeout_sec=timeout("ingredients", 90), fallback=lambda r, e: []),
+        Stage("health", run_health, deps=["ingredients"],
+              timeout_sec=timeout("health", 120), fallback=health_fallback),
+        Stage("mappings", run_mapping, deps=["ingredients", "ocr", "region"],
+              timeout_sec=timeout("mappings", 45), fallback=lambda r, e: []),
+    ]
+
+
+# Gộp scan trùng đang chạy (bấm scan 2 lần, app retry khi mạng chập chờn): chỉ 1 lượt
+# gọi Vision / OpenAI, các request còn lại dùng chung kết quả
+SCAN_COALESCING = env_flag("SCAN_COALESCING", True)
+_scan_flights = SingleFlight("scan_coalescing")
+
+
+def scan_coalescing_key(image_content: bytes, health_profile: dict, threshold: float,
+                        analysis_mode: str = None) -> str:
+    """(hash ảnh, hồ sơ sức khỏe đã chuẩn hóa, threshold, chế độ phân tích)"""
+    return (f"{ocr_cache.content_hash(image_content)}:{profile_hash(health_profile)}:"
+            f"{round(float(threshold), 4)}:{analysis_mode or DEFAULT_ANALYSIS_MODE}")
+
+
+def run_scan_stages(image_content: bytes, health_profile: dict, threshold: float,
+                    on_stage_done=None, **stage_kwargs) -> tuple[dict, dict]:
+    """
+    run_stages(build_scan_stages(...)) có gộp request trùng (SCAN_COALESCING)
+    Request dùng chung kết quả nhận lại on_stage_done của từng stage theo thứ tự hoàn thành
+    của lượt chạy gốc. Kết quả dùng chung chỉ được đọc (mỗi request tự dựng response).
+    Raises:
+        FlightTimeout: lượt chạy gốc chưa xong khi hết deadline của request này
+    """
+    def compute():
+        stages = build_scan_stages(image_content, health_profile, threshold, **stage_kwargs)
+        return run_stages(stages, on_stage_done=on_stage_done)
+
+    if not SCAN_COALESCING:
+        return compute()
+    key = scan_coalescing_key(image_content, health_profile, threshold, stage_kwargs.get("analysis_mode"))
+    # Chờ lượt chạy gốc tối đa tới deadline của chính request này
+    wait_sec = remaining_deadline()
+    (results, stage_report), shared = _scan_flights.do(
+        key, compute, timeout=OPENAI_REQUEST_DEADLINE_SEC if wait_sec is None else wait_sec)
+    if shared:
+        logging.info(f"♻️ Scan trùng đang chạy, dùng chung kết quả ({key[:12]})")
+        if on_stage_done is not None:
+            for name, info in stage_report.items():
+                on_stage_done(name, results[name], info["status"])
+    return results, stage_report
+
+
+def build_risk_summary(warnings: list, overall_recommendation: str) -> dict:
+    """Tính toán risk summary dựa trên risk_score của các cảnh báo"""
+    # Phân loại theo risk_score
+    critical_risk_count = len([w for w in warnings if w.get("risk_score", 0) >= 0.8])  # 0.8-1.0
+    high_risk_count = len([w for w in warnings if 0.6 <= w.get("risk_score", 0) < 0.8])  # 0.6-0.79
+    medium_risk_count = len([w for w in warnings if 0.4 <= w.get("risk_score", 0) < 0.6])  # 0.4-0.59
+    low_risk_count = len([w for w in warnings if 0.2 <= w.get("risk_score", 0) < 0.4])  # 0.2-0.39
+    very_low_risk_count = len([w for w in warnings if w.get("risk_score", 0) < 0.2])  # 0-0.19
     
-    # Tạo Corpus từ OCR data
-    corpus_texts = []
-    corpus_indices = []
+    # Tính max và avg risk score
+    risk_scores = [w.get("risk_score", 0) for w in warnings]
+    max_risk_score = max(risk_scores) if risk_scores else 0
+    avg_risk_score = sum(risk_scores) / len(risk_scores) if risk_scores else 0
     
-    clean_indices = [i for i, w in enumerate(ocr_word_list) if not w['is_noise']]
-    max_window_size = 3  # Reduced from 5 for better performance
+    return {
+        "max_risk_score": round(max_risk_score, 2),
+        "avg_risk_score": round(avg_risk_score, 2),
+        "critical_risk_count": critical_risk_count,
+        "high_risk_count": high_risk_count,
+        "medium_risk_count": medium_risk_count,
+        "low_risk_count": low_risk_count,
+        "very_low_risk_count": very_low_risk_count,
+        "total_warnings": len(warnings),
+        "overall_recommendation": overall_recommendation
+    }
+
+
+def build_scan_response(results: dict, stage_report: dict, health_profile: dict, threshold: float) -> dict:
+    """
+    Tạo response body của smart_ocr_rag từ kết quả các stage
+    """
+    ocr_data = results["ocr"]
+    ingredients = results["ingredients"]
     
-    for window in range(1, max_window_size + 1):
-        for i in range(len(clean_indices) - window + 1):
-            current_indices = clean_indices[i : i + window]
-            text_segment = " ".join([ocr_word_list[idx]['text'] for idx in current_indices])
-            corpus_texts.append(text_segment)
-            corpus_indices.append(current_indices)
+    if not ocr_data:
+        return {
+            "success": False,
+            "error": "Không tìm thấy text trong ảnh"
+        }
     
-    if not corpus_texts:
-        return []
+    # Báo cho client biết stage nào phải dùng kết quả dự phòng
+    degraded_stages = [name for name, info in stage_report.items() if info["status"] != "ok"]
+    
+    if not ingredients:
+        # Trả về raw OCR nếu không phân tích được
+        raw_text = ocr_data.clean_text()
+        response_data = {
+            "success": True,
+            "ingredients": [],
+            "health_warnings": [],
+            "safe_ingredients": [],
+            "risk_summary": build_risk_summary([], "Không tìm thấy nguyên liệu để phân tích."),
+            "mappings": [],
+            "raw_text": raw_text,
+            "message": "Không tìm thấy nguyên liệu. Trả về raw OCR text.",
+            "user_profile": health_profile
+        }
+        if "ingredients" in degraded_stages:
+            # Lỗi dịch vụ AI (quá tải / hết deadline), không phải ảnh không có nguyên liệu
+            response_data["message"] = "Không thể trích xuất nguyên liệu lúc này, vui lòng thử lại. Trả về raw OCR text."
+            response_data["degraded_stages"] = degraded_stages
+            response_data["retryable"] = True
+        return response_data
+    
+    health_analysis = results["health"]
+    mappings = results["mappings"]
+    warnings = health_analysis.get("warnings", [])
+    
+    response_data = {
+        "success": True,
+        "ingredients": ingredients,
+        "health_warnings": warnings,
+        "safe_ingredients": health_analysis.get("safe_ingredients", []),
+        "risk_summary": build_risk_summary(warnings, health_analysis.get("overall_recommendation", "")),
+        "mappings": mappings,
+        "total_ocr_words": len(ocr_data),
+        "matched_count": len(mappings),
+        "threshold_used": threshold,
+        "user_profile": {
+            "allergies_checked": health_profile.get("allergy", []),
+            "conditions_checked": health_profile.get("medical_history", [])
+        }
+    }
+    
+    if health_analysis.get("degraded") and "health" not in degraded_stages:
+        degraded_stages.append("health")
+    if degraded_stages:
+        response_data["degraded_stages"] = degraded_stages
+    
+    return response_data
+
+
+def serialize_scan_response(response_data: dict, debug_timings: bool = False) -> str:
+    """
+    JSON body của response scan (đo thời gian vào span "serialization")
+    debug_timings: thêm block debug_timings từ trace của request
+    """
+    with tracing.span("serialization"):
+        body = json.dumps(response_data, ensure_ascii=False)
+    trace = tracing.current_trace()
+    if debug_timings and trace is not None:
+        # Serialize lại kèm debug_timings (chỉ khi client yêu cầu)
+        body = json.dumps({**response_data, "debug_timings": trace.to_dict()}, ensure_ascii=False)
+    return body
+
+
+# ---------------------------------------------------------
+# ĐỌC ẢNH TỪ REQUEST
+# ---------------------------------------------------------
+# Giới hạn kích thước 1 ảnh (bytes), kiểm tra qua Content-Length trước khi đọc body
+MAX_IMAGE_BYTES = env_int("MAX_IMAGE_BYTES", 10 * 1024 * 1024)
+# Phần dư cho các field JSON / form ngoài ảnh
+REQUEST_OVERHEAD_BYTES = 256 * 1024
+_RAW_READ_CHUNK = 256 * 1024
+
+
+class ImageTooLarge(ValueError):
+    """Ảnh / request vượt MAX_IMAGE_BYTES -> 413"""
+
+
+def _too_large_response(e: ImageTooLarge) -> https_fn.Response:
+    return https_fn.Response(
+        json.dumps({"error": str(e), "max_image_bytes": MAX_IMAGE_BYTES}),
+        status=413,
+        headers={"Content-Type": "application/json"}
+    )
+
+
+def is_raw_image_request(req: https_fn.Request) -> bool:
+    """Body là bytes ảnh thô (Content-Type: image/* hoặc application/octet-stream)"""
+    mimetype = req.mimetype or ""
+    return mimetype.startswith("image/") or mimetype == "application/octet-stream"
+
+
+def ensure_request_size(req: https_fn.Request, max_images: int = 1):
+    """
+    Từ chối sớm theo Content-Length, trước khi Flask đọc / parse body
+    (base64 lớn hơn ~4/3 so với ảnh gốc)
+    Raises:
+        ImageTooLarge
+    """
+    if req.content_length is None:
+        return
+    if is_raw_image_request(req):
+        limit = MAX_IMAGE_BYTES
+    else:
+        limit = max_images * (MAX_IMAGE_BYTES * 4 // 3 + 4) + REQUEST_OVERHEAD_BYTES
+    if req.content_length > limit:
+        raise ImageTooLarge(f"Request quá lớn ({req.content_length} bytes, tối đa {limit})")
+
+
+def read_raw_image(req: https_fn.Request) -> bytes:
+    """
+    Đọc body nhị phân 1 lần (không cache trong request, không decode base64)
+    Body chunked (không có Content-Length) được đọc từng phần và dừng ngay khi vượt giới hạn.
+    """
+    if req.content_length is not None:
+        ensure_request_size(req)
+        return req.get_data(cache=False)
+    chunks, total = [], 0
+    while chunk := req.stream.read(_RAW_READ_CHUNK):
+        total += len(chunk)
+        if total > MAX_IMAGE_BYTES:
+            raise ImageTooLarge(f"Ảnh vượt quá {MAX_IMAGE_BYTES} bytes")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def read_upload(file) -> bytes:
+    """Đọc file multipart, tối đa MAX_IMAGE_BYTES (không đọc hết file quá lớn)"""
+    content = file.stream.read(MAX_IMAGE_BYTES + 1)
+    if len(content) > MAX_IMAGE_BYTES:
+        raise ImageTooLarge(f"Ảnh '{file.filename}' vượt quá {MAX_IMAGE_BYTES} bytes")
+    return content
+
+
+def decode_base64_image(image_base64: str) -> bytes:
+    """Decode base64 (bỏ prefix data:image/...;base64, nếu có), kiểm tra kích thước trước khi decode"""
+    if ',' in image_base64:
+        image_base64 = image_base64.split(',', 1)[1]
+    if len(image_base64) // 4 * 3 > MAX_IMAGE_BYTES:
+        raise ImageTooLarge(f"Ảnh vượt quá {MAX_IMAGE_BYTES} bytes")
+    return base64.b64decode(image_base64)
+
+
+def raw_request_param(req: https_fn.Request, name: str):
+    """Tham số đi kèm body ảnh thô: query ?name=... hoặc header X-Name (VD: health_profile -> X-Health-Profile)"""
+    value = req.args.get(name)
+    if value is None:
+        value = req.headers.get("X-" + "-".join(part.capitalize() for part in name.split("_")))
+    return value
+
+
+# ---------------------------------------------------------
+# STREAMING (NDJSON / Server-Sent Events)
+# ---------------------------------------------------------
+def _is_truthy(value) -> bool:
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_stream_format(req: https_fn.Request, stream_param) -> str | None:
+    """
+    Xác định client có yêu cầu streaming không
+    Returns:
+        "sse", "ndjson" hoặc None (response JSON thường)
+    """
+    accept = req.headers.get('Accept', '')
+    param = str(stream_param).strip().lower() if stream_param is not None else ""
+    if param == "sse" or 'text/event-stream' in accept:
+        return "sse"
+    if param == "ndjson" or _is_truthy(param) or 'application/x-ndjson' in accept:
+        return "ndjson"
+    return None
+
+
+def format_stream_event(event: str, data, stream_format: str) -> str:
+    payload = json.dumps(data, ensure_ascii=False)
+    if stream_format == "sse":
+        return f"event: {event}\ndata: {payload}\n\n"
+    return json.dumps({"event": event, "data": data}, ensure_ascii=False) + "\n"
+
+
+def stream_scan_response(image_content: bytes, health_profile: dict, threshold: float,
+                         stream_format: str, stream_tokens: bool = False,
+                         debug_timings: bool = False, analysis_mode: str = None) -> https_fn.Response:
+    """
+    Chạy pipeline ở thread nền và stream từng kết quả ngay khi có:
+    ocr_done -> ingredients -> mappings / health_warning (xen kẽ theo thứ tự hoàn thành)
+    -> risk_summary -> done
+    health_warning / health_delta đến trước event ingredients (chế độ fused) được giữ lại
+    và gửi ngay sau ingredients.
+    Trace của request được ghi log khi stream kết thúc (debug_timings: kèm vào event done)
+    """
+    trace = tracing.current_trace()
+    events = queue.Queue()
+    # streamed_warnings: nguyên liệu (chuẩn hóa) đã gửi health_warning
+    state = {"ingredients": [], "streamed_warnings": set(), "health_closed": False,
+             "ingredients_sent": False, "pending": []}
+    state_lock = threading.Lock()
+    
+    def emit(event: str, data):
+        events.put((event, data))
+    
+    def emit_health(event: str, data):
+        # Gọi khi đang giữ state_lock
+        if state["ingredients_sent"]:
+            emit(event, data)
+        else:
+            state["pending"].append((event, data))
     
-    # Batch encode corpus và queries với OpenAI
-    all_texts = corpus_texts + target_phrases
-    all_embeddings = get_openai_embeddings(all_texts)
+    def on_warning(warning: dict):
+        with state_lock:
+            # Stage health đã xong/timeout -> bỏ qua token đến muộn
+            if state["health_closed"]:
+                return
+            state["streamed_warnings"].add(normalize(str(warning.get("ingredient", ""))))
+            emit_health("health_warning", warning)
     
-    corpus_embeddings = np.array(all_embeddings[:len(corpus_texts)])
-    query_embeddings = np.array(all_embeddings[len(corpus_texts):])
+    def on_delta(text: str):
+        with state_lock:
+            if not state["health_closed"]:
+                emit_health("health_delta", {"text": text})
     
-    # Batch cosine similarity calculation
-    # Normalize embeddings
-    corpus_norms = norm(corpus_embeddings, axis=1, keepdims=True)
-    query_norms = norm(query_embeddings, axis=1, keepdims=True)
+    def on_stage_done(name: str, value, status: str):
+        if name == "ocr":
+            emit("ocr_done", {"total_ocr_words": len(value)})
+        elif name == "ingredients":
+            state["ingredients"] = value
+            with state_lock:
+                emit("ingredients", {"ingredients": value})
+                for item in state["pending"]:
+                    emit(*item)
+                state["ingredients_sent"] = True
+                state["pending"] = []
+        elif name == "mappings" and state["ingredients"]:
+            emit("mappings", {"mappings": value, "matched_count": len(value)})
+        elif name == "health" and state["ingredients"]:
+            with state_lock:
+                state["health_closed"] = True
+                already_streamed = set(state["streamed_warnings"])
+            warnings = value.get("warnings", [])
+            # Gửi bù các cảnh báo chưa được stream (VD: khi dùng kết quả fallback); theo nguyên liệu
+            # vì merge_warnings gộp trùng và đổi thứ tự so với lúc stream
+            for warning in warnings:
+                if normalize(str(warning.get("ingredient", ""))) not in already_streamed:
+                    emit("health_warning", warning)
+            emit("risk_summary", {
+                "risk_summary": build_risk_summary(warnings, value.get("overall_recommendation", "")),
+                "safe_ingredients": value.get("safe_ingredients", [])
+            })
     
-    normalized_corpus = corpus_embeddings / (corpus_norms + 1e-8)
-    normalized_queries = query_embeddings / (query_norms + 1e-8)
+    def run_pipeline():
+        try:
+            # Stream chỉ đóng sau khi các lệnh ghi cache L2 của pipeline đã xong (request vẫn đang xử lý)
+            with l2_write_scope():
+                results, stage_report = run_scan_stages(
+                    image_content, health_profile, threshold,
+                    on_stage_done=on_stage_done,
+                    on_warning=on_warning,
+                    on_delta=on_delta if stream_tokens else None,
+                    analysis_mode=analysis_mode
+                )
+                response_data = build_scan_response(results, stage_report, health_profile, threshold)
+                if debug_timings and trace is not None:
+                    response_data["debug_timings"] = trace.to_dict()
+                emit("done", response_data)
+        except Exception as e:
+            logging.error(f"❌ Error (stream): {str(e)}")
+            emit("error", {"success": False, "error": str(e)})
+        finally:
+            events.put(None)
+            if trace is not None:
+                trace.log(status=200, streamed=True)
     
-    # Compute all similarities at once
-    all_similarities = np.dot(normalized_queries, normalized_corpus.T)
+    # Thread nền chạy trong copy của context -> giữ request trace
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(run_pipeline,), daemon=True).start()
     
-    # Process each query
-    for i, phrase in enumerate(target_phrases):
-        similarities = all_similarities[i]
-        best_idx = np.argmax(similarities)
-        best_score = float(similarities[best_idx])
-        
-        if best_score >= threshold:
-            matched_text = corpus_texts[best_idx]
-            matched_raw_indices = corpus_indices[best_idx]
-            
-            # Lấy bounding box
-            matched_boxes = [ocr_word_list[idx]['box'] for idx in matched_raw_indices]
-            
-            all_x = [pt[0] for box in matched_boxes for pt in box]
-            all_y = [pt[1] for box in matched_boxes for pt in box]
-            
-            final_box = [
-                [min(all_x), min(all_y)], 
-                [max(all_x), min(all_y)], 
-                [max(all_x), max(all_y)], 
-                [min(all_x), max(all_y)]
-            ]
-            
-            results.append({
-                "label": phrase,
-                "matched_text": matched_text,
-                "confidence": round(best_score, 3),
-                "bounding_box": final_box
-            })
+    def generate():
+        while True:
+            item = events.get()
+            if item is None:
+                return
+            yield format_stream_event(item[0], item[1], stream_format)
     
-    return results
+    content_type = "text/event-stream" if stream_format == "sse" else "application/x-ndjson"
+    return https_fn.Response(
+        generate(),
+        status=200,
+        headers={
+            "Content-Type": f"{content_type}; charset=utf-8",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
 
 
 # ---------------------------------------------------------
@@ -356,8 +1636,12 @@ def find_coordinates_semantic(target_phrases: list, ocr_word_list: list, thresho
     memory=options.MemoryOption.GB_1,  # Reduced from GB_2 since no local model
     timeout_sec=300,  # 5 phút timeout
     region="asia-southeast1",  # Region Singapore
-    min_instances=1  # Keep 1 instance warm to eliminate cold start
+    min_instances=1,  # Keep 1 instance warm to eliminate cold start
+    concurrency=SCAN_CONCURRENCY,  # Nhiều scan / instance (xem SCAN_CONCURRENCY)
+    cpu=1  # concurrency > 1 cần tối thiểu 1 vCPU
 )
+@tracing.traced("smart_ocr_rag")
+@l2_write_scope()
 def smart_ocr_rag(req: https_fn.Request) -> https_fn.Response:
     """
     Firebase HTTP Function để xử lý OCR + RAG + Health Analysis
@@ -376,6 +1660,26 @@ def smart_ocr_rag(req: https_fn.Request) -> https_fn.Response:
     - image: file ảnh
     - health_profile: JSON string của health profile
     - threshold: optional
+    
+    Hoặc body là bytes ảnh thô (Content-Type: image/* hoặc application/octet-stream, không
+    base64): health_profile (JSON string), threshold, stream... qua query string hoặc header
+    X-Health-Profile, X-Threshold...
+    
+    Ảnh lớn hơn MAX_IMAGE_BYTES (mặc định 10MB) -> 413, kiểm tra trước khi đọc body.
+    
+    Streaming (opt-in): "stream": "ndjson" | "sse" (body, form hoặc query ?stream=),
+    hoặc header Accept: application/x-ndjson / text/event-stream.
+    Các event lần lượt: ocr_done, ingredients, mappings, health_warning (từng cảnh báo),
+    risk_summary, done (response đầy đủ như chế độ thường) hoặc error.
+    "stream_tokens": true -> gửi thêm event health_delta chứa token thô của gpt-4o.
+    
+    "analysis_mode": "separate" (mặc định, ANALYSIS_MODE) | "fused" (body, form, query;
+    ảnh thô: thêm header X-Analysis-Mode): "fused" trích xuất nguyên liệu + phân tích rủi ro trong
+    1 lệnh gọi gpt-4o (xem analyze_fused).
+    
+    Đo đạc: response luôn có header Server-Timing (thời gian từng bước);
+    "debug_timings": true (body, form hoặc query) -> thêm block debug_timings
+    (thời gian, token OpenAI, số chuỗi embed, tỉ lệ cache hit) vào body.
     """
     
     # Chỉ chấp nhận POST
@@ -387,15 +1691,44 @@ def smart_ocr_rag(req: https_fn.Request) -> https_fn.Response:
         )
     
     try:
+        decode_started = time.perf_counter()
         image_content = None
         threshold = 0.6
         health_profile = None
+        stream_param = req.args.get('stream')
+        stream_tokens = False
+        debug_timings = _is_truthy(req.args.get('debug_timings'))
+        analysis_mode = req.args.get('analysis_mode')
+        ensure_request_size(req)
+        
+        # Body là ảnh thô: bytes đi thẳng tới tiền xử lý / Vision, không decode base64
+        if is_raw_image_request(req):
+            image_content = read_raw_image(req)
+            threshold = float(raw_request_param(req, 'threshold') or 0.6)
+            stream_param = raw_request_param(req, 'stream')
+            stream_tokens = _is_truthy(raw_request_param(req, 'stream_tokens'))
+            debug_timings = debug_timings or _is_truthy(raw_request_param(req, 'debug_timings'))
+            analysis_mode = raw_request_param(req, 'analysis_mode')
+            
+            health_profile_str = raw_request_param(req, 'health_profile')
+            if health_profile_str:
+                try:
+                    health_profile = json.loads(health_profile_str)
+                except json.JSONDecodeError:
+                    return https_fn.Response(
+                        json.dumps({"error": "Invalid health_profile JSON format"}),
+                        status=400,
+                        headers={"Content-Type": "application/json"}
+                    )
         
         # Xử lý multipart/form-data (upload file trực tiếp)
-        if req.files and 'image' in req.files:
-            file = req.files['image']
-            image_content = file.read()
+        elif req.files and 'image' in req.files:
+            image_content = read_upload(req.files['image'])
             threshold = float(req.form.get('threshold', 0.6))
+            stream_param = req.form.get('stream', stream_param)
+            stream_tokens = _is_truthy(req.form.get('stream_tokens'))
+            debug_timings = debug_timings or _is_truthy(req.form.get('debug_timings'))
+            analysis_mode = req.form.get('analysis_mode', analysis_mode)
             
             # Parse health_profile từ form data
             health_profile_str = req.form.get('health_profile')
@@ -420,19 +1753,18 @@ def smart_ocr_rag(req: https_fn.Request) -> https_fn.Response:
                     headers={"Content-Type": "application/json"}
                 )
             
-            # Decode base64
-            image_base64 = data['image_base64']
-            # Xóa prefix nếu có (data:image/png;base64,...)
-            if ',' in image_base64:
-                image_base64 = image_base64.split(',')[1]
-            
-            image_content = base64.b64decode(image_base64)
+            # Decode base64 (xóa prefix data:image/png;base64,... nếu có)
+            image_content = decode_base64_image(data['image_base64'])
             threshold = float(data.get('threshold', 0.6))
             health_profile = data.get('health_profile')
+            stream_param = data.get('stream', stream_param)
+            stream_tokens = _is_truthy(data.get('stream_tokens'))
+            debug_timings = debug_timings or _is_truthy(data.get('debug_timings'))
+            analysis_mode = data.get('analysis_mode', analysis_mode)
         
         else:
             return https_fn.Response(
-                json.dumps({"error": "Invalid request format. Use JSON or multipart/form-data"}),
+                json.dumps({"error": "Invalid request format. Use JSON, multipart/form-data or a raw image body"}),
                 status=400,
                 headers={"Content-Type": "application/json"}
             )
@@ -457,113 +1789,197 @@ def smart_ocr_rag(req: https_fn.Request) -> https_fn.Response:
         if not isinstance(health_profile.get('allergy'), list):
             health_profile['allergy'] = []
         
+        analysis_mode = analysis_mode or DEFAULT_ANALYSIS_MODE
+        if analysis_mode not in ANALYSIS_MODES:
+            return https_fn.Response(
+                json.dumps({"error": f"Invalid analysis_mode. Use one of: {', '.join(ANALYSIS_MODES)}"}),
+                status=400,
+                headers={"Content-Type": "application/json"}
+            )
+        
+        stream_format = get_stream_format(req, stream_param)
+        tracing.add_span("decode", (time.perf_counter() - decode_started) * 1000)
+        
         # ===== XỬ LÝ CHÍNH =====
+        # OCR -> trích xuất nguyên liệu -> (phân tích sức khỏe || mapping vị trí)
+        # Scan tương tác: ưu tiên cao nhất ở hàng chờ OpenAI, retry trong deadline của request
+        # Cùng ảnh + hồ sơ + threshold đang được scan -> chờ và dùng chung kết quả
+        with request_scope(deadline_sec=OPENAI_REQUEST_DEADLINE_SEC, priority=INTERACTIVE):
+            if stream_format:
+                return stream_scan_response(image_content, health_profile, threshold,
+                                            stream_format, stream_tokens=stream_tokens,
+                                            debug_timings=debug_timings, analysis_mode=analysis_mode)
+            
+            results, stage_report = run_scan_stages(image_content, health_profile, threshold,
+                                                    analysis_mode=analysis_mode)
+        response_data = build_scan_response(results, stage_report, health_profile, threshold)
         
-        # 1. OCR
-        logging.info("🔍 Bắt đầu OCR...")
-        ocr_data = get_ocr_data(image_content)
+        if response_data.get("success") and response_data.get("ingredients"):
+            logging.info(f"✅ Hoàn thành! Tìm thấy {len(response_data['ingredients'])} nguyên liệu, "
+                         f"{len(response_data['health_warnings'])} cảnh báo")
+        
+        return https_fn.Response(
+            serialize_scan_response(response_data, debug_timings),
+            status=200,
+            headers={"Content-Type": "application/json; charset=utf-8"}
+        )
+        
+    except ImageTooLarge as e:
+        return _too_large_response(e)
+    except FlightTimeout as e:
+        logging.error(f"❌ Timeout: {str(e)}")
+        return https_fn.Response(
+            json.dumps({"success": False, "error": str(e), "retryable": True}),
+            status=504,
+            headers={"Content-Type": "application/json"}
+        )
+    except Exception as e:
+        logging.error(f"❌ Error: {str(e)}")
+        return https_fn.Response(
+            json.dumps({"success": False, "error": str(e)}),
+            status=500,
+            headers={"Content-Type": "application/json"}
+        )
+
+
+# ---------------------------------------------------------
+# BATCH SCAN ENDPOINT (nhiều ảnh của cùng 1 sản phẩm)
+# ---------------------------------------------------------
+@https_fn.on_request(
+    cors=options.CorsOptions(
+        cors_origins=["*"],
+        cors_methods=["GET", "POST"]
+    ),
+    memory=options.MemoryOption.GB_1,
+    timeout_sec=300,
+    region="asia-southeast1",
+    concurrency=BATCH_SCAN_CONCURRENCY,  # Batch tới 10 ảnh / request: ít request song song hơn
+    cpu=1
+)
+@tracing.traced("smart_ocr_rag_batch")
+@l2_write_scope()
+def smart_ocr_rag_batch(req: https_fn.Request) -> https_fn.Response:
+    """
+    Quét nhiều ảnh của cùng 1 sản phẩm (VD: danh sách thành phần in vòng quanh bao bì)
+    
+    OCR tất cả ảnh bằng 1 lệnh Vision batch, gộp text (bỏ đoạn trùng lặp giữa các ảnh),
+    rồi chỉ gọi 1 lần trích xuất nguyên liệu + 1 lần phân tích sức khỏe.
+    
+    Request Body (JSON):
+    {
+        "images_base64": ["...", "..."],
+        "threshold": 0.6  (optional),
+        "health_profile": {...}
+    }
+    
+    Hoặc multipart/form-data: nhiều file cùng field "images", health_profile, threshold
+    
+    Response giống smart_ocr_rag; mỗi mapping có thêm "image_index" và
+    "images": [{"image_index", "total_ocr_words"}]
+    """
+    
+    if req.method != 'POST':
+        return https_fn.Response(
+            json.dumps({"error": "Method not allowed. Use POST."}),
+            status=405,
+            headers={"Content-Type": "application/json"}
+        )
+    
+    try:
+        decode_started = time.perf_counter()
+        images = []
+        threshold = 0.6
+        health_profile = None
+        debug_timings = _is_truthy(req.args.get('debug_timings'))
+        max_images = env_int("BATCH_MAX_IMAGES", 10)
+        ensure_request_size(req, max_images=max_images)
+        
+        if req.files and 'images' in req.files:
+            images = [read_upload(file) for file in req.files.getlist('images')]
+            threshold = float(req.form.get('threshold', 0.6))
+            health_profile_str = req.form.get('health_profile')
+            if health_profile_str:
+                try:
+                    health_profile = json.loads(health_profile_str)
+                except json.JSONDecodeError:
+                    return https_fn.Response(
+                        json.dumps({"error": "Invalid health_profile JSON format"}),
+                        status=400,
+                        headers={"Content-Type": "application/json"}
+                    )
+        
+        elif req.is_json:
+            data = req.get_json()
+            images_base64 = data.get('images_base64')
+            if not isinstance(images_base64, list) or not images_base64:
+                return https_fn.Response(
+                    json.dumps({"error": "Missing 'images_base64' field (list)"}),
+                    status=400,
+                    headers={"Content-Type": "application/json"}
+                )
+            images = [decode_base64_image(image_base64) for image_base64 in images_base64]
+            threshold = float(data.get('threshold', 0.6))
+            health_profile = data.get('health_profile')
+            debug_timings = debug_timings or _is_truthy(data.get('debug_timings'))
         
-        if not ocr_data:
+        else:
             return https_fn.Response(
-                json.dumps({
-                    "success": False,
-                    "error": "Không tìm thấy text trong ảnh"
-                }),
-                status=200,
+                json.dumps({"error": "Invalid request format. Use JSON or multipart/form-data"}),
+                status=400,
                 headers={"Content-Type": "application/json"}
             )
         
-        # 2. Phân tích với OpenAI để trích xuất nguyên liệu
-        logging.info("🤖 Đang phân tích với AI...")
-        ingredients = analyze_with_openai_strict(ocr_data)
+        if not images or len(images) > max_images:
+            return https_fn.Response(
+                json.dumps({"error": f"Cần từ 1 đến {max_images} ảnh"}),
+                status=400,
+                headers={"Content-Type": "application/json"}
+            )
         
-        if not ingredients:
-            # Trả về raw OCR nếu không phân tích được
-            raw_text = " ".join([w['text'] for w in ocr_data if not w['is_noise']])
+        if not health_profile:
             return https_fn.Response(
                 json.dumps({
-                    "success": True,
-                    "ingredients": [],
-                    "health_warnings": [],
-                    "safe_ingredients": [],
-                    "risk_summary": {
-                        "max_risk_score": 0,
-                        "avg_risk_score": 0,
-                        "critical_risk_count": 0,
-                        "high_risk_count": 0,
-                        "medium_risk_count": 0,
-                        "low_risk_count": 0,
-                        "very_low_risk_count": 0,
-                        "total_warnings": 0,
-                        "overall_recommendation": "Không tìm thấy nguyên liệu để phân tích."
-                    },
-                    "mappings": [],
-                    "raw_text": raw_text,
-                    "message": "Không tìm thấy nguyên liệu. Trả về raw OCR text.",
-                    "user_profile": health_profile
-                }, ensure_ascii=False),
-                status=200,
-                headers={"Content-Type": "application/json; charset=utf-8"}
+                    "error": "Missing 'health_profile' field",
+                    "required_format": {
+                        "medical_history": ["bệnh 1", "bệnh 2"],
+                        "allergy": ["dị ứng 1", "dị ứng 2"]
+                    }
+                }),
+                status=400,
+                headers={"Content-Type": "application/json"}
             )
         
-        # 3. Phân tích rủi ro sức khỏe
-        logging.info("🏥 Đang phân tích rủi ro sức khỏe...")
-        health_analysis = analyze_health_risks(ingredients, health_profile)
-        
-        # 4. Semantic Mapping
-        logging.info("🔗 Đang mapping vị trí...")
-        mappings = find_coordinates_semantic(ingredients, ocr_data, threshold)
-        
-        # 5. Tính toán risk summary dựa trên risk_score
-        warnings = health_analysis.get("warnings", [])
-        
-        # Phân loại theo risk_score
-        critical_risk_count = len([w for w in warnings if w.get("risk_score", 0) >= 0.8])  # 0.8-1.0
-        high_risk_count = len([w for w in warnings if 0.6 <= w.get("risk_score", 0) < 0.8])  # 0.6-0.79
-        medium_risk_count = len([w for w in warnings if 0.4 <= w.get("risk_score", 0) < 0.6])  # 0.4-0.59
-        low_risk_count = len([w for w in warnings if 0.2 <= w.get("risk_score", 0) < 0.4])  # 0.2-0.39
-        very_low_risk_count = len([w for w in warnings if w.get("risk_score", 0) < 0.2])  # 0-0.19
+        if not isinstance(health_profile.get('medical_history'), list):
+            health_profile['medical_history'] = []
+        if not isinstance(health_profile.get('allergy'), list):
+            health_profile['allergy'] = []
+        tracing.add_span("decode", (time.perf_counter() - decode_started) * 1000)
         
-        # Tính max và avg risk score
-        risk_scores = [w.get("risk_score", 0) for w in warnings]
-        max_risk_score = max(risk_scores) if risk_scores else 0
-        avg_risk_score = sum(risk_scores) / len(risk_scores) if risk_scores else 0
+        stages = build_scan_stages(None, health_profile, threshold,
+                                   ocr_func=lambda: get_ocr_data_batch(images))
+        with request_scope(deadline_sec=OPENAI_REQUEST_DEADLINE_SEC, priority=BATCH):
+            results, stage_report = run_stages(stages)
+        response_data = build_scan_response(results, stage_report, health_profile, threshold)
         
-        # 6. Tạo response
-        response_data = {
-            "success": True,
-            "ingredients": ingredients,
-            "health_warnings": warnings,
-            "safe_ingredients": health_analysis.get("safe_ingredients", []),
-            "risk_summary": {
-                "max_risk_score": round(max_risk_score, 2),
-                "avg_risk_score": round(avg_risk_score, 2),
-                "critical_risk_count": critical_risk_count,
-                "high_risk_count": high_risk_count,
-                "medium_risk_count": medium_risk_count,
-                "low_risk_count": low_risk_count,
-                "very_low_risk_count": very_low_risk_count,
-                "total_warnings": len(warnings),
-                "overall_recommendation": health_analysis.get("overall_recommendation", "")
-            },
-            "mappings": mappings,
-            "total_ocr_words": len(ocr_data),
-            "matched_count": len(mappings),
-            "threshold_used": threshold,
-            "user_profile": {
-                "allergies_checked": health_profile.get("allergy", []),
-                "conditions_checked": health_profile.get("medical_history", [])
-            }
-        }
+        ocr_doc = results["ocr"]
+        words_per_image = [0] * len(images)
+        for image_index in (ocr_doc.image_index.tolist() if ocr_doc.image_index is not None else []):
+            words_per_image[image_index] += 1
+        response_data["images"] = [
+            {"image_index": i, "total_ocr_words": count}
+            for i, count in enumerate(words_per_image)
+        ]
         
-        logging.info(f"✅ Hoàn thành! Tìm thấy {len(ingredients)} nguyên liệu, {len(warnings)} cảnh báo")
+        logging.info(f"✅ Batch {len(images)} ảnh: {len(response_data.get('ingredients', []))} nguyên liệu")
         
         return https_fn.Response(
-            json.dumps(response_data, ensure_ascii=False),
+            serialize_scan_response(response_data, debug_timings),
             status=200,
             headers={"Content-Type": "application/json; charset=utf-8"}
         )
         
+    except ImageTooLarge as e:
+        return _too_large_response(e)
     except Exception as e:
         logging.error(f"❌ Error: {str(e)}")
         return https_fn.Response(
@@ -586,7 +2002,8 @@ def health_check(req: https_fn.Request) -> https_fn.Response:
         json.dumps({
             "status": "healthy",
             "service": "smart-ocr-rag",
-            "version": "1.0.0"
+            "version": "1.0.0",
+            "cache_stats": get_cache_stats()
         }),
         status=200,
         headers={"Content-Type": "application/json"}
@@ -622,6 +2039,10 @@ def save_history(req: https_fn.Request) -> https_fn.Response:
     - device_id: string
     - image: file (ảnh)
     - scan_result: JSON string
+    
+    3. Body là bytes ảnh thô (Content-Type: image/* hoặc application/octet-stream):
+    - device_id, scan_result (JSON string): query string hoặc header X-Device-Id, X-Scan-Result
+      (scan_result lớn nên dùng multipart)
     """
     
     if req.method != 'POST':
@@ -636,24 +2057,20 @@ def save_history(req: https_fn.Request) -> https_fn.Response:
         image_content = None
         scan_result = None
         
+        scan_result_str = None
+        ensure_request_size(req)
+        
+        # === CÁCH 3: Body là ảnh thô ===
+        if is_raw_image_request(req):
+            image_content = read_raw_image(req)
+            device_id = raw_request_param(req, 'device_id')
+            scan_result_str = raw_request_param(req, 'scan_result')
+        
         # === CÁCH 1: Multipart Form-Data (upload file trực tiếp) ===
-        if req.files and 'image' in req.files:
-            file = req.files['image']
-            image_content = file.read()
-            
+        elif req.files and 'image' in req.files:
+            image_content = read_upload(req.files['image'])
             device_id = req.form.get('device_id')
-            
-            # Parse scan_result từ form data (JSON string)
             scan_result_str = req.form.get('scan_result')
-            if scan_result_str:
-                try:
-                    scan_result = json.loads(scan_result_str)
-                except json.JSONDecodeError:
-                    return https_fn.Response(
-                        json.dumps({"error": "Invalid scan_result JSON format"}),
-                        status=400,
-                        headers={"Content-Type": "application/json"}
-                    )
         
         # === CÁCH 2: JSON Body (base64 image) ===
         elif req.is_json:
@@ -662,21 +2079,29 @@ def save_history(req: https_fn.Request) -> https_fn.Response:
             device_id = data.get('device_id')
             scan_result = data.get('scan_result')
             
-            # Decode base64 image nếu có
+            # Decode base64 image nếu có (xóa prefix data:image/png;base64,... nếu có)
             image_base64 = data.get('image_base64')
             if image_base64:
-                # Xóa prefix nếu có (data:image/png;base64,...)
-                if ',' in image_base64:
-                    image_base64 = image_base64.split(',')[1]
-                image_content = base64.b64decode(image_base64)
+                image_content = decode_base64_image(image_base64)
         
         else:
             return https_fn.Response(
-                json.dumps({"error": "Invalid request format. Use JSON or multipart/form-data"}),
+                json.dumps({"error": "Invalid request format. Use JSON, multipart/form-data or a raw image body"}),
                 status=400,
                 headers={"Content-Type": "application/json"}
             )
         
+        # Parse scan_result dạng JSON string (form data / ảnh thô)
+        if scan_result_str:
+            try:
+                scan_result = json.loads(scan_result_str)
+            except json.JSONDecodeError:
+                return https_fn.Response(
+                    json.dumps({"error": "Invalid scan_result JSON format"}),
+                    status=400,
+                    headers={"Content-Type": "application/json"}
+                )
+        
         # Validate required fields
         if not device_id:
             return https_fn.Response(
@@ -692,67 +2117,26 @@ def save_history(req: https_fn.Request) -> https_fn.Response:
                 headers={"Content-Type": "application/json"}
             )
         
-        # Generate unique filename và timestamp
+        # Generate timestamp và history ID
         timestamp = int(datetime.now().timestamp() * 1000)
-        unique_id = str(uuid.uuid4())[:8]
+        history_id = history_store.generate_push_id(timestamp)
         
         image_url = None
+        thumbnail_url = None
         
-        # Upload image to Storage nếu có
+        # Upload image (theo hash nội dung) + thumbnail lên Storage nếu có
         if image_content:
             try:
-                # Upload to Firebase Storage
-                bucket = storage.bucket()
-                blob_path = f"scan_images/{device_id}/{timestamp}_{unique_id}.jpg"
-                blob = bucket.blob(blob_path)
-                
-                blob.upload_from_string(
-                    image_content,
-                    content_type='image/jpeg'
-                )
-                
-                # Make the blob publicly accessible
-                blob.make_public()
-                image_url = blob.public_url
-                
-                logging.info(f"✅ Uploaded image to: {image_url}")
-                
+                stored = store_scan_image(storage.bucket(), device_id, image_content)
+                image_url = stored["image_url"]
+                thumbnail_url = stored["thumbnail_url"]
             except Exception as e:
                 logging.error(f"❌ Error uploading image: {e}")
                 # Continue without image URL
-                image_url = None
         
-        # Prepare data for Realtime Database
-        history_data = {
-            "created_at": timestamp,
-            "image_url": image_url,
-            
-            # Ingredients data
-            "ingredients": scan_result.get("ingredients", []),
-            "safe_ingredients": scan_result.get("safe_ingredients", []),
-            
-            # Health warnings (full object)
-            "health_warnings": scan_result.get("health_warnings", []),
-            
-            # Risk summary (full object)
-            "risk_summary": scan_result.get("risk_summary", {}),
-            
-            # Mappings (bounding boxes)
-            "mappings": scan_result.get("mappings", []),
-            
-            # OCR metadata
-            "total_ocr_words": scan_result.get("total_ocr_words", 0),
-            "matched_count": scan_result.get("matched_count", 0),
-            "threshold_used": scan_result.get("threshold_used", 0.6),
-            
-            # User profile
-            "user_profile": scan_result.get("user_profile", {})
-        }
-        
-        # Save to Realtime Database
-        ref = db.reference(f'scan_history/{device_id}')
-        new_ref = ref.push(history_data)
-        history_id = new_ref.key
+        # Tóm tắt (danh sách) + chi tiết, ghi trong 1 lệnh update nhiều path
+        history_data = history_store.history_record(scan_result, timestamp, image_url, thumbnail_url)
+        db.reference().update(history_store.split_updates(device_id, history_id, history_data))
         
         logging.info(f"✅ Saved history: {history_id} for device: {device_id}")
         
@@ -761,12 +2145,15 @@ def save_history(req: https_fn.Request) -> https_fn.Response:
                 "success": True,
                 "history_id": history_id,
                 "image_url": image_url,
+                "thumbnail_url": thumbnail_url,
                 "created_at": timestamp
             }, ensure_ascii=False),
             status=200,
             headers={"Content-Type": "application/json; charset=utf-8"}
         )
         
+    except ImageTooLarge as e:
+        return _too_large_response(e)
     except Exception as e:
         logging.error(f"❌ Error saving history: {str(e)}")
         return https_fn.Response(
@@ -779,6 +2166,43 @@ def save_history(req: https_fn.Request) -> https_fn.Response:
 # ---------------------------------------------------------
 # GET HISTORY ENDPOINT
 # ---------------------------------------------------------
+HISTORY_PAGE_MAX = 100
+# Realtime DB (admin SDK) chỉ hỗ trợ end_at theo giá trị, không kèm key: lấy thêm vài bản ghi
+# để bù các scan trùng created_at với cursor (bị lọc lại theo key ở dưới)
+HISTORY_CURSOR_TIE_SLACK = 5
+
+
+def _load_history_details(device_id: str, items: list) -> dict:
+    """
+    Node chi tiết của 1 trang lịch sử trong 1 query: push ID tăng theo thời gian nên các
+    bản ghi của trang nằm trong dải key [cũ nhất, mới nhất]
+    """
+    if not items:
+        return {}
+    ids = [history_id for history_id, _ in items]
+    snapshot = (db.reference(f'{history_store.DETAIL_ROOT}/{device_id}')
+                .order_by_key().start_at(min(ids)).end_at(max(ids)).get())
+    return snapshot or {}
+
+
+def history_etag(body: str) -> str:
+    return '"' + hashlib.sha1(body.encode('utf-8')).hexdigest() + '"'
+
+
+def history_version_etag(version: str, *params) -> str:
+    """ETag của 1 trang lịch sử từ node phiên bản của thiết bị (không cần đọc bản ghi)"""
+    raw = "|".join([version, *(str(param) for param in params)])
+    return '"v-' + hashlib.sha1(raw.encode('utf-8')).hexdigest() + '"'
+
+
+def _etag_matches(req: https_fn.Request, etag: str) -> bool:
+    if_none_match = req.headers.get("If-None-Match")
+    if not if_none_match:
+        return False
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag in candidates or "*" in candidates
+
+
 @https_fn.on_request(
     cors=options.CorsOptions(
         cors_origins=["*"],
@@ -790,11 +2214,18 @@ def save_history(req: https_fn.Request) -> https_fn.Response:
 )
 def get_history(req: https_fn.Request) -> https_fn.Response:
     """
-    Lấy lịch sử scan từ Realtime Database
+    Lấy lịch sử scan từ Realtime Database (mới nhất trước, phân trang bằng cursor)
     
     Query Parameters:
     - device_id: (required) Device identifier
     - limit: (optional) Max items to return, default 20, max 100
+    - cursor: (optional) next_cursor của trang trước, lấy các scan cũ hơn
+    - view: (optional) mặc định "summary": chỉ đọc node tóm tắt (id, created_at, image_url,
+      ingredients_count, risk_summary, ...); "full" kèm node chi tiết của trang
+      (màn hình chi tiết nên dùng get_history_detail)
+    
+    Response có header ETag; gửi lại qua If-None-Match để nhận 304 nếu lịch sử không đổi.
+    ETag lấy từ node phiên bản của thiết bị nên 304 chỉ tốn 1 lượt đọc vài byte.
     """
     
     if req.method != 'GET':
@@ -807,7 +2238,8 @@ def get_history(req: https_fn.Request) -> https_fn.Response:
     try:
         # Get query parameters
         device_id = req.args.get('device_id')
-        limit = min(int(req.args.get('limit', 20)), 100)  # Max 100 items
+        view = req.args.get('view', 'summary')
+        cursor = req.args.get('cursor')
         
         if not device_id:
             return https_fn.Response(
@@ -816,46 +2248,81 @@ def get_history(req: https_fn.Request) -> https_fn.Response:
                 headers={"Content-Type": "application/json"}
             )
         
-        # Query Realtime Database
-        ref = db.reference(f'scan_history/{device_id}')
-        
-        # Get data ordered by created_at (descending - newest first)
-        # Realtime DB orders ascending by default, so we get all and reverse
-        snapshot = ref.order_by_child('created_at').limit_to_last(limit).get()
+        try:
+            limit = max(1, min(int(req.args.get('limit', 20)), HISTORY_PAGE_MAX))
+            before = history_store.decode_cursor(cursor) if cursor else None
+        except ValueError:
+            return https_fn.Response(
+                json.dumps({"error": "Invalid 'limit' or 'cursor' query parameter"}),
+                status=400,
+                headers={"Content-Type": "application/json"}
+            )
         
-        if not snapshot:
+        if view not in ('full', 'summary'):
             return https_fn.Response(
-                json.dumps({
-                    "success": True,
-                    "history": [],
-                    "count": 0
-                }, ensure_ascii=False),
-                status=200,
-                headers={"Content-Type": "application/json; charset=utf-8"}
+                json.dumps({"error": "Invalid 'view' query parameter. Use 'full' or 'summary'"}),
+                status=400,
+                headers={"Content-Type": "application/json"}
             )
         
-        # Convert to list and add ID
-        history_list = []
-        for history_id, history_data in snapshot.items():
-            history_item = {
-                "id": history_id,
-                **history_data
-            }
-            history_list.append(history_item)
+        # Node phiên bản đổi mỗi lần save_history -> trả 304 trước khi đọc bản ghi
+        # (thiết bị chỉ có bản ghi cũ, chưa có node phiên bản: ETag theo nội dung như trước)
+        version = db.reference(f'{history_store.VERSION_ROOT}/{device_id}').get()
+        etag = history_version_etag(str(version), view, limit, cursor or "") if version else None
+        if etag is not None and _etag_matches(req, etag):
+            logging.info(f"✅ History not modified for device: {device_id}")
+            return https_fn.Response(status=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+        
+        # Query Realtime Database: limit + 1 bản ghi để biết còn trang sau không
+        query = db.reference(f'{history_store.SUMMARY_ROOT}/{device_id}').order_by_child('created_at')
+        fetch = limit + 1
+        if before:
+            query = query.end_at(before[0])
+            fetch += HISTORY_CURSOR_TIE_SLACK
+        snapshot = query.limit_to_last(fetch).get() or {}
+        
+        # Snapshot đã sắp xếp tăng dần theo created_at (OrderedDict) -> chỉ cần đảo ngược
+        items = []
+        for history_id, history_data in reversed(list(snapshot.items())):
+            if before and (history_data.get('created_at', 0), history_id) >= before:
+                continue
+            items.append((history_id, history_data))
         
-        # Sort by created_at descending (newest first)
-        history_list.sort(key=lambda x: x.get('created_at', 0), reverse=True)
+        has_more = len(items) > limit
+        items = items[:limit]
+        
+        if view == 'summary':
+            history_list = [history_store.summary_of(history_id, data) for history_id, data in items]
+        else:
+            details = _load_history_details(device_id, items)
+            history_list = [history_store.merge_detail(history_id, data, details.get(history_id))
+                            for history_id, data in items]
+        
+        next_cursor = None
+        if has_more:
+            last_id, last_data = items[-1]
+            next_cursor = history_store.encode_cursor(last_data.get('created_at', 0), last_id)
+        
+        body = json.dumps({
+            "success": True,
+            "history": history_list,
+            "count": len(history_list),
+            "next_cursor": next_cursor
+        }, ensure_ascii=False)
+        if etag is None:
+            etag = history_etag(body)
+        cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        
+        if _etag_matches(req, etag):
+            logging.info(f"✅ History not modified for device: {device_id}")
+            return https_fn.Response(status=304, headers=cache_headers)
         
         logging.info(f"✅ Retrieved {len(history_list)} history items for device: {device_id}")
         
         return https_fn.Response(
-            json.dumps({
-                "success": True,
-                "history": history_list,
-                "count": len(history_list)
-            }, ensure_ascii=False),
+            body,
             status=200,
-            headers={"Content-Type": "application/json; charset=utf-8"}
+            headers={"Content-Type": "application/json; charset=utf-8", **cache_headers}
         )
         
     except Exception as e:
@@ -865,3 +2332,83 @@ def get_history(req: https_fn.Request) -> https_fn.Response:
             status=500,
             headers={"Content-Type": "application/json"}
         )
+
+
+# ---------------------------------------------------------
+# GET HISTORY DETAIL ENDPOINT
+# ---------------------------------------------------------
+@https_fn.on_request(
+    cors=options.CorsOptions(
+        cors_origins=["*"],
+        cors_methods=["GET"]
+    ),
+    memory=options.MemoryOption.MB_256,
+    timeout_sec=30,
+    region="asia-southeast1"
+)
+def get_history_detail(req: https_fn.Request) -> https_fn.Response:
+    """
+    Lấy 1 bản ghi lịch sử đầy đủ (tóm tắt + health_warnings, mappings, user_profile...)
+    cho màn hình chi tiết
+    
+    Query Parameters:
+    - device_id: (required) Device identifier
+    - history_id: (required) ID trả về từ save_history / get_history
+    
+    Hỗ trợ ETag / If-None-Match như get_history.
+    """
+    
+    if req.method != 'GET':
+        return https_fn.Response(
+            json.dumps({"error": "Method not allowed. Use GET."}),
+            status=405,
+            headers={"Content-Type": "application/json"}
+        )
+    
+    try:
+        device_id = req.args.get('device_id')
+        history_id = req.args.get('history_id')
+        
+        if not device_id or not history_id:
+            return https_fn.Response(
+                json.dumps({"error": "Missing 'device_id' or 'history_id' query parameter"}),
+                status=400,
+                headers={"Content-Type": "application/json"}
+            )
+        
+        summary_ref = db.reference(f'{history_store.SUMMARY_ROOT}/{device_id}/{history_id}')
+        detail_ref = db.reference(f'{history_store.DETAIL_ROOT}/{device_id}/{history_id}')
+        summary, detail = summary_ref.get(), detail_ref.get()
+        
+        if not summary:
+            return https_fn.Response(
+                json.dumps({"success": False, "error": "History not found"}),
+                status=404,
+                headers={"Content-Type": "application/json"}
+            )
+        
+        body = json.dumps({
+            "success": True,
+            "history": history_store.merge_detail(history_id, summary, detail)
+        }, ensure_ascii=False)
+        etag = history_etag(body)
+        cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        
+        if _etag_matches(req, etag):
+            return https_fn.Response(status=304, headers=cache_headers)
+        
+        logging.info(f"✅ Retrieved history detail: {history_id} for device: {device_id}")
+        
+        return https_fn.Response(
+            body,
+            status=200,
+            headers={"Content-Type": "application/json; charset=utf-8", **cache_headers}
+        )
+        
+    except Exception as e:
+        logging.error(f"❌ Error getting history detail: {str(e)}")
+        return https_fn.Response(
+            json.dumps({"success": False, "error": str(e)}),
+            status=500,
+            headers={"Content-Type": "application/json"}
+        )
@@ -0,0 +1,228 @@
+"""
+Định tuyến model theo tầng cho các lệnh gọi chat
+
+- Tầng nhanh (OPENAI_FAST_MODEL, mặc định gpt-4o-mini) chạy trước cho trích xuất nguyên liệu
+  và kiểm tra rủi ro đơn giản
+- Nâng lên tầng mạnh (OPENAI_STRONG_MODEL, mặc định gpt-4o) khi output của tầng nhanh không
+  qua kiểm tra: JSON hỏng, nguyên liệu không có trong text OCR, tên không khớp danh sách...
+- Đi thẳng tầng mạnh khi đầu vào phức tạp (hồ sơ có tình trạng ngoài taxonomy, nhiều cặp
+  cần đánh giá) hoặc khi output được stream thẳng cho client
+
+Quyết định (tầng, lý do nâng tầng) và latency từng tầng theo tác vụ được expose qua
+health_check (registry cache) và trace của request (span <task>_<tier>) để chỉnh chính sách.
+MODEL_ROUTING=0: luôn dùng tầng mạnh.
+"""
+import os
+import re
+import time
+import logging
+import threading
+from collections import deque
+
+import numpy as np
+
+import tracing
+from cache import register_cache, env_int, env_flag
+from lexical_matcher import fold, normalize
+from allergen_profile import is_known_condition
+
+FAST_MODEL = os.environ.get("OPENAI_FAST_MODEL", "gpt-4o-mini")
+STRONG_MODEL = os.environ.get("OPENAI_STRONG_MODEL", "gpt-4o")
+TIERS = {"fast": FAST_MODEL, "strong": STRONG_MODEL}
+
+# Tỉ lệ nguyên liệu tối thiểu tìm thấy trong text OCR để chấp nhận kết quả tầng nhanh
+MIN_GROUNDED_RATIO = float(os.environ.get("ROUTER_MIN_GROUNDED_RATIO", 0.9))
+# Hồ sơ "đơn giản": tối đa bấy nhiêu tình trạng, tất cả đều có trong taxonomy (allergen_profile.py)
+FAST_MAX_CONDITIONS = env_int("ROUTER_FAST_MAX_CONDITIONS", 3)
+# Số cặp (nguyên liệu, tình trạng) / ước lượng tối đa gửi cho tầng nhanh
+FAST_MAX_PAIRS = env_int("ROUTER_FAST_MAX_PAIRS", 60)
+
+WARNING_TYPES = {"allergy", "cross_reactivity", "medical_condition"}
+# Text OCR có tiêu đề danh sách thành phần mà không trích xuất được gì -> nghi ngờ
+_INGREDIENT_HEADER = re.compile(r"thanh phan|nguyen lieu|ingredient")
+
+
+# -----------------------------------------------------
+# Kiểm tra output của tầng nhanh (None = hợp lệ, str = lý do nâng tầng)
+# -----------------------------------------------------
+def validate_extraction(ingredients: list, ocr_text: str) -> str | None:
+    """Nguyên liệu trích xuất phải có trong text OCR (so theo token, không phân biệt dấu)"""
+    ocr_folded = fold(ocr_text)
+    if not ingredients:
+        return "empty_extraction" if _INGREDIENT_HEADER.search(ocr_folded) else None
+    ocr_tokens = set(re.findall(r"\w+", ocr_folded))
+    grounded = sum(
+        1 for ingredient in ingredients
+        if (tokens := re.findall(r"\w+", fold(str(ingredient)))) and all(t in ocr_tokens for t in tokens)
+    )
+    if grounded / len(ingredients) < MIN_GROUNDED_RATIO:
+        return "ungrounded_ingredients"
+    return None
+
+
+def _invalid_risk(item: dict) -> bool:
+    score = item.get("risk_score")
+    return (not isinstance(score, (int, float)) or not 0 <= score <= 1
+            or item.get("warning_type") not in WARNING_TYPES)
+
+
+def validate_health(result: dict, ingredients: list) -> str | None:
+    """Cảnh báo phải thuộc danh sách nguyên liệu, risk_score trong [0, 1], warning_type hợp lệ"""
+    names = {normalize(str(i)) for i in ingredients}
+    for warning in result.get("warnings", []):
+        if not isinstance(warning, dict) or _invalid_risk(warning):
+            return "invalid_warning"
+        if normalize(str(warning.get("ingredient", ""))) not in names:
+            return "unknown_ingredient"
+    return None
+
+
+def validate_verdicts(data: dict, asked_pairs: set) -> str | None:
+    """
+    Mỗi cặp (nguyên liệu, tình trạng) chuẩn hóa trong asked_pairs phải có verdict tường minh,
+    trỏ đúng tên đã hỏi (cặp thiếu / sai tên không được coi là "an toàn")
+    """
+    verdicts = data.get("verdicts")
+    if not isinstance(verdicts, list):
+        return "malformed_output"
+    answered = set()
+    for item in verdicts:
+        if not isinstance(item, dict):
+            return "invalid_verdict"
+        score = item.get("risk_score")
+        # Cặp an toàn (risk_score = 0) không cần warning_type
+        if not isinstance(score, (int, float)) or (score != 0 and _invalid_risk(item)):
+            return "invalid_verdict"
+        pair = (normalize(str(item.get("ingredient", ""))), normalize(str(item.get("condition", ""))))
+        if pair not in asked_pairs:
+            return "unmatched_verdict"
+        answered.add(pair)
+    if answered != asked_pairs:
+        return "missing_pair"
+    return None
+
+
+def profile_complexity(conditions: list, pair_count: int) -> str | None:
+    """
+    Lý do phải dùng tầng mạnh cho phân tích rủi ro, None nếu hồ sơ đơn giản
+    Args:
+        conditions: [(kind, tên gốc, tên chuẩn hóa)] (health_verdicts.profile_conditions)
+        pair_count: Số cặp (nguyên liệu, tình trạng) cần đánh giá
+    """
+    if len(conditions) > FAST_MAX_CONDITIONS:
+        return "many_conditions"
+    if any(not is_known_condition(name) for _, name, _ in conditions):
+        return "unknown_condition"
+    if pair_count > FAST_MAX_PAIRS:
+        return "many_pairs"
+    return None
+
+
+# -----------------------------------------------------
+# Router
+# -----------------------------------------------------
+class ModelRouter:
+    """
+    Args:
+        name: Tên (thống kê health_check)
+        latency_window: Số mẫu latency gần nhất giữ lại / (tác vụ, tầng) để tính p50 / p95
+    """
+
+    def __init__(self, name: str, latency_window: int = 512):
+        self.name = name
+        self.enabled = env_flag("MODEL_ROUTING", True)
+        self._window = latency_window
+        self._lock = threading.Lock()
+        self._tasks = {}
+        register_cache(self)
+
+    def run(self, task: str, call, validate=None, force_strong: str = None, with_model: bool = False):
+        """
+        Args:
+            task: Tên tác vụ (VD: "extraction", "health_verdicts")
+            call: call(model) -> kết quả; ném ValueError / KeyError / TypeError nếu output hỏng
+            validate: (optional) validate(kết quả) -> None nếu hợp lệ, lý do (str) nếu phải nâng tầng
+            force_strong: Lý do bỏ qua tầng nhanh (VD: "complex_profile"), None = thử tầng nhanh trước
+            with_model: Trả kèm model đã trả lời (VD: để cache kết quả theo đúng model)
+        Returns:
+            Kết quả của tầng nhanh (nếu hợp lệ) hoặc tầng mạnh; (kết quả, model) nếu with_model
+        Raises:
+            Lỗi của tầng mạnh; lỗi gọi API của tầng nhanh (quá deadline, hết lượt retry) không nâng tầng
+        """
+        import openai
+
+        if not self.enabled:
+            force_strong = force_strong or "routing_disabled"
+        if force_strong is None:
+            try:
+                result = self._timed(task, "fast", call)
+                reason = validate(result) if validate is not None else None
+            except (ValueError, KeyError, TypeError):
+                reason = "malformed_output"
+            except (openai.BadRequestError, openai.NotFoundError) as e:
+                # VD: model nhanh không hỗ trợ tham số / không có quyền truy cập
+                logging.warning(f"⚠️ {task}: {FAST_MODEL} lỗi ({e})")
+                reason = "fast_model_error"
+            if reason is None:
+                self._record(task, "fast")
+                return (result, FAST_MODEL) if with_model else result
+            logging.info(f"⤴️ {task}: nâng từ {FAST_MODEL} lên {STRONG_MODEL} ({reason})")
+            tracing.count("model_escalations")
+            self._record(task, "escalated", reason)
+        else:
+            self._record(task, "strong", force_strong)
+        result = self._timed(task, "strong", call)
+        return (result, STRONG_MODEL) if with_model else result
+
+    def _timed(self, task: str, tier: str, call):
+        started = time.perf_counter()
+        try:
+            return call(TIERS[tier])
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            tracing.add_span(f"{task}_{tier}", duration_ms)
+            with self._lock:
+                self._task(task)["latency"][tier].append(duration_ms)
+
+    def _task(self, task: str) -> dict:
+        # Gọi khi đang giữ self._lock
+        if task not in self._tasks:
+            self._tasks[task] = {
+                "counts": {"fast": 0, "strong": 0, "escalated": 0},
+                "reasons": {},
+                "latency": {tier: deque(maxlen=self._window) for tier in TIERS},
+            }
+        return self._tasks[task]
+
+    def _record(self, task: str, decision: str, reason: str = None):
+        """decision: "fast" (tầng nhanh đạt), "strong" (đi thẳng tầng mạnh), "escalated" (nâng tầng)"""
+        with self._lock:
+            stats = self._task(task)
+            stats["counts"][decision] += 1
+            if reason is not None:
+                stats["reasons"][reason] = stats["reasons"].get(reason, 0) + 1
+        tracing.count(f"route_{task}_{decision}")
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            snapshot = {task: (dict(s["counts"]), dict(s["reasons"]),
+                               {tier: list(samples) for tier, samples in s["latency"].items()})
+                        for task, s in self._tasks.items()}
+        stats = {"enabled": self.enabled, "models": dict(TIERS)}
+        for task, (counts, reasons, latency) in snapshot.items():
+            tried_fast = counts["fast"] + counts["escalated"]
+            stats[task] = {
+                **counts,
+                "fast_accept_rate": round(counts["fast"] / tried_fast, 3) if tried_fast else None,
+                "reasons": reasons,
+                "latency_ms": {
+                    tier: {"n": len(samples),
+                           "p50": round(float(np.percentile(samples, 50)), 1),
+                           "p95": round(float(np.percentile(samples, 95)), 1)}
+                    for tier, samples in latency.items() if samples
+                },
+            }
+        return stats
+
+
+model_router = ModelRouter("model_router")
@@ -0,0 +1,197 @@
+"""
+Cache kết quả OCR theo nội dung ảnh (content-addressed)
+
+- Key chính: SHA-256 của bytes ảnh (trùng khớp tuyệt đối)
+- Key phụ (tùy chọn): perceptual hash (dHash 64-bit) để ảnh chụp gần giống nhau
+  (cùng sản phẩm, lệch sáng/nén lại) cũng dùng lại được kết quả OCR
+
+Bật perceptual hash bằng OCR_CACHE_PHASH=1, ngưỡng khoảng cách Hamming: OCR_CACHE_PHASH_DISTANCE.
+"""
+import json
+import zlib
+import base64
+import hashlib
+import logging
+import threading
+from io import BytesIO
+from collections import OrderedDict
+
+import numpy as np
+
+from cache import TieredCache, register_cache, env_int, env_flag
+from ocr_document import OcrDocument
+
+SERIAL_VERSION = 3
+
+
+def content_hash(image_content: bytes) -> str:
+    """SHA-256 hex của bytes ảnh"""
+    return hashlib.sha256(image_content).hexdigest()
+
+
+def perceptual_hash(image_content: bytes) -> int | None:
+    """
+    dHash 64-bit: so sánh độ sáng các pixel liền kề trên ảnh xám 9x8
+    Returns:
+        int 64-bit, hoặc None nếu không decode được ảnh
+    """
+    from PIL import Image
+
+    try:
+        img = Image.open(BytesIO(image_content))
+        # JPEG: decode ở độ phân giải thấp, nhanh hơn nhiều so với decode full-size
+        img.draft('L', (64, 64))
+        pixels = list(img.convert('L').resize((9, 8), Image.Resampling.LANCZOS).getdata())
+    except Exception as e:
+        logging.warning(f"⚠️ Không tính được perceptual hash: {e}")
+        return None
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+# ---------------------------------------------------------
+# SERIALIZE OcrDocument (dạng nén gọn cho Realtime Database)
+# ---------------------------------------------------------
+def serialize_document(doc: OcrDocument) -> str:
+    """
+    Nén OcrDocument thành chuỗi base64:
+    {"v": version, "t": [text...], "b": [x0,y0,...,x3,y3 (phẳng)], "n": "0101...",
+     "l": [block, paragraph, line (phẳng)], "c": [độ tin cậy từ x100], "s": [độ tin cậy ký tự x100]}
+    """
+    compact = {
+        "v": SERIAL_VERSION,
+        "t": doc.words,
+        "b": doc.boxes.ravel().tolist(),
+        "n": "".join("1" if noise else "0" for noise in doc.is_noise.tolist()),
+        "l": np.stack([doc.block, doc.paragraph, doc.line], axis=1).ravel().tolist(),
+        "c": np.rint(doc.confidence * 100).astype(np.int16).tolist(),
+        "s": np.rint(doc.symbol_confidence * 100).astype(np.int16).tolist(),
+    }
+    raw = json.dumps(compact, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.b64encode(zlib.compress(raw, 6)).decode('ascii')
+
+
+def deserialize_document(payload: str) -> OcrDocument:
+    """Giải nén chuỗi từ serialize_document về OcrDocument"""
+    compact = json.loads(zlib.decompress(base64.b64decode(payload)).decode('utf-8'))
+    if compact.get("v") != SERIAL_VERSION:
+        return None
+
+    layout = np.array(compact["l"], dtype=np.int32).reshape(-1, 3)
+    return OcrDocument(
+        compact["t"],
+        np.array(compact["b"], dtype=np.int32),
+        np.frombuffer(compact["n"].encode('ascii'), dtype=np.uint8) == ord("1"),
+        np.array(compact["c"], dtype=np.float32) / 100,
+        np.array(compact["s"], dtype=np.float32) / 100,
+        layout[:, 0], layout[:, 1], layout[:, 2],
+    )
+
+
+class PerceptualIndex:
+    """
+    Index in-process: perceptual hash -> content hash
+    Tra cứu theo khoảng cách Hamming (quét tuyến tính, số entry nhỏ nên đủ nhanh)
+    """
+
+    def __init__(self, name: str, maxsize: int = 1024):
+        self.name = name
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"near_hits": 0, "lookups": 0}
+        register_cache(self)
+
+    def add(self, phash: int, key: str):
+        with self._lock:
+            self._data[phash] = key
+            self._data.move_to_end(phash)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def find(self, phash: int, max_distance: int) -> str | None:
+        with self._lock:
+            self.stats["lookups"] += 1
+            best_key, best_distance = None, max_distance + 1
+            for candidate, key in self._data.items():
+                distance = (candidate ^ phash).bit_count()
+                if distance < best_distance:
+                    best_key, best_distance = key, distance
+            if best_key is not None:
+                self.stats["near_hits"] += 1
+            return best_key
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {**self.stats, "size": len(self._data)}
+
+
+_ocr_cache = TieredCache(
+    "ocr",
+    serialize_document,
+    deserialize_document,
+    maxsize=env_int("OCR_CACHE_MAXSIZE", 256),
+    ttl_sec=env_int("OCR_CACHE_TTL_SEC", 24 * 3600),
+    l2_ttl_sec=env_int("OCR_CACHE_L2_TTL_SEC", 30 * 24 * 3600),
+    use_l2=env_flag("OCR_CACHE_L2", True)
+)
+
+# Bảng phụ trên L2: phash (hex) -> content hash, chỉ khớp chính xác phash
+_phash_l2 = TieredCache(
+    "ocr_phash",
+    lambda key: key,
+    lambda key: key,
+    maxsize=1,
+    ttl_sec=0,
+    l2_ttl_sec=env_int("OCR_CACHE_L2_TTL_SEC", 30 * 24 * 3600),
+    use_l2=env_flag("OCR_CACHE_L2", True)
+)
+_phash_index = PerceptualIndex("ocr_phash_l1", maxsize=env_int("OCR_CACHE_MAXSIZE", 256) * 4)
+
+
+def lookup(image_content: bytes) -> tuple[OcrDocument | None, dict]:
+    """
+    Tra cứu kết quả OCR của ảnh trong cache
+    Returns:
+        (OcrDocument hoặc None nếu miss, keys để truyền lại cho store())
+    """
+    keys = {"content": content_hash(image_content), "phash": None}
+
+    doc = _ocr_cache.get(keys["content"])
+    if doc is not None:
+        return doc, keys
+
+    if not env_flag("OCR_CACHE_PHASH", False):
+        return None, keys
+
+    phash = perceptual_hash(image_content)
+    if phash is None:
+        return None, keys
+    keys["phash"] = phash
+
+    near_key = _phash_index.find(phash, env_int("OCR_CACHE_PHASH_DISTANCE", 4))
+    if near_key is None:
+        near_key = _phash_l2.get(f"{phash:016x}")
+    if near_key is not None:
+        doc = _ocr_cache.get(near_key)
+        if doc is not None:
+            logging.info(f"⚡ OCR cache: ảnh gần giống {near_key[:12]}")
+            # Ghi lại dưới content hash mới để lần sau trùng khớp tuyệt đối (chỉ L1)
+            _ocr_cache.l1.set(keys["content"], doc)
+            return doc, keys
+
+    return None, keys
+
+
+def store(keys: dict, doc: OcrDocument):
+    """Lưu kết quả OCR (đã parse) vào cache; ghi L2 chạy nền, được chờ khi request kết thúc (l2_write_scope)"""
+    _ocr_cache.set(keys["content"], doc)
+    if keys.get("phash") is not None:
+        _phash_index.add(keys["phash"], keys["content"])
+        _phash_l2.set(f"{keys['phash']:016x}", keys["content"])
@@ -0,0 +1,207 @@
+"""
+Kết quả OCR dạng mảng song song (OcrDocument)
+
+Thay cho list dict {"text", "box", "is_noise", ...} mỗi từ: một từ = một vị trí trong các mảng
+NumPy liên tục, text gộp 1 lần với offset từng từ. Các bước sau (trích xuất nguyên liệu,
+mapping vị trí, raw_text fallback, cache) dùng các view rẻ trên cùng dữ liệu thay vì
+quét/copy lại list từ nhiều lần.
+
+Độ tin cậy của Vision được giữ lại (theo từ và theo ký tự, căn theo .text) để
+lọc các từ nhận diện kém khi cần.
+"""
+import numpy as np
+
+class OcrDocument:
+    """
+    Attributes:
+        words: list[str] text từng từ
+        text: các từ nối bằng 1 khoảng trắng
+        offsets: int32 (N, 2) vị trí [start, end) của từng từ trong text
+        boxes: int32 (N, 4, 2) 4 đỉnh bounding box (tọa độ ảnh gốc)
+        is_noise: bool (N) từ chỉ là dấu câu
+        is_duplicate: bool (N) đoạn text đã xuất hiện ở ảnh trước (batch scan)
+        confidence: float32 (N) độ tin cậy của từ
+        symbol_confidence: float32 (len(text)) độ tin cậy từng ký tự (khoảng trắng = 1)
+        block / paragraph / line: int32 (N) chỉ số bố cục, tăng dần theo thứ tự đọc
+        image_index: int32 (N) ảnh chứa từ (chỉ có với batch scan, None nếu 1 ảnh)
+    """
+
+    def __init__(self, words: list, boxes: np.ndarray, is_noise: np.ndarray, confidence: np.ndarray,
+                 symbol_confidence: np.ndarray, block: np.ndarray, paragraph: np.ndarray, line: np.ndarray,
+                 image_index: np.ndarray = None, is_duplicate: np.ndarray = None):
+        n = len(words)
+        self.words = words
+        self.text = " ".join(words)
+        lengths = np.fromiter(map(len, words), dtype=np.int32, count=n)
+        ends = np.cumsum(lengths + 1, dtype=np.int32) - 1
+        self.offsets = np.stack([ends - lengths, ends], axis=1) if n else np.zeros((0, 2), dtype=np.int32)
+        self.boxes = boxes.reshape(n, 4, 2).astype(np.int32, copy=False)
+        self.is_noise = is_noise.astype(bool, copy=False)
+        self.is_duplicate = is_duplicate if is_duplicate is not None else np.zeros(n, dtype=bool)
+        self.confidence = confidence.astype(np.float32, copy=False)
+        self.symbol_confidence = symbol_confidence.astype(np.float32, copy=False)
+        self.block = block.astype(np.int32, copy=False)
+        self.paragraph = paragraph.astype(np.int32, copy=False)
+        self.line = line.astype(np.int32, copy=False)
+        self.image_index = image_index
+        self._rects = None
+
+    @classmethod
+    def empty(cls) -> "OcrDocument":
+        zeros = np.zeros(0, dtype=np.int32)
+        return cls([], np.zeros((0, 4, 2), dtype=np.int32), np.zeros(0, dtype=bool),
+                   np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.float32), zeros, zeros, zeros)
+
+    def __len__(self):
+        return len(self.words)
+
+    # -----------------------------------------------------
+    # Views
+    # -----------------------------------------------------
+    def joined(self, mask: np.ndarray = None) -> str:
+        """Text của các từ được chọn (mask None = toàn bộ, không tạo chuỗi mới)"""
+        if mask is None or mask.all():
+            return self.text
+        return " ".join(self.words[i] for i in np.flatnonzero(mask))
+
+    def extraction_text(self, region: np.ndarray = None) -> str:
+        """
+        Text gửi cho bước trích xuất nguyên liệu: giữ dấu câu, bỏ đoạn trùng giữa các ảnh
+        region: (optional) mask vùng thành phần (ingredient_region.py), None = toàn bộ
+        """
+        keep = ~self.is_duplicate
+        return self.joined(keep if region is None else keep & region)
+
+    def clean_text(self) -> str:
+        """Text không có dấu câu và đoạn trùng (raw_text fallback)"""
+        return self.joined(~self.is_noise & ~self.is_duplicate)
+
+    def line_slices(self) -> list:
+        """Các slice chỉ số từ, mỗi slice là 1 dòng (theo thứ tự đọc)"""
+        if not len(self):
+            return []
+        bounds = np.flatnonzero(np.diff(self.line)) + 1
+        starts = np.concatenate([[0], bounds])
+        stops = np.concatenate([bounds, [len(self)]])
+        return [slice(int(a), int(b)) for a, b in zip(starts, stops)]
+
+    def slice_text(self, words: slice) -> str:
+        """Text của một dải từ liên tiếp (VD: 1 dòng), cắt thẳng từ text"""
+        return self.text[self.offsets[words.start, 0]:self.offsets[words.stop - 1, 1]]
+
+    def segments(self, scope: str = "paragraph", region: np.ndarray = None) -> list:
+        """
+        Chỉ số các từ không phải noise, chia đoạn theo bố cục ("paragraph" | "line");
+        cửa sổ n-gram khi mapping không vượt qua ranh giới đoạn (kể cả giữa các ảnh,
+        vì concat giữ chỉ số bố cục tăng dần qua các ảnh)
+        region: (optional) chỉ lấy các từ trong mask
+        """
+        layout = self.line if scope == "line" else self.paragraph
+        clean = np.flatnonzero(~self.is_noise if region is None else ~self.is_noise & region)
+        if not clean.size:
+            return []
+        bounds = np.flatnonzero(np.diff(layout[clean])) + 1
+        return [part.tolist() for part in np.split(clean, bounds)]
+
+    def rects(self) -> np.ndarray:
+        """Hình chữ nhật bao ngoài từng từ, int32 (N, 4): x0, y0, x1, y1 (tính 1 lần)"""
+        if self._rects is None:
+            self._rects = np.concatenate([self.boxes.min(axis=1), self.boxes.max(axis=1)], axis=1)
+        return self._rects
+
+    def confident(self, min_confidence: float) -> np.ndarray:
+        """Mask các từ có độ tin cậy >= min_confidence"""
+        return self.confidence >= min_confidence
+
+    def image_of(self, word_index: int) -> int | None:
+        """Ảnh chứa từ (None nếu không phải batch scan)"""
+        return None if self.image_index is None else int(self.image_index[word_index])
+
+    # -----------------------------------------------------
+    # Biến đổi (luôn trả về document mới, document gốc có thể đang nằm trong cache)
+    # -----------------------------------------------------
+    def with_boxes(self, boxes: np.ndarray) -> "OcrDocument":
+        if boxes is self.boxes:
+            return self
+        return OcrDocument(self.words, boxes, self.is_noise, self.confidence, self.symbol_confidence,
+                           self.block, self.paragraph, self.line, self.image_index, self.is_duplicate)
+
+    @classmethod
+    def concat(cls, docs: list) -> "OcrDocument":
+        """Gộp kết quả OCR của nhiều ảnh; image_index = vị trí trong docs"""
+        if not docs:
+            return cls.empty()
+
+        def offset_layout(field):
+            # Giữ chỉ số bố cục tăng dần trên toàn bộ document gộp
+            parts, base = [], 0
+            for doc in docs:
+                values = getattr(doc, field)
+                parts.append(values + base)
+                if len(values):
+                    base += int(values.max()) + 1
+            return np.concatenate(parts)
+
+        symbol_parts = []
+        for doc in docs:
+            if not len(doc):
+                continue
+            # Khoảng trắng nối giữa từ cuối ảnh trước và từ đầu ảnh này
+            if symbol_parts:
+                symbol_parts.append(np.ones(1, dtype=np.float32))
+            symbol_parts.append(doc.symbol_confidence)
+        symbol_parts = symbol_parts or [np.zeros(0, dtype=np.float32)]
+
+        return cls(
+            [w for doc in docs for w in doc.words],
+            np.concatenate([doc.boxes for doc in docs]),
+            np.concatenate([doc.is_noise for doc in docs]),
+            np.concatenate([doc.confidence for doc in docs]),
+            np.concatenate(symbol_parts),
+            offset_layout("block"),
+            offset_layout("paragraph"),
+            offset_layout("line"),
+            image_index=np.concatenate([np.full(len(doc), i, dtype=np.int32) for i, doc in enumerate(docs)]),
+        )
+
+
+class OcrDocumentBuilder:
+    """Thu thập từng từ khi parse response Vision rồi tạo OcrDocument 1 lần"""
+
+    def __init__(self):
+        self.words = []
+        self.boxes = []
+        self.is_noise = []
+        self.confidence = []
+        self.symbol_confidence = []
+        self.layout = []
+
+    def add(self, text: str, box: list, is_noise: bool, confidence: float,
+            symbol_confidences: list, block: int, paragraph: int, line: int):
+        """
+        symbol_confidences: độ tin cậy của từng ký tự trong text (len bằng len(text))
+        """
+        if self.words:
+            self.symbol_confidence.append(1.0)
+        self.words.append(text)
+        self.boxes.append(box)
+        self.is_noise.append(is_noise)
+        self.confidence.append(confidence)
+        self.symbol_confidence.extend(symbol_confidences)
+        self.layout.append((block, paragraph, line))
+
+    def last_line(self) -> int | None:
+        return self.layout[-1][2] if self.layout else None
+
+    def build(self) -> OcrDocument:
+        if not self.words:
+            return OcrDocument.empty()
+        layout = np.array(self.layout, dtype=np.int32)
+        return OcrDocument(
+            self.words,
+            np.array(self.boxes, dtype=np.int32),
+            np.array(self.is_noise, dtype=bool),
+            np.array(self.confidence, dtype=np.float32),
+            np.array(self.symbol_confidence, dtype=np.float32),
+            layout[:, 0], layout[:, 1], layout[:, 2],
+        )
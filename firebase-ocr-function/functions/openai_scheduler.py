@@ -0,0 +1,305 @@
+"""
+Bộ điều phối lệnh gọi OpenAI dùng chung cho mọi request trên instance
+
+- Retry lỗi tạm thời (429, 408/409, 5xx, timeout, mất kết nối) với exponential backoff
+  có jitter, trong phạm vi deadline của request (request_scope); hết deadline thì ném lỗi
+  thay vì chờ mãi
+- Đọc header rate limit của OpenAI (x-ratelimit-remaining-*, x-ratelimit-reset-*,
+  retry-after) để tự điều chỉnh số lệnh gọi đồng thời (AIMD): gặp 429 hoặc quota sắp cạn
+  -> giảm một nửa + tạm dừng tới lúc reset; thành công liên tục -> tăng dần tới mức tối đa
+- Hàng chờ theo priority (upstream.UpstreamLimiter): scan tương tác được vào trước
+  batch / việc nền
+
+Thử với server giả lập trả 429 / chậm: benchmarks/fake_openai_server.py
+"""
+import re
+import time
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+import tracing
+from cache import register_cache, env_int
+from upstream import UpstreamLimiter, UpstreamBusy, chat_limiter, embedding_limiter
+
+# Priority (nhỏ hơn = ưu tiên hơn)
+INTERACTIVE = 0
+BATCH = 1
+BACKGROUND = 2
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+# Quota còn dưới tỉ lệ này -> giảm concurrency + chờ tới lúc reset
+LOW_QUOTA_RATIO = 0.05
+# Không tạm dừng quá lâu chỉ vì header (VD: reset-tokens theo phút)
+MAX_PAUSE_SEC = 20.0
+
+_deadline = contextvars.ContextVar("openai_deadline", default=None)
+_priority = contextvars.ContextVar("openai_priority", default=INTERACTIVE)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Hết deadline của request trước khi gọi được OpenAI thành công"""
+
+
+@contextmanager
+def request_scope(deadline_sec: float = None, priority: int = None):
+    """
+    Đặt deadline (giây kể từ bây giờ) / priority cho các lệnh gọi OpenAI bên trong.
+    Lồng nhau: deadline lấy giá trị sớm hơn; priority None = giữ nguyên.
+    Stage của pipeline chạy trong copy của context nên kế thừa scope của request.
+    """
+    tokens = []
+    if deadline_sec is not None:
+        deadline = time.monotonic() + deadline_sec
+        current = _deadline.get()
+        tokens.append((_deadline, _deadline.set(deadline if current is None else min(current, deadline))))
+    if priority is not None:
+        tokens.append((_priority, _priority.set(priority)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def remaining_deadline() -> float | None:
+    """Số giây còn lại của request_scope hiện tại (None nếu không có deadline, tối thiểu 0)"""
+    deadline = _deadline.get()
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+def parse_reset(value) -> float | None:
+    """Thời gian reset kiểu OpenAI ("20ms", "1s", "6m0s", "1h2m3.5s") -> giây"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total, matched = 0.0, False
+    for number, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        total += float(number) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+        matched = True
+    return total if matched else None
+
+
+def _header_int(headers, name: str) -> int | None:
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after(headers) -> float | None:
+    """Thời gian chờ server yêu cầu (retry-after-ms / retry-after), giây"""
+    if headers is None:
+        return None
+    ms = headers.get("retry-after-ms")
+    if ms is not None:
+        try:
+            return float(ms) / 1000
+        except ValueError:
+            pass
+    return parse_reset(headers.get("retry-after"))
+
+
+class OpenAIScheduler:
+    """
+    Args:
+        name: Tên (thống kê health_check)
+        limiter: UpstreamLimiter chặn số lệnh gọi đồng thời (giới hạn hiện tại được điều chỉnh)
+        max_attempts: Số lần gọi tối đa cho 1 lệnh (kể cả lần đầu)
+        base_delay / max_delay: Backoff = random(0, min(max_delay, base_delay * 2^attempt))
+    """
+
+    def __init__(self, name: str, limiter: UpstreamLimiter, max_attempts: int = 5,
+                 base_delay: float = 0.5, max_delay: float = 8.0, min_limit: int = 1):
+        self.name = name
+        self.limiter = limiter
+        self.max_limit = limiter.limit
+        self.min_limit = min_limit
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+        self._successes = 0
+        self._rng = random.Random()
+        self.stats = {
+            "calls": 0, "retries": 0, "rate_limited": 0, "server_errors": 0, "failures": 0,
+            "deadline_exceeded": 0, "throttled": 0, "limit_decreases": 0, "limit_increases": 0
+        }
+        register_cache(self)
+
+    # -----------------------------------------------------
+    # Gọi API
+    # -----------------------------------------------------
+    def call(self, resource, consume=None, **kwargs):
+        """
+        Gọi resource.create(**kwargs) (VD: client.chat.completions) qua hàng chờ + retry
+        Args:
+            consume: (optional) consume(response) chạy khi vẫn giữ slot (VD: đọc hết stream);
+                     lỗi trong consume không được retry (client có thể đã nhận 1 phần)
+        Returns:
+            response đã parse (hoặc kết quả consume)
+        Raises:
+            DeadlineExceeded, hoặc lỗi cuối cùng của OpenAI sau khi hết lượt retry
+        """
+        deadline = _deadline.get()
+        priority = _priority.get()
+        raw_create = getattr(getattr(resource, "with_raw_response", None), "create", None)
+        attempt = 0
+        while True:
+            self._wait_until_resumed(deadline)
+            remaining = self._remaining(deadline)
+            try:
+                self.limiter.acquire(timeout=remaining, priority=priority)
+            except UpstreamBusy:
+                self._count("deadline_exceeded")
+                raise DeadlineExceeded(f"{self.name}: hết deadline khi chờ slot")
+
+            delay = None
+            try:
+                self._count("calls")
+                call_kwargs = dict(kwargs)
+                remaining = self._remaining(deadline)
+                if remaining is not None:
+                    # Không chờ response lâu hơn phần deadline còn lại
+                    call_kwargs["timeout"] = remaining
+                try:
+                    if raw_create is not None:
+                        raw = raw_create(**call_kwargs)
+                        self._on_success(raw.headers)
+                        response = raw.parse()
+                    else:
+                        response = resource.create(**call_kwargs)
+                        self._on_success(None)
+                except Exception as e:
+                    delay = self._on_error(e, attempt)
+                    if delay is None or attempt + 1 >= self.max_attempts:
+                        self._count("failures")
+                        raise
+                    remaining = self._remaining(deadline)
+                    if remaining is not None and delay >= remaining:
+                        self._count("deadline_exceeded")
+                        raise DeadlineExceeded(f"{self.name}: hết deadline khi retry ({e})") from e
+                    logging.warning(f"⚠️ {self.name} lỗi tạm thời ({e}), thử lại sau {delay:.2f}s "
+                                    f"(lần {attempt + 1}/{self.max_attempts})")
+                else:
+                    return consume(response) if consume is not None else response
+            finally:
+                self.limiter.release()
+
+            # Backoff ngoài slot để request khác dùng slot trong lúc chờ
+            self._count("retries")
+            tracing.count("openai_retries")
+            time.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    def _remaining(deadline: float | None) -> float | None:
+        if deadline is None:
+            return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded("Hết deadline của request")
+        return remaining
+
+    def _wait_until_resumed(self, deadline: float | None):
+        """Chờ hết thời gian tạm dừng do rate limit (áp dụng cho mọi lệnh gọi)"""
+        with self._lock:
+            pause = self._paused_until - time.monotonic()
+        if pause <= 0:
+            return
+        if deadline is not None and time.monotonic() + pause >= deadline:
+            self._count("deadline_exceeded")
+            raise DeadlineExceeded(f"{self.name}: đang bị rate limit tới sau deadline")
+        self._count("throttled")
+        with tracing.span("openai_throttle"):
+            time.sleep(pause)
+
+    # -----------------------------------------------------
+    # Điều chỉnh concurrency theo phản hồi của OpenAI
+    # -----------------------------------------------------
+    def _pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + min(seconds, MAX_PAUSE_SEC))
+
+    def _decrease(self):
+        with self._lock:
+            self._successes = 0
+            limit = max(self.min_limit, self.limiter.limit // 2)
+            if limit == self.limiter.limit:
+                return
+            self.stats["limit_decreases"] += 1
+        self.limiter.set_limit(limit)
+        logging.warning(f"⚠️ {self.name}: giảm concurrency xuống {limit}")
+
+    def _on_success(self, headers):
+        low_quota_reset = None
+        if headers is not None:
+            for kind in ("requests", "tokens"):
+                remaining = _header_int(headers, f"x-ratelimit-remaining-{kind}")
+                limit = _header_int(headers, f"x-ratelimit-limit-{kind}")
+                if remaining is not None and limit and remaining < limit * LOW_QUOTA_RATIO:
+                    reset = parse_reset(headers.get(f"x-ratelimit-reset-{kind}"))
+                    low_quota_reset = max(low_quota_reset or 0.0, reset or 1.0)
+        if low_quota_reset is not None:
+            # Sắp cạn quota: chậm lại trước khi bị 429
+            self._decrease()
+            self._pause(low_quota_reset)
+            return
+
+        with self._lock:
+            self._successes += 1
+            # Tăng 1 slot sau mỗi "cửa sổ" thành công (additive increase)
+            if self.limiter.limit >= self.max_limit or self._successes < self.limiter.limit:
+                return
+            self._successes = 0
+            limit = self.limiter.limit + 1
+            self.stats["limit_increases"] += 1
+        self.limiter.set_limit(limit)
+
+    def _on_error(self, error: Exception, attempt: int) -> float | None:
+        """Returns: thời gian chờ trước khi retry, None nếu lỗi không retry được"""
+        import openai
+
+        status = getattr(error, "status_code", None)
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None)
+        if status is not None:
+            if status not in RETRYABLE_STATUS:
+                return None
+        elif not isinstance(error, openai.APIConnectionError):  # gồm cả APITimeoutError
+            return None
+
+        backoff = self._rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        server_wait = retry_after(headers)
+        if status == 429:
+            self._count("rate_limited")
+            tracing.count("openai_rate_limited")
+            self._decrease()
+            self._pause(server_wait if server_wait is not None else backoff)
+        elif status is not None and status >= 500:
+            self._count("server_errors")
+        return max(backoff, server_wait or 0.0)
+
+    def _count(self, field: str):
+        with self._lock:
+            self.stats[field] += 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["paused_sec"] = round(max(0.0, self._paused_until - time.monotonic()), 2)
+        stats["limit"] = self.limiter.limit
+        return stats
+
+
+chat_scheduler = OpenAIScheduler("openai_chat_scheduler", chat_limiter,
+                                 max_attempts=env_int("OPENAI_MAX_ATTEMPTS", 5))
+embedding_scheduler = OpenAIScheduler("openai_embedding_scheduler", embedding_limiter,
+                                      max_attempts=env_int("OPENAI_MAX_ATTEMPTS", 5))
@@ -0,0 +1,127 @@
+"""
+Bộ chạy pipeline dạng DAG (stage graph) cho smart_ocr_rag
+
+Mỗi stage khai báo các stage phụ thuộc; stage nào đủ input sẽ được chạy ngay trên
+thread pool, nên các stage độc lập (VD: phân tích sức khỏe và mapping vị trí) chạy song song.
+Mỗi stage có timeout riêng và fallback: stage chậm/lỗi sẽ trả về kết quả dự phòng
+thay vì chặn các stage khác.
+"""
+import time
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import tracing
+from cache import env_int
+
+# Pool dùng chung cho mọi request trên instance: mỗi scan chạy tối đa ~3 stage cùng lúc,
+# nên cần >= 3 * SCAN_CONCURRENCY (main.py) để stage không phải xếp hàng (timeout của stage
+# tính từ lúc submit)
+_executor = ThreadPoolExecutor(
+    max_workers=env_int("PIPELINE_WORKERS", 64),
+    thread_name_prefix="stage"
+)
+
+# Chu kỳ kiểm tra timeout khi chưa có stage nào hoàn thành
+_POLL_INTERVAL_SEC = 0.05
+
+
+class Stage:
+    """
+    Một bước trong pipeline
+    Args:
+        name: Tên stage (cũng là key kết quả)
+        func: func(results: dict) -> value, results chứa output của các stage phụ thuộc
+        deps: Danh sách tên stage phải xong trước
+        timeout_sec: Thời gian tối đa (None = không giới hạn)
+        fallback: fallback(results, error) -> value khi stage lỗi/quá thời gian;
+                  None = lỗi được ném ra ngoài
+    """
+
+    def __init__(self, name: str, func, deps: list = None, timeout_sec: float = None, fallback=None):
+        self.name = name
+        self.func = func
+        self.deps = deps or []
+        self.timeout_sec = timeout_sec
+        self.fallback = fallback
+
+
+class StageTimeout(Exception):
+    pass
+
+
+def run_stages(stages: list, initial: dict = None, on_stage_done=None) -> tuple[dict, dict]:
+    """
+    Chạy các stage theo thứ tự phụ thuộc, song song khi có thể
+    Args:
+        stages: Danh sách Stage (tên không trùng nhau)
+        initial: Giá trị đầu vào có sẵn (coi như stage đã xong)
+        on_stage_done: (optional) callback(name, value, status) ngay khi một stage xong
+    Returns:
+        (results: tên -> output, report: tên -> {"status", "duration_ms"})
+        status: "ok" | "fallback" | "timeout"
+    """
+    results = dict(initial or {})
+    report = {}
+    pending = {stage.name: stage for stage in stages}
+    running = {}  # future -> (stage, start time)
+
+    def finish(stage, value, status, started):
+        results[stage.name] = value
+        report[stage.name] = {
+            "status": status,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 1)
+        }
+        tracing.add_span(stage.name, report[stage.name]["duration_ms"])
+        if status != "ok":
+            tracing.count(f"stage_{status}")
+        if on_stage_done is not None:
+            on_stage_done(stage.name, value, status)
+
+    def recover(stage, error, status, started):
+        if stage.fallback is None:
+            raise error
+        logging.warning(f"⚠️ Stage '{stage.name}' {status}: {error} -> dùng fallback")
+        finish(stage, stage.fallback(results, error), status, started)
+
+    while pending or running:
+        # Khởi chạy mọi stage đã đủ input
+        for name, stage in list(pending.items()):
+            if all(dep in results for dep in stage.deps):
+                del pending[name]
+                snapshot = dict(results)
+                # Chạy trong copy của context hiện tại (giữ request trace, xem tracing.py)
+                context = contextvars.copy_context()
+                running[_executor.submit(context.run, stage.func, snapshot)] = (stage, time.perf_counter())
+
+        if not running:
+            missing = {name: [d for d in s.deps if d not in results] for name, s in pending.items()}
+            raise ValueError(f"Pipeline có phụ thuộc không thỏa mãn: {missing}")
+
+        # Chờ tới khi có stage xong hoặc tới deadline gần nhất
+        now = time.perf_counter()
+        deadlines = [
+            started + stage.timeout_sec - now
+            for stage, started in running.values() if stage.timeout_sec is not None
+        ]
+        wait_timeout = max(min(deadlines), 0) + _POLL_INTERVAL_SEC if deadlines else None
+        done, _ = wait(list(running), timeout=wait_timeout, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            stage, started = running.pop(future)
+            try:
+                value = future.result()
+            except Exception as e:
+                recover(stage, e, "fallback", started)
+                continue
+            finish(stage, value, "ok", started)
+
+        # Stage quá thời gian: bỏ qua kết quả (thread vẫn chạy nốt ở nền)
+        now = time.perf_counter()
+        for future, (stage, started) in list(running.items()):
+            if stage.timeout_sec is not None and now - started > stage.timeout_sec:
+                del running[future]
+                future.cancel()
+                recover(stage, StageTimeout(f"quá {stage.timeout_sec}s"), "timeout", started)
+
+    return results, report
@@ -0,0 +1,106 @@
+"""
+Gộp các lệnh tính toán trùng nhau đang chạy đồng thời (single-flight)
+
+Lệnh đầu tiên với 1 key (leader) chạy thật; các lệnh cùng key đến trong lúc leader đang
+chạy (follower) chờ và dùng chung kết quả (hoặc lỗi) của leader thay vì gọi lại
+Vision / OpenAI. Khác cache: leader xong là key được xóa, lệnh đến sau chạy lại từ đầu.
+Follower chỉ chờ tối đa timeout (deadline của chính request đó): leader treo (VD: Vision /
+OpenAI không phản hồi) thì follower nhận FlightTimeout thay vì treo tới timeout của function.
+
+Thống kê (leader, số lệnh được gộp, đang chạy, thời gian chờ) expose qua health_check.
+"""
+import time
+import threading
+
+import tracing
+from cache import register_cache
+
+
+class FlightTimeout(TimeoutError):
+    """Follower hết thời gian chờ kết quả của leader"""
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """
+    Args:
+        name: Tên (thống kê health_check, trace: <name>_wait / <name>_shared)
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {"leaders": 0, "shared": 0, "shared_errors": 0, "wait_ms": 0.0, "max_followers": 0,
+                      "timeouts": 0}
+        register_cache(self)
+
+    def do(self, key, func, timeout: float = None):
+        """
+        Chạy func() hoặc chờ lệnh cùng key đang chạy
+        Args:
+            timeout: Thời gian chờ tối đa (giây) của follower; None = chờ tới khi leader xong
+        Returns:
+            (kết quả, shared): shared=True nếu kết quả là của lệnh khác
+        Raises:
+            Lỗi của func (cả leader và follower đều nhận cùng lỗi)
+            FlightTimeout: follower chờ quá timeout (leader vẫn tiếp tục chạy)
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.stats["leaders"] += 1
+                leader = True
+            else:
+                flight.followers += 1
+                self.stats["max_followers"] = max(self.stats["max_followers"], flight.followers)
+                leader = False
+
+        if not leader:
+            started = time.perf_counter()
+            finished = flight.done.wait(timeout)
+            wait_ms = (time.perf_counter() - started) * 1000
+            tracing.add_span(f"{self.name}_wait", wait_ms)
+            if not finished:
+                tracing.count(f"{self.name}_timeouts")
+                with self._lock:
+                    self.stats["timeouts"] += 1
+                    self.stats["wait_ms"] += wait_ms
+                raise FlightTimeout(f"{self.name}: chờ lệnh trùng đang chạy quá {timeout:.0f}s")
+            tracing.count(f"{self.name}_shared")
+            with self._lock:
+                self.stats["shared"] += 1
+                self.stats["wait_ms"] += wait_ms
+                if flight.error is not None:
+                    self.stats["shared_errors"] += 1
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = func()
+            return flight.result, False
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["in_flight"] = len(self._flights)
+        calls = stats["leaders"] + stats["shared"]
+        stats["shared_rate"] = round(stats["shared"] / calls, 3) if calls else 0
+        stats["wait_ms"] = round(stats["wait_ms"], 1)
+        return stats
@@ -0,0 +1,17 @@
+"""
+Test offline: không gọi Vision / OpenAI / Realtime Database thật
+
+Chạy từ firebase-ocr-function/functions:
+    python -m pytest -q tests
+"""
+import os
+import sys
+
+# Tắt cache L2 (Realtime Database) trước khi import các module của functions
+for _name in ("OCR_CACHE_L2", "EMBEDDING_CACHE_L2", "VERDICT_CACHE_L2", "PREPROCESS_ENABLED"):
+    os.environ.setdefault(_name, "0")
+
+FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, FUNCTIONS_DIR)
+# Client / server OpenAI, Vision giả lập và nhãn tổng hợp dùng chung với benchmark
+sys.path.insert(0, os.path.join(FUNCTIONS_DIR, "..", "benchmarks"))
@@ -0,0 +1,58 @@
+from allergen_profile import compile_profile, find_local_warnings
+
+
+def _warned(ingredient: str, allergies: list) -> dict:
+    """tên tình trạng -> warning_type cao nhất của nguyên liệu"""
+    hits = compile_profile({"allergy": allergies}).match(ingredient)
+    return {condition: warning_type for _, condition, _, warning_type in hits}
+
+
+def test_exclusion_only_applies_to_its_own_condition():
+    # "bơ đậu phộng" không phải sữa, nhưng vẫn là đậu phộng
+    assert _warned("Bơ đậu phộng", ["sữa", "đậu phộng"]) == {"đậu phộng": "allergy"}
+    # "sữa đậu nành" không phải sữa, nhưng vẫn là đậu nành
+    assert _warned("Sữa đậu nành", ["sữa", "đậu nành"]) == {"đậu nành": "allergy"}
+
+
+def test_exclusion_still_suppresses_its_own_condition():
+    assert _warned("sữa dừa", ["sữa"]) == {}
+    assert _warned("bơ đậu phộng", ["sữa"]) == {}
+    # Trigger nằm ngoài cụm loại trừ vẫn được cảnh báo
+    assert _warned("sữa dừa, bơ sữa", ["sữa"]) == {"sữa": "allergy"}
+
+
+def test_find_local_warnings_peanut_butter():
+    warnings = find_local_warnings(["bột mì", "bơ đậu phộng"], {"allergy": ["sữa", "đậu phộng"]})
+    assert [(w["ingredient"], w["warning_type"]) for w in warnings] == [("bơ đậu phộng", "allergy")]
+    assert warnings[0]["conditions"] == ["đậu phộng"]
+
+
+def _medical(ingredient: str, conditions: list) -> set:
+    hits = compile_profile({"medical_history": conditions}).match(ingredient)
+    return {condition for _, condition, _, _ in hits}
+
+
+def test_avocado_is_not_butter():
+    # "bơ" trần là quả bơ: không phải sữa, nhưng là phản ứng chéo với latex
+    assert _warned("Bơ sáp", ["sữa"]) == {}
+    assert _warned("Bơ", ["latex"]) == {"latex": "cross_reactivity"}
+    assert _warned("Bơ sữa", ["sữa", "latex"]) == {"sữa": "allergy"}
+    assert _medical("Bơ nghiền", ["gan nhiễm mỡ"]) == set()
+
+
+def test_additive_codes_need_prefix_or_parentheses():
+    for text in ("Chất bảo quản (220)", "Chất bảo quản (211, 223)", "E220", "INS 223"):
+        assert _warned(text, ["sulfite"]) == {"sulfite": "allergy"}, text
+    # Số đứng trần: khối lượng, hàm lượng...
+    assert _warned("Khối lượng tịnh 220g", ["sulfite"]) == {}
+    assert _warned("Bánh quy (220g)", ["sulfite"]) == {}
+    assert _warned("Đường 221", ["sulfite"]) == {}
+    assert _medical("Chất điều chỉnh độ acid (330)", ["viêm họng"]) == {"viêm họng"}
+    assert _medical("330 kcal", ["viêm họng"]) == set()
+    assert _medical("Chất ổn định (451i)", ["bệnh thận"]) == {"bệnh thận"}
+    assert _medical("Chất ổn định INS 452(i)", ["bệnh thận"]) == {"bệnh thận"}
+
+
+def test_pepper_needs_explicit_phrase():
+    assert _medical("Hạt tiêu đen", ["viêm họng"]) == {"viêm họng"}
+    assert _medical("Tiêu hóa tốt", ["viêm họng"]) == set()
@@ -0,0 +1,85 @@
+import threading
+
+import cache
+from cache import TieredCache, RealtimeDbTier, l2_write_scope
+from fake_clients import Latency, FakeRealtimeDb
+
+
+class _BlockingDb:
+    """firebase_admin.db giả lập: lệnh ghi chờ tới khi được release"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.written = threading.Event()
+        self.data = {}
+        self.requests = 0
+
+    def reference(self, path: str):
+        db = self
+
+        class Ref:
+            def set(self, value):
+                db.requests += 1
+                db.release.wait(5)
+                db.data[path] = value
+                db.written.set()
+
+            def update(self, values):
+                db.requests += 1
+                db.release.wait(5)
+                for key, value in values.items():
+                    db.data[f"{path}/{key}"] = value
+                db.written.set()
+
+        return Ref()
+
+
+def _cache(monkeypatch, name: str):
+    db = _BlockingDb()
+    monkeypatch.setattr(cache, "db", db)
+    return db, TieredCache(name, str, str, use_l2=True)
+
+
+def test_set_does_not_wait_for_l2_write(monkeypatch):
+    db, tiered = _cache(monkeypatch, "test_set_background")
+    tiered.set("key", "value")
+    # Đã trả về (L1 có giá trị) trong khi lệnh ghi L2 vẫn đang chờ
+    assert tiered.l1.get("key") == "value" and not db.written.is_set()
+    db.release.set()
+    assert db.written.wait(5)
+    assert db.data["cache/test_set_background/key"]["v"] == "value"
+
+
+def test_scope_waits_for_pending_writes(monkeypatch):
+    db, tiered = _cache(monkeypatch, "test_scope_flush")
+    threading.Timer(0.05, db.release.set).start()
+    with l2_write_scope():
+        tiered.set("key", "value")
+        assert not db.written.is_set()
+    # Thoát scope (kết thúc request) chỉ sau khi lệnh ghi L2 đã xong
+    assert db.written.is_set()
+
+
+def test_expired_entry_is_deleted_on_read(monkeypatch):
+    rtdb = FakeRealtimeDb(Latency(0))
+    monkeypatch.setattr(cache, "db", rtdb)
+    rtdb.reference("cache/test_expired/key").set({"v": "old", "exp": 1})
+    assert RealtimeDbTier("test_expired", ttl_sec=60).get("key") is None
+    assert "cache/test_expired/key" not in rtdb._data
+
+
+def test_set_many_writes_one_request(monkeypatch):
+    db, tiered = _cache(monkeypatch, "test_set_many")
+    db.release.set()
+    tiered.set_many({"a": "1", "b": "2"})
+    assert db.written.wait(5)
+    assert {k: v["v"] for k, v in db.data.items()} == {"cache/test_set_many/a": "1", "cache/test_set_many/b": "2"}
+    assert db.requests == 1
+
+
+def test_set_many_chunks_large_batches(monkeypatch):
+    db, tiered = _cache(monkeypatch, "test_set_many_chunks")
+    monkeypatch.setattr(cache, "L2_WRITE_BATCH", 2)
+    db.release.set()
+    tiered.l2.set_many({key: key for key in "abcde"})
+    assert db.requests == 3 and len(db.data) == 5
@@ -0,0 +1,25 @@
+import numpy as np
+
+import cache
+from embedding_cache import EmbeddingStore
+from fake_clients import Latency, FakeRealtimeDb
+
+
+def test_shared_ngram_hits_l2_across_lookups(monkeypatch):
+    rtdb = FakeRealtimeDb(Latency(0))
+    monkeypatch.setattr(cache, "db", rtdb)
+    vectors = {text: np.full(4, i, dtype=np.float32) for i, text in enumerate(["đường", "muối", "bột mì"])}
+
+    writer = EmbeddingStore("test_embeddings_shared", use_l2=True)
+    with cache.l2_write_scope():
+        writer.set_many("text-embedding-3-small", vectors)
+    # Mỗi text 1 node theo model; cả lô trong 1 multi-path update
+    assert sorted(k for k in rtdb._data if k.startswith("cache/test_embeddings_shared/")) == sorted(
+        f"cache/test_embeddings_shared/{EmbeddingStore._key('text-embedding-3-small', t)}" for t in vectors)
+    assert rtdb.stats.snapshot()["rtdb_writes"] == 1
+
+    # Instance khác (L1 trống), nhãn khác chỉ trùng một phần n-gram
+    reader = EmbeddingStore("test_embeddings_shared", use_l2=True)
+    found = reader.get_many("text-embedding-3-small", ["muối", "sữa bột"])
+    assert list(found) == ["muối"] and np.array_equal(found["muối"], vectors["muối"])
+    assert reader.get_many("text-embedding-3-large", ["muối"]) == {}
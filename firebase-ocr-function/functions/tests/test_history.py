@@ -0,0 +1,77 @@
+import json
+
+import flask
+import pytest
+
+import main
+import history_store
+
+_app = flask.Flask(__name__)
+
+
+class _HistoryDb:
+    """firebase_admin.db giả lập cho get_history: ghi lại các path đã đọc"""
+
+    def __init__(self, records: dict, version: str | None):
+        self.records = records
+        self.version = version
+        self.reads = []
+
+    def reference(self, path: str):
+        db = self
+
+        class Ref:
+            def order_by_child(self, child):
+                return self
+
+            def limit_to_last(self, n):
+                return self
+
+            def get(self):
+                db.reads.append(path)
+                if path.startswith(history_store.VERSION_ROOT):
+                    return db.version
+                return dict(sorted(db.records.items(), key=lambda item: item[1]["created_at"]))
+
+        return Ref()
+
+
+def _get_history(monkeypatch, db: _HistoryDb, query: str = "", headers: dict = None):
+    monkeypatch.setattr(main, "db", db)
+    with _app.test_request_context(f"/?device_id=d1{query}", headers=headers or {}):
+        return main.get_history(flask.request)
+
+
+@pytest.fixture
+def records():
+    return {"-a": {"created_at": 1, "ingredients_count": 2, "risk_summary": {}},
+            "-b": {"created_at": 2, "ingredients_count": 3, "risk_summary": {}}}
+
+
+def test_not_modified_reads_only_the_version_node(monkeypatch, records):
+    response = _get_history(monkeypatch, _HistoryDb(records, "-b"))
+    assert response.status_code == 200
+    assert [item["id"] for item in json.loads(response.get_data())["history"]] == ["-b", "-a"]
+
+    db = _HistoryDb(records, "-b")
+    response = _get_history(monkeypatch, db, headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    assert db.reads == [f"{history_store.VERSION_ROOT}/d1"]
+
+    # Lần ghi mới đổi node phiên bản -> ETag cũ không còn khớp
+    records["-c"] = {"created_at": 3, "ingredients_count": 1, "risk_summary": {}}
+    stale = response.headers["ETag"]
+    assert _get_history(monkeypatch, _HistoryDb(records, "-c"), headers={"If-None-Match": stale}).status_code == 200
+
+
+def test_default_view_is_summary(monkeypatch, records):
+    records["-a"]["health_warnings"] = [{"ingredient": "Tôm"}]
+    db = _HistoryDb(records, "-b")
+    history = json.loads(_get_history(monkeypatch, db).get_data())["history"]
+    assert all("health_warnings" not in item for item in history)
+    assert not any(path.startswith(history_store.DETAIL_ROOT) for path in db.reads)
+
+
+def test_split_updates_bumps_version():
+    updates = history_store.split_updates("d1", "-c", {"created_at": 3, "mappings": []})
+    assert updates[f"{history_store.VERSION_ROOT}/d1"] == "-c"
@@ -0,0 +1,22 @@
+import json
+
+import pytest
+
+from eval_ingredient_parser import FIXTURES, evaluate
+from lexical_matcher import normalize
+
+with open(FIXTURES, encoding="utf-8") as _f:
+    LABELS = json.load(_f)
+
+
+@pytest.mark.parametrize("fixture", LABELS, ids=[label["name"] for label in LABELS])
+def test_local_parser(fixture):
+    """Nhãn "expected": null phải gọi model; các nhãn còn lại tách cục bộ đúng từng nguyên liệu"""
+    result = evaluate(fixture)
+    if fixture["expected"] is None:
+        # False accept: bỏ qua model với danh sách sai
+        assert not result["accepted"], f"parser tự tin sai: {result['ingredients']}"
+    else:
+        assert result["accepted"], f"parser không đủ tự tin: {result['issues']}"
+        assert [normalize(i) for i in result["ingredients"]] == [normalize(i) for i in fixture["expected"]]
+
@@ -0,0 +1,34 @@
+from lexical_matcher import match_phrases
+
+MIN_SCORE = 0.85
+
+
+def _match(phrase: str, words: list):
+    """(text khớp, điểm) hoặc None"""
+    found = match_phrases([phrase], words, [list(range(len(words)))], MIN_SCORE)
+    if not found:
+        return None
+    _, matched_text, score = found[0][0]
+    return matched_text, score
+
+
+def test_exact_match():
+    assert _match("bột mì", ["Bột", "mì", "đường"]) == ("Bột mì", 1.0)
+
+
+def test_different_diacritics_do_not_match():
+    # "đường" (sugar) và "dương" chỉ giống nhau sau khi bỏ dấu
+    assert _match("đường", ["dương", "liễu"]) is None
+    assert _match("bột mì", ["bốt", "mí"]) is None
+
+
+def test_ocr_without_diacritics_still_matches():
+    matched, score = _match("đường", ["bot", "mi", "duong"])
+    assert matched == "duong" and MIN_SCORE <= score < 1.0
+    matched, _ = _match("bột mì", ["bot", "mi", "duong"])
+    assert matched == "bot mi"
+
+
+def test_prefers_exact_occurrence_over_folded():
+    found = match_phrases(["đường"], ["dương", "đường"], [[0, 1]], MIN_SCORE)
+    assert [text for _, text, _ in found[0]] == ["đường"]
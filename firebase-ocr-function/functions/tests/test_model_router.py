@@ -0,0 +1,44 @@
+from model_router import ModelRouter, FAST_MODEL, STRONG_MODEL, validate_verdicts
+
+
+def test_reports_fast_model_when_fast_tier_answers():
+    router = ModelRouter("test_router_fast")
+    calls = []
+
+    def call(model):
+        calls.append(model)
+        return {"ok": True}
+
+    assert router.run("task", call, with_model=True) == ({"ok": True}, FAST_MODEL)
+    assert calls == [FAST_MODEL]
+
+
+def test_reports_strong_model_after_escalation():
+    router = ModelRouter("test_router_escalate")
+    calls = []
+
+    def call(model):
+        calls.append(model)
+        if model == FAST_MODEL:
+            raise ValueError("JSON hỏng")
+        return {"ok": True}
+
+    assert router.run("task", call, with_model=True) == ({"ok": True}, STRONG_MODEL)
+    assert calls == [FAST_MODEL, STRONG_MODEL]
+
+
+def test_failed_validation_escalates():
+    router = ModelRouter("test_router_validate")
+    result, model = router.run("task", lambda model: model, with_model=True,
+                               validate=lambda result: "bad" if result == FAST_MODEL else None)
+    assert result == model == STRONG_MODEL
+
+
+def test_verdicts_must_cover_every_pair():
+    asked = {("bột mì", "gluten"), ("đường", "tiểu đường")}
+    risky = {"ingredient": "Bột mì", "condition": "Gluten", "risk_score": 0.9, "warning_type": "allergy"}
+    safe = {"ingredient": "Đường", "condition": "tiểu đường", "risk_score": 0}
+    assert validate_verdicts({"verdicts": [risky, safe]}, asked) is None
+    assert validate_verdicts({"verdicts": [risky]}, asked) == "missing_pair"
+    assert validate_verdicts({"verdicts": [risky, {**safe, "ingredient": "Đuờng"}]}, asked) == "unmatched_verdict"
+    assert validate_verdicts({"verdicts": [risky, {**safe, "risk_score": None}]}, asked) == "invalid_verdict"
@@ -0,0 +1,18 @@
+import main
+import tracing
+from cache import clear_l1_caches
+from fake_clients import Latency, FakeVisionClient
+from synthetic_labels import make_label, to_vision_response
+
+
+def test_batch_preprocess_is_traced(monkeypatch):
+    clear_l1_caches()
+    _, paragraphs = make_label(40, seed=3)
+    monkeypatch.setattr(main, "_vision_client", FakeVisionClient(to_vision_response(paragraphs, seed=3), Latency(0)))
+    monkeypatch.setattr(main, "preprocess_image", lambda content: (content, {}))
+
+    with tracing.trace_scope("test") as trace:
+        doc = main.get_ocr_data_batch([b"test-batch-front", b"test-batch-back"], preprocess=True)
+
+    assert len(doc) > 0
+    assert {"preprocess", "vision"} <= set(trace.to_dict()["spans_ms"])
@@ -0,0 +1,66 @@
+import openai
+import pytest
+
+from fake_openai_server import start_server
+from openai_scheduler import OpenAIScheduler, DeadlineExceeded, request_scope
+from upstream import UpstreamLimiter
+
+MESSAGES = [{"role": "user", "content": "Trích xuất nguyên liệu"}]
+
+
+@pytest.fixture
+def server_factory():
+    servers = []
+
+    def start(**options):
+        server = start_server(["Bột mì", "Đường"], **options)
+        servers.append(server)
+        client = openai.OpenAI(api_key="test", base_url=server.base_url, max_retries=0)
+        return server, client
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def _scheduler(name: str, max_attempts: int = 5) -> OpenAIScheduler:
+    # Backoff ngắn để test chạy nhanh (retry-after của server giả lập: 0.05s)
+    return OpenAIScheduler(name, UpstreamLimiter(f"{name}_upstream", 4), max_attempts=max_attempts,
+                           base_delay=0.01, max_delay=0.05)
+
+
+def test_retries_rate_limited_call(server_factory):
+    # seed=1: request đầu bị 429, request thứ 2 thành công
+    server, client = server_factory(error_rate=0.5, seed=1)
+    scheduler = _scheduler("test_scheduler_429")
+
+    response = scheduler.call(client.chat.completions, model="gpt-4o-mini", messages=MESSAGES)
+
+    assert "Bột mì" in response.choices[0].message.content
+    assert server.stats.snapshot()["rate_limited"] == 1
+    stats = scheduler.get_stats()
+    assert stats["retries"] == 1 and stats["rate_limited"] == 1 and stats["failures"] == 0
+    # 429 -> giảm một nửa concurrency (AIMD)
+    assert stats["limit"] == 2
+
+
+def test_gives_up_after_max_attempts(server_factory):
+    server, client = server_factory(server_error_rate=1.0)
+    scheduler = _scheduler("test_scheduler_500", max_attempts=3)
+
+    with pytest.raises(openai.InternalServerError):
+        scheduler.call(client.chat.completions, model="gpt-4o-mini", messages=MESSAGES)
+
+    assert server.stats.snapshot()["server_errors"] == 3
+    stats = scheduler.get_stats()
+    assert stats["retries"] == 2 and stats["server_errors"] == 3 and stats["failures"] == 1
+
+
+def test_stops_retrying_at_request_deadline(server_factory):
+    server, client = server_factory(latency=1.0)
+    scheduler = _scheduler("test_scheduler_deadline")
+
+    with request_scope(deadline_sec=0.3), pytest.raises(DeadlineExceeded):
+        scheduler.call(client.chat.completions, model="gpt-4o-mini", messages=MESSAGES)
+
+    assert server.stats.snapshot()["requests"] == 1
@@ -0,0 +1,78 @@
+import itertools
+
+import pytest
+
+import main
+from cache import clear_l1_caches
+from fake_clients import Latency, FakeVisionClient, FakeOpenAIClient
+from lexical_matcher import normalize
+from synthetic_labels import make_label, to_vision_response
+
+HEALTH_PROFILE = {"allergy": ["hải sản"], "medical_history": ["tiểu đường"]}
+# Ảnh khác nhau mỗi lượt (không gộp với scan đang chạy của test khác)
+_images = itertools.count()
+
+
+class FailingChatClient(FakeOpenAIClient):
+    """Lệnh chat lỗi (không retry được) với các prompt trong fail_kinds"""
+
+    def __init__(self, ingredients: list, fail_kinds: set):
+        super().__init__(ingredients, Latency(0), Latency(0))
+        self.fail_kinds = fail_kinds
+
+    def respond(self, prompt: str, response_format: dict = None) -> str:
+        kind = "verdicts" if '"verdicts"' in prompt else "extraction"
+        if kind in self.fail_kinds:
+            raise RuntimeError(f"{kind} không khả dụng")
+        return super().respond(prompt, response_format)
+
+
+@pytest.fixture
+def label(monkeypatch):
+    # Cache (OCR, verdict, embedding) không được dùng lại giữa các test
+    clear_l1_caches()
+    ingredients, paragraphs = make_label(120, seed=7)
+    vision = FakeVisionClient(to_vision_response(paragraphs, seed=7), Latency(0))
+    monkeypatch.setattr(main, "_vision_client", vision)
+    # Buộc đi đường model trích xuất (bộ tách cục bộ có test riêng), nguyên liệu = của client giả lập
+    monkeypatch.setattr(main, "extract_ingredients_local", lambda doc, region: None)
+    return ingredients
+
+
+def _scan(client, monkeypatch) -> dict:
+    monkeypatch.setattr(main, "_openai_client", client)
+    image = f"test-pipeline-{next(_images)}".encode()
+    results, report = main.run_scan_stages(image, HEALTH_PROFILE, 0.6, analysis_mode="separate")
+    return main.build_scan_response(results, report, HEALTH_PROFILE, 0.6)
+
+
+def test_scan_against_fake_clients(label, monkeypatch):
+    client = FakeOpenAIClient(label, Latency(0), Latency(0))
+    response = _scan(client, monkeypatch)
+
+    assert response["success"] and "degraded_stages" not in response
+    assert [normalize(i) for i in response["ingredients"]] == [normalize(i) for i in label]
+    # FakeOpenAIClient: 1/4 nguyên liệu có rủi ro, còn lại an toàn
+    assert {normalize(w["ingredient"]) for w in response["health_warnings"]} >= {normalize(i) for i in label[::4]}
+    assert set(response["safe_ingredients"]).isdisjoint(w["ingredient"] for w in response["health_warnings"])
+    # Vector giả lập là ngẫu nhiên: chỉ so khớp cục bộ (lexical) mới chắc chắn tìm được vị trí
+    mapped = {normalize(m["label"]) for m in response["mappings"]}
+    assert mapped >= {normalize(i) for i in label if "(" not in i}
+
+
+def test_health_failure_falls_back(label, monkeypatch):
+    response = _scan(FailingChatClient(label, {"verdicts"}), monkeypatch)
+
+    assert response["success"] and response["degraded_stages"] == ["health"]
+    assert [normalize(i) for i in response["ingredients"]] == [normalize(i) for i in label]
+    # Nguyên liệu chưa có kết luận không được báo là an toàn; mapping vẫn chạy
+    assert response["safe_ingredients"] == []
+    assert response["mappings"]
+
+
+def test_extraction_failure_is_retryable(label, monkeypatch):
+    response = _scan(FailingChatClient(label, {"extraction"}), monkeypatch)
+
+    assert response["success"] and response["ingredients"] == []
+    assert response["degraded_stages"] == ["ingredients"] and response["retryable"]
+    assert response["raw_text"]
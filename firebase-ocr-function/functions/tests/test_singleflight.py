@@ -0,0 +1,31 @@
+import threading
+
+import pytest
+
+from singleflight import SingleFlight, FlightTimeout
+
+
+def test_follower_stops_waiting_for_a_hung_leader():
+    flights = SingleFlight("test_flight_timeout")
+    release = threading.Event()
+    started = threading.Event()
+    results = []
+
+    def hung():
+        started.set()
+        release.wait(5)
+        return "leader"
+
+    leader = threading.Thread(target=lambda: results.append(flights.do("key", hung)))
+    leader.start()
+    assert started.wait(5)
+
+    with pytest.raises(FlightTimeout):
+        flights.do("key", lambda: "follower", timeout=0.05)
+    assert flights.get_stats()["timeouts"] == 1
+
+    # Leader không bị ảnh hưởng, vẫn chạy tới khi xong
+    release.set()
+    leader.join(5)
+    assert results == [("leader", False)]
+    assert flights.get_stats()["in_flight"] == 0
@@ -0,0 +1,28 @@
+import json
+
+import main
+
+
+def _events(response) -> list:
+    return [json.loads(line) for chunk in response.response for line in chunk.splitlines() if line]
+
+
+def test_fallback_replays_only_unsent_warnings(monkeypatch):
+    local = {"ingredient": "Tôm khô", "risk_score": 0.9, "warning_type": "allergy"}
+    late = {"ingredient": "Muối", "risk_score": 0.5, "warning_type": "medical_condition"}
+
+    def fake_run_scan_stages(image_content, health_profile, threshold, on_stage_done=None,
+                             on_warning=None, on_delta=None, analysis_mode=None):
+        on_stage_done("ingredients", ["Muối", "Tôm khô"], "ok")
+        on_warning(local)
+        # Kết quả fallback: merge_warnings đổi thứ tự, cảnh báo đã stream không còn đứng đầu
+        on_stage_done("health", {"warnings": [late, {**local, "ingredient": "tôm khô"}],
+                                 "safe_ingredients": []}, "fallback")
+        return {}, {}
+
+    monkeypatch.setattr(main, "run_scan_stages", fake_run_scan_stages)
+    monkeypatch.setattr(main, "build_scan_response", lambda *args: {"success": True})
+
+    response = main.stream_scan_response(b"img", {"allergy": ["hải sản"]}, 0.6, "ndjson")
+    warnings = [e["data"]["ingredient"] for e in _events(response) if e["event"] == "health_warning"]
+    assert warnings == ["Tôm khô", "Muối"]
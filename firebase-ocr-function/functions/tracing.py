@@ -0,0 +1,161 @@
+"""
+Đo đạc nhẹ cho từng request (không phụ thuộc thư viện ngoài)
+
+Mỗi request tạo 1 RequestTrace (decorator traced) và gắn vào contextvar; các hàm bên
+trong chỉ cần gọi span() / count() / record_usage() mà không phải truyền trace qua tham số.
+pipeline.run_stages chạy stage trong copy của context hiện tại nên các thread stage
+ghi vào cùng trace.
+
+Kết quả được xuất ra:
+- log JSON có cấu trúc (1 dòng / request)
+- header Server-Timing
+- block "debug_timings" trong response body (khi client yêu cầu)
+"""
+import json
+import time
+import uuid
+import logging
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+_current_trace = contextvars.ContextVar("request_trace", default=None)
+
+
+class RequestTrace:
+    """
+    Thời gian (ms, cộng dồn theo tên span) + bộ đếm (token, số chuỗi embed, cache hit/miss)
+    Thread-safe: các stage song song ghi vào cùng 1 trace.
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.request_id = uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        self.spans = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, duration_ms: float):
+        with self._lock:
+            self.spans[name] = self.spans.get(name, 0.0) + duration_ms
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    @staticmethod
+    def cache_hit_rates(counters: dict) -> dict:
+        """Tỉ lệ hit của các cache trong request (từ bộ đếm <name>_cache_hits / <name>_cache_misses)"""
+        names = {key.rsplit("_cache_", 1)[0] for key in counters
+                 if key.endswith(("_cache_hits", "_cache_misses"))}
+        rates = {}
+        for name in sorted(names):
+            hits = counters.get(f"{name}_cache_hits", 0)
+            total = hits + counters.get(f"{name}_cache_misses", 0)
+            rates[name] = round(hits / total, 3) if total else 0
+        return rates
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = {name: round(ms, 1) for name, ms in self.spans.items()}
+            counters = dict(self.counters)
+        return {
+            "request_id": self.request_id,
+            "total_ms": round(self.elapsed_ms(), 1),
+            "spans_ms": spans,
+            "counters": counters,
+            "cache_hit_rates": self.cache_hit_rates(counters),
+        }
+
+    def server_timing(self) -> str:
+        """Giá trị header Server-Timing: "ocr;dur=812.3, health;dur=2301.0, ..., total;dur=..." """
+        with self._lock:
+            items = list(self.spans.items())
+        parts = [f"{name};dur={ms:.1f}" for name, ms in items]
+        parts.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(parts)
+
+    def log(self, **extra):
+        """1 dòng log JSON (Cloud Logging tự parse thành jsonPayload)"""
+        entry = {"message": f"trace {self.endpoint}", "severity": "INFO",
+                 "endpoint": self.endpoint, **self.to_dict(), **extra}
+        logging.info(json.dumps(entry, ensure_ascii=False))
+
+
+def traced(endpoint: str):
+    """
+    Decorator cho HTTP endpoint: tạo trace cho request, thêm header Server-Timing
+    và ghi log JSON khi xong. Response dạng stream tự ghi log khi stream kết thúc
+    (xem main.stream_scan_response), decorator chỉ gắn Server-Timing của phần đã chạy.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(req):
+            trace = RequestTrace(endpoint)
+            token = _current_trace.set(trace)
+            try:
+                response = func(req)
+                response.headers["Server-Timing"] = trace.server_timing()
+                if not response.is_streamed:
+                    trace.log(status=response.status_code)
+                return response
+            finally:
+                # Thread của worker được dùng lại cho request sau
+                _current_trace.reset(token)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def trace_scope(endpoint: str):
+    """Trace cho đoạn code ngoài endpoint (VD: benchmark), yield RequestTrace"""
+    trace = RequestTrace(endpoint)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def current_trace() -> RequestTrace | None:
+    return _current_trace.get()
+
+
+def add_span(name: str, duration_ms: float):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(name, duration_ms)
+
+
+@contextmanager
+def span(name: str):
+    """Đo thời gian một đoạn code vào trace hiện tại (không làm gì nếu không có trace)"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, (time.perf_counter() - started) * 1000)
+
+
+def count(name: str, n: int = 1):
+    trace = _current_trace.get()
+    if trace is not None and n:
+        trace.count(name, n)
+
+
+def record_usage(usage, prefix: str = "openai"):
+    """Cộng token từ response.usage của OpenAI (chat: prompt/completion, embeddings: prompt)"""
+    trace = _current_trace.get()
+    if trace is None or usage is None:
+        return
+    trace.count(f"{prefix}_input_tokens", getattr(usage, "prompt_tokens", 0) or 0)
+    trace.count(f"{prefix}_output_tokens", getattr(usage, "completion_tokens", 0) or 0)
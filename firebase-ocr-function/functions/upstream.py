@@ -0,0 +1,109 @@
+"""
+Giới hạn số lệnh gọi đồng thời tới từng dịch vụ bên ngoài (Vision, OpenAI)
+
+Mỗi instance xử lý nhiều request cùng lúc (concurrency của Cloud Functions gen2), mỗi
+request lại chạy nhiều stage song song. Limiter chặn số lệnh gọi đang bay tới từng
+upstream để không vượt quota / pool kết nối; request vượt giới hạn chờ tới lượt
+(thời gian chờ được ghi vào trace dưới span "<tên>_queue").
+
+Khi hết slot, request có priority nhỏ hơn (VD: scan tương tác) được vào trước;
+cùng priority thì theo thứ tự đến.
+
+Thống kê (đang bay, đỉnh, số lần phải chờ) được expose qua health_check (registry cache).
+"""
+import time
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+
+import tracing
+from cache import register_cache, env_int
+
+
+class UpstreamBusy(Exception):
+    """Chờ slot quá timeout"""
+
+
+class UpstreamLimiter:
+    """
+    Semaphore có thống kê + hàng chờ theo priority, giới hạn có thể đổi lúc chạy (set_limit)
+    Args:
+        name: Tên upstream (tên trong thống kê / trace)
+        limit: Số lệnh gọi đồng thời tối đa
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = max(1, limit)
+        self._cond = threading.Condition()
+        self._waiting = []  # heap (priority, thứ tự đến)
+        self._arrivals = itertools.count()
+        self.stats = {"in_flight": 0, "peak_in_flight": 0, "calls": 0, "waited": 0, "wait_ms": 0.0}
+        register_cache(self)
+
+    def acquire(self, timeout: float = None, priority: int = 0):
+        """
+        Args:
+            timeout: Thời gian chờ slot tối đa (None = chờ tới khi có slot)
+            priority: Nhỏ hơn = được vào trước khi phải xếp hàng
+        Raises:
+            UpstreamBusy nếu chờ quá timeout
+        """
+        started = time.perf_counter()
+        ticket = (priority, next(self._arrivals))
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            waited = self.stats["in_flight"] >= self.limit or self._waiting[0] != ticket
+            ready = self._cond.wait_for(
+                lambda: self.stats["in_flight"] < self.limit and self._waiting[0] == ticket, timeout)
+            if not ready:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise UpstreamBusy(f"{self.name}: không có slot sau {timeout}s")
+            heapq.heappop(self._waiting)
+            # Request kế tiếp trong hàng chờ có thể vào luôn nếu còn slot
+            self._cond.notify_all()
+            self.stats["in_flight"] += 1
+            self.stats["calls"] += 1
+            self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.stats["in_flight"])
+            if waited:
+                wait_ms = (time.perf_counter() - started) * 1000
+                self.stats["waited"] += 1
+                self.stats["wait_ms"] += wait_ms
+        if waited:
+            tracing.add_span(f"{self.name}_queue", wait_ms)
+
+    def release(self):
+        with self._cond:
+            self.stats["in_flight"] -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, timeout: float = None, priority: int = 0):
+        self.acquire(timeout, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def set_limit(self, limit: int):
+        with self._cond:
+            self.limit = max(1, limit)
+            self._cond.notify_all()
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            stats = dict(self.stats)
+            stats["limit"] = self.limit
+            stats["queued"] = len(self._waiting)
+        stats["wait_ms"] = round(stats["wait_ms"], 1)
+        return stats
+
+
+# Mặc định: đủ cho SCAN_CONCURRENCY (main.py) request cùng lúc, mỗi request tối đa
+# 1 lệnh Vision, 2 lệnh chat (trích xuất -> sức khỏe) và 1-2 lệnh embeddings
+vision_limiter = UpstreamLimiter("vision", env_int("VISION_MAX_IN_FLIGHT", 16))
+chat_limiter = UpstreamLimiter("openai_chat", env_int("OPENAI_CHAT_MAX_IN_FLIGHT", 16))
+embedding_limiter = UpstreamLimiter("openai_embedding", env_int("OPENAI_EMBEDDING_MAX_IN_FLIGHT", 8))